@@ -23,6 +23,39 @@ class Config:
     AES_KEY: bytes = hashlib.sha256(os.getenv("AES_SECRET_KEY", "default_secret_key").encode()).digest()
     AES_IV: bytes = os.getenv("AES_IV", "default_iv_12345678").encode()[:16]  # IV должен быть 16 байт
 
+    # Параметры доставки рассылок
+    BROADCAST_RATE: float = float(os.getenv("BROADCAST_RATE", "28"))  # сообщений/сек (лимит Telegram ~30)
+    BROADCAST_CONCURRENCY: int = int(os.getenv("BROADCAST_CONCURRENCY", "20"))  # число параллельных отправителей
+    BROADCAST_CHAT_INTERVAL: float = float(os.getenv("BROADCAST_CHAT_INTERVAL", "1.0"))  # секунд между сообщениями в один чат
+    BROADCAST_BATCH_SIZE: int = int(os.getenv("BROADCAST_BATCH_SIZE", "500"))  # строк outbox за одну выборку
+    BROADCAST_MIN_RATE: float = float(os.getenv("BROADCAST_MIN_RATE", "3"))  # нижняя граница при flood control
+    BROADCAST_MAX_RETRIES: int = int(os.getenv("BROADCAST_MAX_RETRIES", "5"))  # повторов для временных ошибок
+    BROADCAST_RETRY_BASE: float = float(os.getenv("BROADCAST_RETRY_BASE", "2"))  # базовая задержка повтора, сек
+    BROADCAST_RETRY_CAP: float = float(os.getenv("BROADCAST_RETRY_CAP", "120"))  # максимальная задержка повтора, сек
+    BROADCAST_LEASE_SECONDS: int = int(os.getenv("BROADCAST_LEASE_SECONDS", "300"))  # аренда запуска рассылки процессом
+    BROADCAST_WORKERS: int = int(os.getenv("BROADCAST_WORKERS", "0"))  # процессов-воркеров доставки (0 – отправка в основном процессе)
+    BROADCAST_WORKER_POLL: float = float(os.getenv("BROADCAST_WORKER_POLL", "2"))  # секунд между проверками outbox воркерами
+    BROADCAST_SEND_MODE: str = os.getenv("BROADCAST_SEND_MODE", "send")  # send – сборка из file_ids, copy/forward – из исходного сообщения
+    MAX_CONCURRENT_MAILINGS: int = int(os.getenv("MAX_CONCURRENT_MAILINGS", "4"))  # рассылок по расписанию одновременно
+    AUDIENCE_SNAPSHOT_LEAD: int = int(os.getenv("AUDIENCE_SNAPSHOT_LEAD", "300"))  # за сколько секунд до next_run готовить аудиторию
+    AUDIENCE_ESTIMATE_TTL: int = int(os.getenv("AUDIENCE_ESTIMATE_TTL", "60"))  # секунд кэша оценки размера аудитории
+    VIEWER_INDEX_REFRESH: int = int(os.getenv("VIEWER_INDEX_REFRESH", "3600"))  # секунд между полными перестроениями индекса аудитории (0 – индекс выключен)
+    BROADCAST_PROGRESS_INTERVAL: float = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "10"))  # секунд между обновлениями прогресса
+    DELIVERY_LOG_BATCH_SIZE: int = int(os.getenv("DELIVERY_LOG_BATCH_SIZE", "5000"))  # строк журнала доставки в одном COPY
+    LAST_VISIT_FLUSH_INTERVAL: float = float(os.getenv("LAST_VISIT_FLUSH_INTERVAL", "5"))  # секунд между записями last_interaction
+    LAST_VISIT_RESOLUTION: int = int(os.getenv("LAST_VISIT_RESOLUTION", "60"))  # не обновлять last_interaction чаще, секунд
+    PERF_METRICS_HOST: str = os.getenv("PERF_METRICS_HOST", "127.0.0.1")  # адрес эндпоинта /metrics
+    PERF_METRICS_PORT: int = int(os.getenv("PERF_METRICS_PORT", "9100"))  # порт эндпоинта /metrics (0 – выключен)
+
+    # Пул соединений с БД (на каждый процесс: основной и каждый воркер доставки)
+    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", "10"))  # постоянных соединений в пуле
+    DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", "5"))  # временных соединений сверх DB_POOL_SIZE
+    DB_POOL_TIMEOUT: float = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # секунд ожидания свободного соединения
+    DB_POOL_RECYCLE: int = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # пересоздавать соединения старше, секунд
+    DB_POOL_PRE_PING: bool = os.getenv("DB_POOL_PRE_PING", "1").lower() in ("1", "true", "yes")  # проверять соединение при выдаче
+    DB_AUTO_MIGRATE: bool = os.getenv("DB_AUTO_MIGRATE", "0").lower() in ("1", "true", "yes")  # применять миграции при старте бота
+    DB_STATEMENT_CACHE_SIZE: int = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500"))  # подготовленных запросов asyncpg на соединение (0 – для pgbouncer)
+
     @property
     def database_url(self) -> str:
         return (
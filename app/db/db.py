@@ -1,29 +1,106 @@
 import logging
+import time
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from app.config import config
+from app.utils.perf import metrics, record_query
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """
+    Пул соединений, замеряющий время ожидания соединения (включая открытие нового).
+    """
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            metrics.inc("bot_db_pool_timeouts_total")
+            raise
+        finally:
+            metrics.observe("bot_db_pool_wait_seconds", (), time.perf_counter() - started)
+
 
 # Создаём асинхронный движок SQLAlchemy
-engine = create_async_engine(config.database_url, echo=False)
+engine = create_async_engine(
+    config.database_url,
+    echo=False,
+    poolclass=TimedQueuePool,
+    pool_size=config.DB_POOL_SIZE,
+    max_overflow=config.DB_MAX_OVERFLOW,
+    pool_timeout=config.DB_POOL_TIMEOUT,
+    pool_recycle=config.DB_POOL_RECYCLE,
+    pool_pre_ping=config.DB_POOL_PRE_PING,
+    # Кэш подготовленных запросов на соединение: у asyncpg и у адаптера SQLAlchemy
+    connect_args={
+        "statement_cache_size": config.DB_STATEMENT_CACHE_SIZE,
+        "prepared_statement_cache_size": config.DB_STATEMENT_CACHE_SIZE,
+    },
+)
+
+
+def pool_state() -> dict[str, int]:
+    """
+    Текущее состояние пула: занятые, свободные и временные (overflow) соединения.
+    """
+    pool = engine.pool
+    return {
+        "size": pool.size(),
+        "in_use": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "max": pool.size() + config.DB_MAX_OVERFLOW,
+    }
+
+
+metrics.histogram("bot_db_pool_wait_seconds", "Ожидание соединения из пула БД")
+metrics.counter("bot_db_pool_timeouts_total", "Отказы по таймауту ожидания соединения из пула БД")
+metrics.gauge(
+    "bot_db_pool_connections", "Соединения пула БД по состоянию",
+    lambda: {(("state", state),): value for state, value in pool_state().items()}
+)
+
+
+# Время каждого запроса к БД – в метрики и в счётчики текущего апдейта (см. app/utils/perf.py)
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    record_query(time.perf_counter() - conn.info["query_started"].pop())
+
+
+@event.listens_for(engine.sync_engine, "handle_error")
+def _query_failed(context):
+    started = context.connection.info.get("query_started") if context.connection is not None else None
+    if started:
+        record_query(time.perf_counter() - started.pop())
+
 
 # Создаём фабрику асинхронных сессий
 AsyncSessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
 
-async def init_db(Base):
+async def init_db():
     """
-    Удаляет все таблицы, кроме User, и создаёт их заново при запуске.
+    Проверяет, что схема БД актуальна. Таблицы и индексы создаются миграциями
+    (python -m app.db.migrate); при DB_AUTO_MIGRATE=1 они применяются здесь же.
     """
-    async with engine.begin() as conn:
-        # # Получаем список таблиц для удаления, исключая User
-        # tables_to_drop = [table for table in Base.metadata.sorted_tables if table.name in ["mailings","mailing_schedules", "mailing_statuses"]]
-        #
-        # # Удаляем выбранные таблицы
-        # for table in reversed(tables_to_drop):  # Удаляем в обратном порядке зависимостей
-        #     await conn.run_sync(table.drop)
-        # logging.info('Таблицы "mailings","mailing_schedules", "mailing_statuses" удалены.')
-
-        # Создаём все таблицы заново
-        await conn.run_sync(Base.metadata.create_all)
-        logging.info("Таблицы в БД созданы/обновлены.")
+    from app.db.migrate import pending_migrations, migrate
+
+    pending = await pending_migrations()
+    if not pending:
+        logging.info("Схема БД актуальна.")
+        return
+    names = ", ".join(f"{migration.version:04d}_{migration.name}" for migration in pending)
+    if not config.DB_AUTO_MIGRATE:
+        raise RuntimeError(f"Не применены миграции БД: {names}. Выполните python -m app.db.migrate")
+    await migrate()
+    logging.info(f"Применены миграции БД: {names}.")
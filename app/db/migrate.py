@@ -0,0 +1,229 @@
+"""
+Версионные миграции схемы БД.
+
+    python -m app.db.migrate           – применить новые миграции
+    python -m app.db.migrate --status  – показать применённые и ожидающие
+
+Каждая миграция выполняется в своей транзакции и записывается в schema_migrations.
+Несколько одновременно запущенных экземпляров не мешают друг другу (advisory lock).
+Новые миграции добавляются в конец MIGRATIONS со следующим номером; уже выпущенные не меняются.
+"""
+import argparse
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from sqlalchemy import text
+
+from app.db.db import engine
+
+MIGRATIONS_LOCK_ID = 7_204_318  # ключ pg_advisory_xact_lock для миграций
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    statements: tuple[str, ...] = ()
+    run: Callable[..., Awaitable] | None = None
+
+
+MIGRATIONS: tuple[Migration, ...] = (
+    # Исходная схема бота (до outbox рассылок). Записана явным DDL, а не через модели:
+    # миграция не должна меняться вместе с app/db/models.py. На уже развёрнутой БД ничего не делает.
+    Migration(1, "baseline", statements=(
+        "CREATE TABLE IF NOT EXISTS users ("
+        " id SERIAL PRIMARY KEY,"
+        " tg_id VARCHAR NOT NULL,"
+        " wp_id VARCHAR,"
+        " status VARCHAR,"
+        " username_in_tg VARCHAR,"
+        " tg_fullname VARCHAR,"
+        " first_name VARCHAR,"
+        " last_name VARCHAR,"
+        " last_interaction TIMESTAMP WITHOUT TIME ZONE,"
+        " created_at TIMESTAMP WITHOUT TIME ZONE)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_tg_id ON users (tg_id)",
+        "CREATE TABLE IF NOT EXISTS materials ("
+        " id SERIAL PRIMARY KEY,"
+        " keyword VARCHAR NOT NULL UNIQUE,"
+        " chat_id VARCHAR,"
+        " message_id VARCHAR,"
+        " file_ids TEXT,"
+        " caption TEXT,"
+        " caption_entities TEXT)",
+        "CREATE TABLE IF NOT EXISTS keyword_links ("
+        " id SERIAL PRIMARY KEY,"
+        " link VARCHAR NOT NULL UNIQUE,"
+        " material_id INTEGER NOT NULL REFERENCES materials (id),"
+        " expiration_date TIMESTAMP WITHOUT TIME ZONE,"
+        " max_clicks INTEGER,"
+        " click_count INTEGER)",
+        "CREATE TABLE IF NOT EXISTS material_views ("
+        " id SERIAL PRIMARY KEY,"
+        " user_id INTEGER NOT NULL REFERENCES users (id),"
+        " material_id INTEGER NOT NULL REFERENCES materials (id),"
+        " viewed_at TIMESTAMP WITHOUT TIME ZONE)",
+        "CREATE TABLE IF NOT EXISTS mailings ("
+        " id SERIAL PRIMARY KEY,"
+        " title VARCHAR NOT NULL,"
+        " saved_chat_id VARCHAR,"
+        " saved_message_id VARCHAR,"
+        " file_ids TEXT,"
+        " caption TEXT,"
+        " caption_entities TEXT,"
+        " active INTEGER,"
+        " created_at TIMESTAMP WITHOUT TIME ZONE)",
+        "CREATE TABLE IF NOT EXISTS mailing_statuses ("
+        " id SERIAL PRIMARY KEY,"
+        " mailing_id INTEGER REFERENCES mailings (id) ON DELETE CASCADE,"
+        " user_status VARCHAR NOT NULL,"
+        " CONSTRAINT uq_mailing_status UNIQUE (mailing_id, user_status))",
+        "CREATE TABLE IF NOT EXISTS mailing_schedules ("
+        " id SERIAL PRIMARY KEY,"
+        " mailing_id INTEGER REFERENCES mailings (id) ON DELETE CASCADE,"
+        " schedule_type VARCHAR,"
+        " day_of_week VARCHAR,"
+        " day_of_month VARCHAR,"
+        " time_of_day VARCHAR,"
+        " next_run TIMESTAMP WITHOUT TIME ZONE,"
+        " active INTEGER)",
+    )),
+    # Outbox рассылок: запуски и получатели каждого запуска
+    Migration(2, "mailing_outbox", statements=(
+        "CREATE TABLE IF NOT EXISTS mailing_runs ("
+        " id SERIAL PRIMARY KEY,"
+        " mailing_id INTEGER NOT NULL REFERENCES mailings (id) ON DELETE CASCADE,"
+        " schedule_id INTEGER REFERENCES mailing_schedules (id) ON DELETE SET NULL,"
+        " scheduled_for TIMESTAMP WITHOUT TIME ZONE,"
+        " status VARCHAR NOT NULL,"
+        " started_at TIMESTAMP WITHOUT TIME ZONE,"
+        " finished_at TIMESTAMP WITHOUT TIME ZONE,"
+        " CONSTRAINT uq_mailing_run_schedule UNIQUE (schedule_id, scheduled_for))",
+        "CREATE TABLE IF NOT EXISTS mailing_deliveries ("
+        " id SERIAL PRIMARY KEY,"
+        " run_id INTEGER NOT NULL REFERENCES mailing_runs (id) ON DELETE CASCADE,"
+        " tg_id VARCHAR NOT NULL,"
+        " status VARCHAR NOT NULL,"
+        " error TEXT,"
+        " updated_at TIMESTAMP WITHOUT TIME ZONE,"
+        " CONSTRAINT uq_mailing_delivery UNIQUE (run_id, tg_id))",
+        "CREATE INDEX IF NOT EXISTS ix_mailing_deliveries_run_status ON mailing_deliveries (run_id, status)",
+    )),
+    # Версия содержимого рассылки для кэша подготовленных сообщений
+    Migration(3, "mailing_updated_at", statements=(
+        "ALTER TABLE mailings ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITHOUT TIME ZONE",
+    )),
+    # Недоступные для рассылок пользователи (бот заблокирован, аккаунт удалён)
+    Migration(4, "user_reachability", statements=(
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMP WITHOUT TIME ZONE",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS delivery_failures INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS ix_users_blocked_at ON users (tg_id) WHERE blocked_at IS NOT NULL",
+    )),
+    # Аренда запусков между экземплярами бота
+    Migration(5, "mailing_run_leases", statements=(
+        "ALTER TABLE mailing_runs ADD COLUMN IF NOT EXISTS audience_loaded_at TIMESTAMP WITHOUT TIME ZONE",
+        "ALTER TABLE mailing_runs ADD COLUMN IF NOT EXISTS owner VARCHAR",
+        "ALTER TABLE mailing_runs ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP WITHOUT TIME ZONE",
+    )),
+    # Журнал доставки (пишется через COPY, без внешних ключей)
+    Migration(6, "delivery_log", statements=(
+        "CREATE TABLE IF NOT EXISTS delivery_log ("
+        " id BIGSERIAL PRIMARY KEY,"
+        " mailing_id INTEGER,"
+        " schedule_id INTEGER,"
+        " run_id INTEGER,"
+        " tg_id VARCHAR NOT NULL,"
+        " status SMALLINT NOT NULL,"
+        " error_class VARCHAR(64),"
+        " created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS ix_delivery_log_mailing_run ON delivery_log (mailing_id, run_id)",
+    )),
+    # Отпечаток аудитории заранее подготовленных запусков
+    Migration(7, "mailing_run_audience_key", statements=(
+        "ALTER TABLE mailing_runs ADD COLUMN IF NOT EXISTS audience_key VARCHAR(40)",
+    )),
+    # Растянутая во времени отправка: окно расписания и слот каждого получателя
+    Migration(8, "delivery_spread", statements=(
+        "ALTER TABLE mailing_schedules ADD COLUMN IF NOT EXISTS spread_minutes INTEGER DEFAULT 0",
+        "ALTER TABLE mailing_deliveries ADD COLUMN IF NOT EXISTS not_before TIMESTAMP WITHOUT TIME ZONE",
+    )),
+    # Индексы для фильтров на горячих путях: аудитория по ключевым словам и статусам, /start, профиль, ссылки
+    Migration(9, "hot_path_indexes", statements=(
+        "CREATE INDEX IF NOT EXISTS ix_material_views_user_id ON material_views (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_material_views_material_id ON material_views (material_id)",
+        "CREATE INDEX IF NOT EXISTS ix_users_wp_id ON users (wp_id)",
+        "CREATE INDEX IF NOT EXISTS ix_keyword_links_material_id ON keyword_links (material_id)",
+        "CREATE INDEX IF NOT EXISTS ix_users_lower_status ON users (lower(status))",
+    )),
+)
+
+
+async def ensure_migrations_table(conn):
+    await conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        " version INTEGER PRIMARY KEY,"
+        " name VARCHAR NOT NULL,"
+        " applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'utc'))"
+    ))
+
+
+async def applied_versions(conn) -> set[int]:
+    result = await conn.execute(text("SELECT version FROM schema_migrations"))
+    return set(result.scalars().all())
+
+
+async def pending_migrations() -> list[Migration]:
+    """
+    Миграции, ещё не применённые к БД.
+    """
+    async with engine.begin() as conn:
+        await ensure_migrations_table(conn)
+        applied = await applied_versions(conn)
+    return [migration for migration in MIGRATIONS if migration.version not in applied]
+
+
+async def migrate() -> list[Migration]:
+    """
+    Применяет ожидающие миграции по порядку, каждую в отдельной транзакции. Возвращает применённые.
+    """
+    done = []
+    for migration in await pending_migrations():
+        async with engine.begin() as conn:
+            await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATIONS_LOCK_ID})
+            # Другой экземпляр мог применить миграцию, пока мы ждали блокировку
+            if migration.version in await applied_versions(conn):
+                continue
+            for statement in migration.statements:
+                await conn.execute(text(statement))
+            if migration.run:
+                await migration.run(conn)
+            await conn.execute(
+                text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                {"version": migration.version, "name": migration.name},
+            )
+        logging.info(f"🗄 Миграция {migration.version:04d}_{migration.name} применена")
+        done.append(migration)
+    return done
+
+
+async def main(show_status: bool):
+    try:
+        if show_status:
+            pending = {migration.version for migration in await pending_migrations()}
+            for migration in MIGRATIONS:
+                state = "ожидает" if migration.version in pending else "применена"
+                print(f"{migration.version:04d}_{migration.name}: {state}")
+            return
+        done = await migrate()
+        logging.info(f"Схема БД актуальна, применено миграций: {len(done)}.")
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    parser = argparse.ArgumentParser(description="Миграции схемы БД")
+    parser.add_argument("--status", action="store_true", help="показать применённые и ожидающие миграции")
+    asyncio.run(main(parser.parse_args().status))
@@ -1,6 +1,6 @@
 from datetime import datetime
 from sqlalchemy.orm import declarative_base, relationship
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, UniqueConstraint, Text
+from sqlalchemy import Column, Integer, BigInteger, SmallInteger, String, DateTime, ForeignKey, UniqueConstraint, Text, Index, func
 
 Base = declarative_base()
 
@@ -12,7 +12,7 @@ class User(Base):
 
     id = Column(Integer, primary_key=True)
     tg_id = Column(String, unique=True, index=True, nullable=False)
-    wp_id = Column(String, nullable=True)
+    wp_id = Column(String, nullable=True, index=True)
     status = Column(String, nullable=True)  # пример: "подписка на 6 месяцев", "зарегистрирован" и т.д.
     username_in_tg = Column(String, nullable=True)
     tg_fullname = Column(String, nullable=True)
@@ -22,6 +22,16 @@ class User(Base):
     last_interaction = Column(DateTime, nullable=True)  # Дата последнего взаимодействия
     created_at = Column(DateTime, default=datetime.utcnow, nullable=True)
 
+    # Доступность для рассылок: бот заблокирован / аккаунт удалён
+    blocked_at = Column(DateTime, nullable=True)  # None = пользователь доступен
+    delivery_failures = Column(Integer, default=0, nullable=False, server_default="0")
+
+
+# Выбор аудитории по статусу идёт через lower(status)
+Index("ix_users_lower_status", func.lower(User.status))
+# Недоступных немного: снятие отметки при /start ищет только среди них
+Index("ix_users_blocked_at", User.tg_id, postgresql_where=User.blocked_at.is_not(None))
+
 class Material(Base):
     """
     Таблица материалов, привязанных к ключевым словам.
@@ -49,7 +59,7 @@ class KeywordLink(Base):
 
     id = Column(Integer, primary_key=True)
     link = Column(String, unique=True, nullable=False)
-    material_id = Column(Integer, ForeignKey("materials.id"), nullable=False)
+    material_id = Column(Integer, ForeignKey("materials.id"), nullable=False, index=True)
     expiration_date = Column(DateTime, nullable=True)
     max_clicks = Column(Integer, nullable=True)
     click_count = Column(Integer, default=0)
@@ -63,8 +73,8 @@ class MaterialView(Base):
     __tablename__ = "material_views"
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    material_id = Column(Integer, ForeignKey("materials.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    material_id = Column(Integer, ForeignKey("materials.id"), nullable=False, index=True)
     viewed_at = Column(DateTime, default=datetime.utcnow)
 
     material = relationship("Material", back_populates="views", lazy="selectin")
@@ -84,6 +94,7 @@ class Mailing(Base):
     caption_entities = Column(Text, nullable=True)     # JSON-строка с caption_entities
     active = Column(Integer, default=1)  # 1 = активна, 0 = нет
     created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, nullable=True, onupdate=datetime.utcnow)  # версия содержимого для кэша
 
     statuses = relationship("MailingStatus", back_populates="mailing", cascade="all, delete-orphan", lazy="selectin")
     schedules = relationship("MailingSchedule", back_populates="mailing", cascade="all, delete-orphan", lazy="selectin")
@@ -118,6 +129,7 @@ class MailingSchedule(Base):
     day_of_month = Column(String, nullable=True)  # "1,15,28" и т.п.
     time_of_day = Column(String, nullable=True)  # "HH:MM"
     next_run = Column(DateTime, nullable=True)
+    spread_minutes = Column(Integer, default=0, server_default="0")  # растянуть отправку на N минут после next_run
     active = Column(Integer, default=1)
 
     mailing = relationship("Mailing", back_populates="schedules", lazy="selectin")
@@ -127,3 +139,71 @@ class MailingSchedule(Base):
                 f"next={self.next_run}, active={self.active})>")
 
 
+class MailingRun(Base):
+    """
+    Запуск рассылки: один проход по аудитории (для расписания или разовой отправки).
+    """
+    __tablename__ = "mailing_runs"
+
+    id = Column(Integer, primary_key=True)
+    mailing_id = Column(Integer, ForeignKey("mailings.id", ondelete="CASCADE"), nullable=False)
+    schedule_id = Column(Integer, ForeignKey("mailing_schedules.id", ondelete="SET NULL"), nullable=True)
+    scheduled_for = Column(DateTime, nullable=True)  # next_run расписания, для которого создан запуск
+    status = Column(String, default="running", nullable=False)  # prepared (снимок аудитории заранее), running, paused, cancelled, done
+    started_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    audience_loaded_at = Column(DateTime, nullable=True)  # аудитория полностью записана в outbox
+    audience_key = Column(String(40), nullable=True)  # отпечаток статусов/ключевых слов, по которым собрана аудитория
+
+    # Аренда запуска: какой процесс его отправляет и до какого времени
+    owner = Column(String, nullable=True)
+    lease_until = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint('schedule_id', 'scheduled_for', name='uq_mailing_run_schedule'),
+    )
+
+    def __repr__(self):
+        return (f"<MailingRun(id={self.id}, mailing={self.mailing_id}, schedule={self.schedule_id}, "
+                f"status={self.status})>")
+
+
+class MailingDelivery(Base):
+    """
+    Outbox рассылки: одна строка на получателя в рамках запуска.
+    """
+    __tablename__ = "mailing_deliveries"
+
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey("mailing_runs.id", ondelete="CASCADE"), nullable=False)
+    tg_id = Column(String, nullable=False)
+    status = Column(String, default="pending", nullable=False)  # pending, sending (забрана отправителем), sent, failed
+    error = Column(Text, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
+    not_before = Column(DateTime, nullable=True)  # слот получателя в окне растянутой рассылки
+
+    __table_args__ = (
+        UniqueConstraint('run_id', 'tg_id', name='uq_mailing_delivery'),
+        Index('ix_mailing_deliveries_run_status', 'run_id', 'status'),
+    )
+
+
+class DeliveryLog(Base):
+    """
+    Журнал доставки: результат отправки рассылки одному получателю.
+    Пишется пачками через COPY, поэтому без внешних ключей.
+    """
+    __tablename__ = "delivery_log"
+
+    id = Column(BigInteger, primary_key=True)
+    mailing_id = Column(Integer, nullable=True)
+    schedule_id = Column(Integer, nullable=True)
+    run_id = Column(Integer, nullable=True)
+    tg_id = Column(String, nullable=False)
+    status = Column(SmallInteger, nullable=False)  # 0 – доставлено, 1 – временная ошибка, 2 – получатель недоступен, 3 – прочая постоянная ошибка
+    error_class = Column(String(64), nullable=True)  # класс исключения, например TelegramForbiddenError
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_delivery_log_mailing_run', 'mailing_id', 'run_id'),
+    )
@@ -1,7 +1,7 @@
 import asyncio
 import json
 import logging
-from datetime import datetime, timedelta, time
+from datetime import datetime, time
 from calendar import monthrange
 
 from aiogram import Router, types, F
@@ -10,15 +10,34 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaVideo, InputMediaDocument, \
     InputMediaPhoto, MessageEntity
-from sqlalchemy import select, func
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.config import config
 from app.db.db import AsyncSessionLocal
-from app.db.models import User, Mailing, MailingStatus, MailingSchedule, Material, MaterialView
+from app.db.models import User, Mailing, MailingStatus, MailingSchedule, Material
+from app.utils.delivery import DeliveryEngine, DeliveryStats, prepare_payload, get_mailing_payload
+from app.utils.outbox import start_run, complete_run, audience_key, get_run_status
+from app.utils.audience import (
+    stream_audience, get_mailing_statuses, get_status_counts, get_keyword_counts, estimate_audience
+)
+from app.utils.progress import BroadcastProgress, track_progress, format_duration, estimate_send_duration
+from app.utils.delivery_log import DeliveryLogWriter
+from app.utils.recurrence import compile_recurrence
 from app.utils.helpers import get_day_of_week_names, bot
+from app.tasks import notify_scheduler
+from app.handlers.runs import run_control_keyboard
 
 broadcast_router = Router()
 
+# Растяжка должна закончиться до следующего запуска: самый частый период расписания – сутки
+MAX_SPREAD_MINUTES = 24 * 60 - 1
+
+TIME_PROMPT = (
+    "Введите время в формате HH:MM (например 09:00).\n"
+    f"Чтобы растянуть отправку на N минут, укажите HH:MM/N (например 09:00/30, N не больше {MAX_SPREAD_MINUTES})."
+)
+
 # -----------------------------
 # Шаги FSM
 # -----------------------------
@@ -133,7 +152,7 @@ async def process_new_mailing(callback: types.CallbackQuery, state: FSMContext):
 
 
 @broadcast_router.callback_query(BroadcastStates.CHOOSING_TARGET_TYPE)
-async def choose_target_type(callback: types.CallbackQuery, state: FSMContext):
+async def choose_target_type(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
     """
     Обработка выбора типа рассылки.
     При выборе по статусам – загружаем все уникальные статусы.
@@ -141,13 +160,14 @@ async def choose_target_type(callback: types.CallbackQuery, state: FSMContext):
     """
     if callback.data == "target_statuses":
         # Получаем статусы из БД
-        async with AsyncSessionLocal() as session:
-            result = await session.scalars(select(User.status).distinct().order_by(User.status))
-            all_statuses = sorted({s.lower() for s in result.all() if s})
+        result = await session.scalars(select(User.status).distinct().order_by(User.status))
+        all_statuses = sorted({s.lower() for s in result.all() if s})
+        status_counts = await get_status_counts(session)
         all_statuses.append("админы")
         await state.update_data(
             all_statuses=all_statuses,
             selected_statuses={status: False for status in all_statuses},
+            status_counts=status_counts,
             target_type="statuses"
         )
         await edit_statuses_message(callback, state)
@@ -155,16 +175,17 @@ async def choose_target_type(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer()
     elif callback.data == "target_keywords":
         # Получаем ключевые слова из таблицы Material и сортируем по алфавиту
-        async with AsyncSessionLocal() as session:
-            result = await session.scalars(select(Material.keyword))
-            all_keywords = sorted({kw for kw in result.all() if kw})
+        result = await session.scalars(select(Material.keyword))
+        all_keywords = sorted({kw for kw in result.all() if kw})
+        keyword_counts = await get_keyword_counts(session)
         await state.update_data(
             all_keywords=all_keywords,
             selected_keywords={kw: False for kw in all_keywords},
+            keyword_counts=keyword_counts,
             target_type="keywords",
             keywords_page=0  # Начинаем с первой страницы
         )
-        kb = build_keywords_keyboard(all_keywords, {kw: False for kw in all_keywords}, page=0)
+        kb = build_keywords_keyboard(all_keywords, {kw: False for kw in all_keywords}, page=0, counts=keyword_counts)
         await callback.message.edit_text("Выберите ключевые слова для рассылки.\nНажмите 'Далее', когда выбор завершён.", reply_markup=kb)
         await state.set_state(BroadcastStates.CHOOSING_KEYWORDS)
         await callback.answer()
@@ -172,22 +193,22 @@ async def choose_target_type(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer("Неизвестная команда")
 
 
-def build_statuses_keyboard(all_statuses, selected_dict):
+def build_statuses_keyboard(all_statuses, selected_dict, counts=None):
     """
-    Строит клавиатуру для выбора статусов пользователей.
+    Строит клавиатуру для выбора статусов пользователей (с числом получателей у каждого статуса).
     """
     buttons = []
     for st in all_statuses:
         checked = "✅" if selected_dict.get(st, False) else ""
-        btn_text = f"{checked}{st}"
+        btn_text = f"{checked}{st}" + (f" ({counts.get(st, 0)})" if counts is not None else "")
         buttons.append([InlineKeyboardButton(text=btn_text, callback_data=f"toggle_status_{st}")])
     buttons.append([InlineKeyboardButton(text="Далее", callback_data="statuses_done")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-def build_keywords_keyboard(all_keywords, selected_dict, page=0, items_per_page=90):
+def build_keywords_keyboard(all_keywords, selected_dict, page=0, items_per_page=90, counts=None):
     """
-    Строит клавиатуру для выбора ключевых слов с пагинацией.
+    Строит клавиатуру для выбора ключевых слов с пагинацией (с числом получателей у каждого слова).
     """
     buttons = []
     
@@ -199,7 +220,7 @@ def build_keywords_keyboard(all_keywords, selected_dict, page=0, items_per_page=
     # Добавляем кнопки для ключевых слов на текущей странице
     for kw in page_keywords:
         checked = "✅" if selected_dict.get(kw, False) else ""
-        btn_text = f"{checked}{kw}"
+        btn_text = f"{checked}{kw}" + (f" ({counts.get(kw, 0)})" if counts is not None else "")
         buttons.append([InlineKeyboardButton(text=btn_text, callback_data=f"toggle_keyword_{kw}")])
     
     # Добавляем навигационные кнопки
@@ -234,12 +255,21 @@ async def edit_statuses_message(callback: types.CallbackQuery, state: FSMContext
         "Выберите статусы пользователей для рассылки.\n"
         "Нажимайте для (де)активации. Затем нажмите 'Далее'."
     )
-    kb = build_statuses_keyboard(all_statuses, selected)
+    kb = build_statuses_keyboard(all_statuses, selected, data.get("status_counts"))
     await callback.message.edit_text(text, reply_markup=kb)
 
 
+async def audience_estimate_text(session: AsyncSession, user_statuses: list[str], cost: int = 1) -> str:
+    """
+    Размер выбранной аудитории и ожидаемая длительность отправки при текущем лимите скорости.
+    """
+    recipients = await estimate_audience(session, user_statuses)
+    duration = format_duration(estimate_send_duration(recipients, cost))
+    return f"Получателей: {recipients}\nОриентировочное время отправки: {duration}"
+
+
 @broadcast_router.callback_query(BroadcastStates.CHOOSING_KEYWORDS)
-async def handle_keywords_callback(callback: types.CallbackQuery, state: FSMContext):
+async def handle_keywords_callback(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
     """
     Обрабатывает выбор ключевых слов с поддержкой пагинации.
     """
@@ -253,7 +283,8 @@ async def handle_keywords_callback(callback: types.CallbackQuery, state: FSMCont
         
         # Обновляем клавиатуру с текущей страницей
         current_page = data.get("keywords_page", 0)
-        kb = build_keywords_keyboard(data.get("all_keywords", []), selected, page=current_page)
+        kb = build_keywords_keyboard(data.get("all_keywords", []), selected, page=current_page,
+                                     counts=data.get("keyword_counts"))
         await callback.message.edit_text("Выберите ключевые слова для рассылки.\nНажмите 'Далее', когда выбор завершён.", reply_markup=kb)
         await callback.answer()
         
@@ -263,7 +294,8 @@ async def handle_keywords_callback(callback: types.CallbackQuery, state: FSMCont
         await state.update_data(keywords_page=page)
         
         selected = data.get("selected_keywords", {})
-        kb = build_keywords_keyboard(data.get("all_keywords", []), selected, page=page)
+        kb = build_keywords_keyboard(data.get("all_keywords", []), selected, page=page,
+                                     counts=data.get("keyword_counts"))
         await callback.message.edit_text("Выберите ключевые слова для рассылки.\nНажмите 'Далее', когда выбор завершён.", reply_markup=kb)
         await callback.answer()
         
@@ -274,7 +306,8 @@ async def handle_keywords_callback(callback: types.CallbackQuery, state: FSMCont
             await callback.answer("Выберите хотя бы одно ключевое слово!", show_alert=True)
             return
         await state.update_data(keywords=chosen)
-        await callback.message.edit_text(f"Выбраны ключевые слова: {', '.join(chosen)}.\nВведите название рассылки:")
+        estimate = await audience_estimate_text(session, [f"keyword:{kw}" for kw in chosen])
+        await callback.message.edit_text(f"Выбраны ключевые слова: {', '.join(chosen)}.\n{estimate}\n\nВведите название рассылки:")
         await state.set_state(BroadcastStates.ENTERING_TITLE)
         await callback.answer()
     else:
@@ -285,15 +318,14 @@ async def handle_keywords_callback(callback: types.CallbackQuery, state: FSMCont
 #  «Существующая рассылка»
 # -----------------------------
 @broadcast_router.callback_query(BroadcastStates.CHOOSING_NEW_OR_EXISTING, F.data == "existing_mailing")
-async def process_existing_mailing(callback: types.CallbackQuery, state: FSMContext):
+async def process_existing_mailing(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
     """
     Показывает список активных рассылок.
     """
     await callback.answer()
-    async with AsyncSessionLocal() as session:
-        mailings = (await session.scalars(
-            select(Mailing).where(Mailing.active == 1)
-        )).all()
+    mailings = (await session.scalars(
+        select(Mailing).where(Mailing.active == 1)
+    )).all()
     if not mailings:
         await callback.message.edit_text("Активных рассылок нет.")
         await state.clear()
@@ -310,7 +342,7 @@ async def process_existing_mailing(callback: types.CallbackQuery, state: FSMCont
 #  Обработка выбора статусов (для рассылки по статусам)
 # -----------------------------
 @broadcast_router.callback_query(BroadcastStates.CHOOSING_STATUSES)
-async def handle_statuses_callback(callback: types.CallbackQuery, state: FSMContext):
+async def handle_statuses_callback(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
     if callback.data.startswith("toggle_status_"):
         st = callback.data.replace("toggle_status_", "")
@@ -326,7 +358,8 @@ async def handle_statuses_callback(callback: types.CallbackQuery, state: FSMCont
             await callback.answer("Выберите хотя бы один статус!", show_alert=True)
             return
         await state.update_data(statuses=chosen)
-        await callback.message.edit_text("Введите название рассылки:")
+        estimate = await audience_estimate_text(session, chosen)
+        await callback.message.edit_text(f"{estimate}\n\nВведите название рассылки:")
         await state.set_state(BroadcastStates.ENTERING_TITLE)
         await callback.answer()
     else:
@@ -411,11 +444,11 @@ async def receive_broadcast_message(message: types.Message, state: FSMContext):
 #  Выбор типа расписания (новая рассылка)
 # -----------------------------
 @broadcast_router.callback_query(BroadcastStates.CHOOSING_SCHEDULE_TYPE)
-async def choose_schedule_type_new(callback: types.CallbackQuery, state: FSMContext):
+async def choose_schedule_type_new(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
     data = callback.data
     await callback.answer()
     if data == "schedule_daily":
-        await callback.message.edit_text("Введите время в формате HH:MM (например 09:00):")
+        await callback.message.edit_text(TIME_PROMPT)
         await state.set_state(BroadcastStates.ENTERING_DAILY_TIME)
     elif data == "schedule_weekly":
         await state.update_data(selected_weekdays=[])
@@ -428,8 +461,12 @@ async def choose_schedule_type_new(callback: types.CallbackQuery, state: FSMCont
         await callback.message.edit_text(text, reply_markup=build_monthdays_keyboard([]))
         await state.set_state(BroadcastStates.ENTERING_MONTHLY_DAYS)
     elif data == "schedule_once":
+        state_data = await state.get_data()
+        payload = prepare_payload(state_data.get("file_ids"), state_data.get("caption"), state_data.get("caption_entities"))
+        estimate = await audience_estimate_text(session, selected_user_statuses(state_data), payload.cost)
         text = (
             "Единоразовая рассылка.\n\n"
+            f"{estimate}\n\n"
             "Введите дату и время в формате <b>YYYY-MM-DD HH:MM</b>, чтобы запланировать отправку.\n\n"
             "Или нажмите кнопку «Отправить сейчас» чтобы отправить сразу.\n"
             "Нажмите «Отмена», чтобы выйти."
@@ -467,7 +504,7 @@ async def once_time_choice_callback(callback: types.CallbackQuery, state: FSMCon
 
 
 @broadcast_router.message(BroadcastStates.ENTERING_ONCE_TIME)
-async def once_time_entered(message: types.Message, state: FSMContext):
+async def once_time_entered(message: types.Message, state: FSMContext, session: AsyncSession):
     text = message.text.strip()
     try:
         dt = datetime.strptime(text, "%Y-%m-%d %H:%M")
@@ -478,11 +515,11 @@ async def once_time_entered(message: types.Message, state: FSMContext):
         data = await state.get_data()
         is_edit = data.get("is_edit", False)
         if not is_edit:
-            await create_mailing_in_db(state, schedule_type="once", next_run=dt)
+            await create_mailing_in_db(session, state, schedule_type="once", next_run=dt)
             await message.answer(f"Единоразовая рассылка запланирована на {dt} (UTC).")
         else:
             mailing_id = data["existing_mailing_id"]
-            await add_schedule_for_existing_mailing(mailing_id, schedule_type="once", next_run=dt)
+            await add_schedule_for_existing_mailing(session, mailing_id, schedule_type="once", next_run=dt)
             await message.answer(f"Для существующей рассылки назначен единоразовый запуск на {dt} (UTC).")
         await state.clear()
     except ValueError:
@@ -495,108 +532,65 @@ async def once_time_entered(message: types.Message, state: FSMContext):
 # -----------------------------
 #  Отправка единоразовой рассылки (без записи в БД)
 # -----------------------------
+def parse_time_and_spread(text: str) -> tuple[str, int]:
+    """
+    "09:00" -> ("09:00", 0); "09:00/30" -> ("09:00", 30) – отправка растягивается на 30 минут.
+    """
+    time_part, _, spread_part = text.strip().partition("/")
+    hh, mm = time_part.strip().split(":")
+    dt_time = time(hour=int(hh), minute=int(mm))
+    spread_minutes = int(spread_part) if spread_part.strip() else 0
+    if not 0 <= spread_minutes <= MAX_SPREAD_MINUTES:
+        raise ValueError(f"spread_minutes must be in 0..{MAX_SPREAD_MINUTES}")
+    return dt_time.strftime("%H:%M"), spread_minutes
+
+
+def selected_user_statuses(data: dict) -> list[str]:
+    """
+    Переводит выбор администратора из FSM в список user_status (как в MailingStatus).
+    """
+    if data.get("target_type") == "keywords":
+        return [f"keyword:{kw}" for kw in data.get("keywords") or []]
+    statuses = data.get("selected_statuses", {})
+    return [st for st, val in statuses.items() if val]
+
+
+def delivery_errors_text(stats: DeliveryStats) -> str:
+    """
+    Разбивка ошибок для итогового сообщения: недоступные получатели отдельно от прочих отказов.
+    """
+    rejected = stats.permanent_errors - stats.unreachable
+    return (f"Из них недоступных получателей: {stats.unreachable}, "
+            f"отклонено Telegram: {rejected}, временных сбоев: {stats.errors - stats.permanent_errors}")
+
+
 async def send_once_broadcast(state: FSMContext, callback_or_message: types.Message | types.CallbackQuery):
     data = await state.get_data()
-    if data.get("target_type") == "keywords":
-        keyword_list = data.get("keywords", [])
-        async with AsyncSessionLocal() as session:
-            all_user_ids = set()
-            for kw in keyword_list:
-                material = await session.scalar(select(Material).where(Material.keyword == kw))
-                if not material:
-                    logging.error(f"Неверное ключевое слово '{kw}', пропускаем его.")
-                    continue
-                mviews = await session.scalars(select(MaterialView).where(MaterialView.material_id == material.id))
-                for mv in mviews:
-                    all_user_ids.add(mv.user_id)
-            if all_user_ids:
-                users = await session.scalars(select(User).where(User.id.in_(list(all_user_ids))))
-                users_list = users.all()
-            else:
-                users_list = []
-    else:  # target_type == "statuses"
-        selected_statuses = data["selected_statuses"]
-        chosen_statuses = [st for st, val in selected_statuses.items() if val]
-        users_list = []
-        async with AsyncSessionLocal() as session:
-            if "админы" in chosen_statuses:
-                admin_users = await session.scalars(
-                    select(User).where(User.tg_id.in_(map(str, config.ADMIN_IDS)))
-                )
-                users_list.extend(admin_users.all())
-            non_admin_statuses = [st.lower() for st in chosen_statuses if st.lower() != "админы"]
-            if non_admin_statuses:
-                users_by_status = await session.scalars(
-                    select(User).where(func.lower(User.status).in_(non_admin_statuses))
-                )
-                users_list.extend(users_by_status.all())
-    bot = callback_or_message.bot if isinstance(callback_or_message, types.CallbackQuery) else callback_or_message.bot
-    success_count = 0
-    error_count = 0
-
-    # Извлекаем данные для отправки
-    saved_chat_id = data.get("saved_chat_id")
-    saved_message_id = data.get("saved_message_id")
-    file_ids = data.get("file_ids")
-    caption = data.get("caption")
-    caption_entities_raw = data.get("caption_entities")
-    entities = None
-    if caption_entities_raw:
-        try:
-            entities = [MessageEntity(**entity) for entity in json.loads(caption_entities_raw)]
-        except Exception as e:
-            logging.error(f"Ошибка парсинга caption_entities: {e}")
-            entities = None
+    bot = callback_or_message.bot
 
-    tg_ids = set([user.tg_id for user in users_list if user.tg_id])
-    for tg_id in tg_ids:
-        try:
-            # if file_ids:
-            attachments = json.loads(file_ids)
-            if attachments:
-                input_media = []
-                for idx, att in enumerate(attachments):
-                    if att["type"] == "photo":
-                        media_obj = InputMediaPhoto(
-                            media=att["file_id"],
-                            caption=caption if (idx == 0 and caption) else None,
-                            caption_entities=entities if (idx == 0 and caption) else None,
-                            parse_mode=None,
-                        )
-                    elif att["type"] == "document":
-                        media_obj = InputMediaDocument(
-                            media=att["file_id"],
-                            caption=caption if (idx == 0 and caption) else None,
-                            caption_entities=entities if (idx == 0 and caption) else None,
-                            parse_mode=None,
-                        )
-                    elif att["type"] == "video":
-                        media_obj = InputMediaVideo(
-                            media=att["file_id"],
-                            caption=caption if (idx == 0 and caption) else None,
-                            caption_entities=entities if (idx == 0 and caption) else None,
-                            parse_mode=None,
-                        )
-                    input_media.append(media_obj)
-                await bot.send_media_group(chat_id=tg_id, media=input_media)
-            else:
-                await bot.send_message(
-                    chat_id=tg_id,
-                    text=caption,
-                    entities=entities,
-                    parse_mode=None
-                )
-            success_count += 1
-        except Exception as e:
-            logging.warning(f"Не удалось отправить сообщение пользователю {tg_id}: {e}")
-            error_count += 1
+    # Содержимое рассылки разбирается один раз для всех получателей
+    payload = prepare_payload(data.get("file_ids"), data.get("caption"), data.get("caption_entities"),
+                              data.get("saved_chat_id"), data.get("saved_message_id"))
 
-    logging.info(f"Единоразовая рассылка завершена: успешно={success_count}, ошибок={error_count}.")
-    final_text = f"Единоразовая рассылка завершена.\nУспешно: {success_count}, Ошибок: {error_count}"
     if isinstance(callback_or_message, types.CallbackQuery):
-        await callback_or_message.message.edit_text(final_text)
+        status_message = await callback_or_message.message.answer("Ожидайте, идет рассылка...")
     else:
-        await callback_or_message.answer(final_text)
+        status_message = await callback_or_message.answer("Ожидайте, идет рассылка...")
+
+    # Разовая рассылка не хранится в БД, поэтому outbox-запуска у неё нет: аудитория
+    # загружается списком одним запросом, и сессия закрывается до начала отправки
+    async with AsyncSessionLocal() as session:
+        audience = [tg_id async for tg_id in stream_audience(session, selected_user_statuses(data))]
+    progress = BroadcastProgress(total=len(audience))
+    async with track_progress(progress, status_message.edit_text), DeliveryLogWriter() as log:
+        stats = await DeliveryEngine(bot).run(audience, payload.send, progress, log)
+    success_count, error_count = stats.success, stats.errors
+
+    logging.info(f"Единоразовая рассылка завершена: успешно={success_count}, ошибок={error_count}, "
+                 f"постоянных={stats.permanent_errors} (недоступных={stats.unreachable}), повторов={stats.retries}.")
+    final_text = (f"Единоразовая рассылка завершена.\nУспешно: {success_count}, Ошибок: {error_count}\n"
+                  f"{delivery_errors_text(stats)}")
+    await status_message.edit_text(final_text)
 
 
 
@@ -604,12 +598,14 @@ async def send_once_broadcast(state: FSMContext, callback_or_message: types.Mess
 #  Создание новой рассылки и её расписания
 # -----------------------------
 async def create_mailing_in_db(
+    session: AsyncSession,
     state: FSMContext,
     schedule_type: str,
     day_of_week: str = None,
     day_of_month: str = None,
     time_of_day: str = None,
-    next_run: datetime = None
+    next_run: datetime = None,
+    spread_minutes: int = 0
 ):
     data = await state.get_data()
     title = data["mailing_title"]
@@ -620,43 +616,36 @@ async def create_mailing_in_db(
     caption = data.get("caption")
     caption_entities = data.get("caption_entities")
 
-    async with AsyncSessionLocal() as session:
-        new_mailing = Mailing(
-            title=title,
-            saved_chat_id=saved_chat_id,
-            saved_message_id=saved_message_id,
-            file_ids=file_ids,
-            caption=caption,
-            caption_entities=caption_entities,
-            active=1,
-            created_at=datetime.utcnow()
-        )
-        session.add(new_mailing)
-        await session.flush()  # получим ID рассылки
-
-        if data.get("target_type") == "keywords":
-            keywords = data.get("keywords") or []
-            for kw in keywords:
-                ms = MailingStatus(mailing_id=new_mailing.id, user_status=f"keyword:{kw}")
-                session.add(ms)
-        else:
-            statuses = data.get("selected_statuses", {})
-            chosen_statuses = [st for st, val in statuses.items() if val]
-            for st in chosen_statuses:
-                ms = MailingStatus(mailing_id=new_mailing.id, user_status=st)
-                session.add(ms)
-
-        sch = MailingSchedule(
-            mailing_id=new_mailing.id,
-            schedule_type=schedule_type,
-            day_of_week=day_of_week,
-            day_of_month=day_of_month,
-            time_of_day=time_of_day,
-            next_run=next_run or datetime.utcnow(),
-            active=1
-        )
-        session.add(sch)
-        await session.commit()
+    new_mailing = Mailing(
+        title=title,
+        saved_chat_id=saved_chat_id,
+        saved_message_id=saved_message_id,
+        file_ids=file_ids,
+        caption=caption,
+        caption_entities=caption_entities,
+        active=1,
+        created_at=datetime.utcnow()
+    )
+    session.add(new_mailing)
+    await session.flush()  # получим ID рассылки
+
+    for user_status in selected_user_statuses(data):
+        ms = MailingStatus(mailing_id=new_mailing.id, user_status=user_status)
+        session.add(ms)
+
+    sch = MailingSchedule(
+        mailing_id=new_mailing.id,
+        schedule_type=schedule_type,
+        day_of_week=day_of_week,
+        day_of_month=day_of_month,
+        time_of_day=time_of_day,
+        next_run=next_run or datetime.utcnow(),
+        spread_minutes=spread_minutes,
+        active=1
+    )
+    session.add(sch)
+    await session.commit()
+    notify_scheduler()
 
 
 
@@ -664,26 +653,25 @@ async def create_mailing_in_db(
 #  Обработчик «существующая рассылка» (после выбора)
 # -----------------------------
 @broadcast_router.callback_query(BroadcastStates.CHOOSING_EXISTING_MAILING)
-async def existing_mailing_selected(callback: types.CallbackQuery, state: FSMContext):
+async def existing_mailing_selected(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
     if not callback.data.startswith("mailing_"):
         await callback.answer("Неизвестная команда")
         return
     mailing_id = int(callback.data.split("_", 1)[1])
-    async with AsyncSessionLocal() as session:
-        mailing = await session.get(Mailing, mailing_id)
-        if not mailing or mailing.active == 0:
-            await callback.message.edit_text("Рассылка не найдена или деактивирована.")
-            await state.clear()
-            return
-        await state.update_data(mailing_title=mailing.title, existing_mailing_id=mailing_id)
-        schedules = (await session.scalars(
-            select(MailingSchedule)
-            .where(MailingSchedule.mailing_id == mailing_id, MailingSchedule.active == 1)
-        )).all()
-        mailing_statuses = (await session.scalars(
-            select(MailingStatus.user_status)
-            .where(MailingStatus.mailing_id == mailing_id)
-        )).all()
+    mailing = await session.get(Mailing, mailing_id)
+    if not mailing or mailing.active == 0:
+        await callback.message.edit_text("Рассылка не найдена или деактивирована.")
+        await state.clear()
+        return
+    await state.update_data(mailing_title=mailing.title, existing_mailing_id=mailing_id)
+    schedules = (await session.scalars(
+        select(MailingSchedule)
+        .where(MailingSchedule.mailing_id == mailing_id, MailingSchedule.active == 1)
+    )).all()
+    mailing_statuses = (await session.scalars(
+        select(MailingStatus.user_status)
+        .where(MailingStatus.mailing_id == mailing_id)
+    )).all()
 
     info_lines = [f"Название рассылки: <b>{mailing.title}</b>\n"]
     if schedules:
@@ -710,6 +698,8 @@ async def existing_mailing_selected(callback: types.CallbackQuery, state: FSMCon
                 info_lines.append(f"- Время (UTC): <b>{sch.time_of_day}</b>")
             elif sch.schedule_type == "once":
                 info_lines.append("- Тип: <b>единоразово</b>")
+            if sch.spread_minutes:
+                info_lines.append(f"- Отправка растянута на: <b>{sch.spread_minutes} мин</b>")
             info_lines.append(f"- Следующий запуск (UTC): <b>{sch.next_run}</b>\n")
     else:
         info_lines.append("Нет активных расписаний.\n")
@@ -795,7 +785,7 @@ async def existing_mailing_selected(callback: types.CallbackQuery, state: FSMCon
 #  Меню управления существующей рассылкой
 # -----------------------------
 @broadcast_router.callback_query(BroadcastStates.EXISTING_MAILING_MANAGE)
-async def manage_existing_mailing(callback: types.CallbackQuery, state: FSMContext):
+async def manage_existing_mailing(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
     mailing_id = data.get("existing_mailing_id")
     if callback.data == "edit_mailing_message":
@@ -803,13 +793,13 @@ async def manage_existing_mailing(callback: types.CallbackQuery, state: FSMConte
         await state.set_state(BroadcastStates.EDITING_EXISTING_MESSAGE)
         await callback.answer()
     elif callback.data == "edit_mailing_schedule":
-        async with AsyncSessionLocal() as session:
-            schedules = (await session.scalars(
-                select(MailingSchedule).where(MailingSchedule.mailing_id == mailing_id)
-            )).all()
-            for s in schedules:
-                s.active = 0
-            await session.commit()
+        schedules = (await session.scalars(
+            select(MailingSchedule).where(MailingSchedule.mailing_id == mailing_id)
+        )).all()
+        for s in schedules:
+            s.active = 0
+        await session.commit()
+        notify_scheduler()
         kb = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="Ежедневно", callback_data="schedule_daily_exists")],
             [InlineKeyboardButton(text="Еженедельно", callback_data="schedule_weekly_exists")],
@@ -821,11 +811,11 @@ async def manage_existing_mailing(callback: types.CallbackQuery, state: FSMConte
         await state.set_state(BroadcastStates.EDITING_EXISTING_SCHEDULE_TYPE)
         await callback.answer()
     elif callback.data == "delete_mailing":
-        async with AsyncSessionLocal() as session:
-            mailing = await session.get(Mailing, mailing_id)
-            if mailing:
-                mailing.active = 0
-                await session.commit()
+        mailing = await session.get(Mailing, mailing_id)
+        if mailing:
+            mailing.active = 0
+            await session.commit()
+        notify_scheduler()
         await callback.message.edit_text("Рассылка удалена (деактивирована).")
         await state.clear()
         await callback.answer()
@@ -892,7 +882,7 @@ async def process_media_group_broadcast_edit(media_group_id: str, state: FSMCont
 #  Редактирование сообщения существующей рассылки
 # -----------------------------
 @broadcast_router.message(BroadcastStates.EDITING_EXISTING_MESSAGE)
-async def editing_existing_message(message: types.Message, state: FSMContext):
+async def editing_existing_message(message: types.Message, state: FSMContext, session: AsyncSession):
     """
     Обрабатывает новое сообщение для редактирования рассылки.
     Если сообщение принадлежит media‑группе, накапливает его и вызывает обработку группы.
@@ -923,19 +913,18 @@ async def editing_existing_message(message: types.Message, state: FSMContext):
             file_list.append({"type": "document", "file_id": message.document.file_id})
         elif message.video:
             file_list.append({"type": "video", "file_id": message.video.file_id})
-        async with AsyncSessionLocal() as session:
-            data = await state.get_data()
-            mailing_id = data.get("existing_mailing_id")
-            new_chat_id = str(message.chat.id)
-            new_msg_id = str(message.message_id)
-            mailing = await session.get(Mailing, mailing_id)
-            if mailing and mailing.active == 1:
-                mailing.saved_chat_id = new_chat_id
-                mailing.saved_message_id = new_msg_id
-                mailing.file_ids = json.dumps(file_list)
-                mailing.caption = caption
-                mailing.caption_entities = json.dumps(caption_entities) if caption_entities else None
-                await session.commit()
+        data = await state.get_data()
+        mailing_id = data.get("existing_mailing_id")
+        new_chat_id = str(message.chat.id)
+        new_msg_id = str(message.message_id)
+        mailing = await session.get(Mailing, mailing_id)
+        if mailing and mailing.active == 1:
+            mailing.saved_chat_id = new_chat_id
+            mailing.saved_message_id = new_msg_id
+            mailing.file_ids = json.dumps(file_list)
+            mailing.caption = caption
+            mailing.caption_entities = json.dumps(caption_entities) if caption_entities else None
+            await session.commit()
         await message.answer("Сообщение для рассылки обновлено.")
         await state.clear()
 
@@ -949,7 +938,7 @@ async def editing_existing_schedule_type(callback: types.CallbackQuery, state: F
     data = callback.data
     await callback.answer()
     if data == "schedule_daily_exists":
-        await callback.message.edit_text("Введите время в формате HH:MM (например 09:00):")
+        await callback.message.edit_text(TIME_PROMPT)
         await state.set_state(BroadcastStates.ENTERING_DAILY_TIME)
     elif data == "schedule_weekly_exists":
         await state.update_data(selected_weekdays=[])
@@ -985,107 +974,35 @@ async def editing_existing_schedule_type(callback: types.CallbackQuery, state: F
 async def send_once_broadcast_existing(state: FSMContext, callback: types.CallbackQuery):
     data = await state.get_data()
     mailing_id = data.get("existing_mailing_id")
-    await callback.message.answer("Ожидайте, идет рассылка...")
+    status_message = await callback.message.answer("Ожидайте, идет рассылка...")
     async with AsyncSessionLocal() as session:
         mailing = await session.get(Mailing, mailing_id)
         if not mailing:
             return
-        mail_stats = await session.scalars(select(MailingStatus).where(MailingStatus.mailing_id == mailing_id))
-        mail_stats_list = mail_stats.all()
-        # Если рассылка по ключевым словам, выбираем пользователей по просмотрам материала
-        if any(ms.user_status.lower().startswith("keyword:") for ms in mail_stats_list):
-            all_user_ids = set()
-            for ms in mail_stats_list:
-                if ms.user_status.lower().startswith("keyword:"):
-                    kw = ms.user_status.split(":", 1)[1]
-                    material = await session.scalar(select(Material).where(Material.keyword == kw))
-                    if not material:
-                        await callback.message.edit_text("Неверное ключевое слово, попробуйте ещё раз.")
-                        return
-                    mviews = await session.scalars(select(MaterialView).where(MaterialView.material_id == material.id))
-                    for mv in mviews:
-                        all_user_ids.add(mv.user_id)
-            if all_user_ids:
-                users = await session.scalars(select(User).where(User.id.in_(list(all_user_ids))))
-                users_list = users.all()
-            else:
-                users_list = []
-        else:
-            all_statuses = [ms.user_status.lower() for ms in mail_stats_list]
-            non_admin_statuses = [st for st in all_statuses if st != "админы"]
-            users_list = []
-            users_by_status = await session.scalars(
-                select(User).where(func.lower(User.status).in_(non_admin_statuses))
-            )
-            users_list.extend(users_by_status.all())
-            if "админы" in all_statuses:
-                admin_users = await session.scalars(
-                    select(User).where(User.tg_id.in_(map(str, config.ADMIN_IDS)))
-                )
-                users_list.extend(admin_users.all())
-    bot = callback.bot
-    success_count = 0
-    error_count = 0
-
-    # Готовим данные рассылки
-    mailing_file_ids = mailing.file_ids
-    mailing_caption = mailing.caption
-    mailing_caption_entities = mailing.caption_entities
-    mailing_saved_chat_id = mailing.saved_chat_id
-    mailing_saved_message_id = mailing.saved_message_id
-
-    # Если указаны caption_entities, пытаемся их распарсить
-    entities = None
-    if mailing_caption_entities:
-        try:
-            entities = [MessageEntity(**entity) for entity in json.loads(mailing_caption_entities)]
-        except Exception as e:
-            logging.error(f"Ошибка парсинга caption_entities: {e}")
-            entities = None
-    tg_ids = set([user.tg_id for user in users_list if user.tg_id])
-    for tg_id in tg_ids:
-        try:
-            attachments = json.loads(mailing_file_ids)
-            if len(attachments) > 0:
-                media_group = []
-                for idx, att in enumerate(attachments):
-                    if att["type"] == "photo":
-                        media_obj = InputMediaPhoto(
-                            media=att["file_id"],
-                            caption=mailing_caption if (idx == 0 and mailing_caption) else None,
-                            caption_entities=entities if (idx == 0 and mailing_caption) else None,
-                            parse_mode=None,
-                        )
-                    elif att["type"] == "document":
-                        media_obj = InputMediaDocument(
-                            media=att["file_id"],
-                            caption=mailing_caption if (idx == 0 and mailing_caption) else None,
-                            caption_entities=entities if (idx == 0 and mailing_caption) else None,
-                            parse_mode=None,
-                        )
-                    elif att["type"] == "video":
-                        media_obj = InputMediaVideo(
-                            media=att["file_id"],
-                            caption=mailing_caption if (idx == 0 and mailing_caption) else None,
-                            caption_entities=entities if (idx == 0 and mailing_caption) else None,
-                            parse_mode=None,
-                        )
-                    media_group.append(media_obj)
-                await bot.send_media_group(chat_id=tg_id, media=media_group)
-            else:
-                await callback.bot.send_message(
-                    chat_id=tg_id,
-                    text=mailing.caption,
-                    entities=entities,
-                    parse_mode=None
-                )
-            success_count += 1
-        except Exception as e:
-            logging.warning(f"Не удалось отправить сообщение пользователю {tg_id}: {e}")
-            error_count += 1
-    logging.info(f"Единоразовая рассылка для mailing_id={mailing_id} завершена: успешно={success_count}, ошибок={error_count}.")
-    text = f"Единоразовая рассылка завершена.\nУспешно: {success_count}, Ошибок: {error_count}"
-    await callback.message.edit_text(text)
+        mailing_statuses = await get_mailing_statuses(session, mailing_id)
+    # Готовим данные рассылки (один раз на запуск)
+    payload = get_mailing_payload(mailing)
+
+    async with AsyncSessionLocal() as session:
+        run = await start_run(mailing_id, stream_audience(session, mailing_statuses), scheduled_for=datetime.utcnow(),
+                              key=audience_key(mailing_statuses))
+    # Кнопки паузы/отмены остаются под сообщением с прогрессом
+    controls = run_control_keyboard(run.id, "running")
+    await status_message.edit_reply_markup(reply_markup=controls)
+
+    async def report(text: str):
+        await status_message.edit_text(text, reply_markup=controls)
+
+    stats = await complete_run(callback.bot, run.id, payload.send, report=report)
+    success_count, error_count = stats.success, stats.errors
+    status = await get_run_status(run.id)
+    result = {"paused": "приостановлена", "cancelled": "отменена"}.get(status, "завершена")
+    logging.info(f"Единоразовая рассылка для mailing_id={mailing_id} {result}: успешно={success_count}, "
+                 f"ошибок={error_count}, постоянных={stats.permanent_errors} (недоступных={stats.unreachable}), "
+                 f"повторов={stats.retries}.")
+    text = (f"Единоразовая рассылка {result}.\nУспешно: {success_count}, Ошибок: {error_count}\n"
+            f"{delivery_errors_text(stats)}")
+    await status_message.edit_text(text, reply_markup=run_control_keyboard(run.id, status))
 
 # -----------------------------
 # Универсальные функции: построение клавиатур
@@ -1138,7 +1055,7 @@ async def choosing_weekly_days(callback: types.CallbackQuery, state: FSMContext)
         if not selected:
             await callback.answer("Выберите хотя бы один день!", show_alert=True)
             return
-        await callback.message.edit_text("Введите время в формате HH:MM (например, 09:00):")
+        await callback.message.edit_text(TIME_PROMPT)
         await state.set_state(BroadcastStates.ENTERING_WEEKLY_TIME)
         await callback.answer()
     else:
@@ -1149,41 +1066,23 @@ async def choosing_weekly_days(callback: types.CallbackQuery, state: FSMContext)
 #  Ввод времени для еженедельной рассылки
 # -----------------------------
 @broadcast_router.message(BroadcastStates.ENTERING_WEEKLY_TIME)
-async def entering_weekly_time(message: types.Message, state: FSMContext):
-    time_str = message.text.strip()
+async def entering_weekly_time(message: types.Message, state: FSMContext, session: AsyncSession):
     try:
-        hh, mm = time_str.split(":")
-        dt_time = time(hour=int(hh), minute=int(mm))
-    except:
-        await message.answer("Неверный формат. Введите время HH:MM.")
+        time_str, spread_minutes = parse_time_and_spread(message.text)
+    except ValueError:
+        await message.answer(f"Неверный формат. Введите время HH:MM (или HH:MM/N, чтобы растянуть отправку на N минут, N не больше {MAX_SPREAD_MINUTES}).")
         return
     data = await state.get_data()
     selected_days = data.get("selected_weekdays", [])
     is_edit = data.get("is_edit", False)
     day_of_week_str = ",".join(str(d) for d in selected_days)
-    now = datetime.utcnow()
-    first_run = None
-    for d in selected_days:
-        offset = (d - 1) - now.weekday()
-        if offset < 0:
-            offset += 7
-        candidate = datetime(
-            year=now.year,
-            month=now.month,
-            day=now.day,
-            hour=dt_time.hour,
-            minute=dt_time.minute
-        ) + timedelta(days=offset)
-        if not first_run or candidate < first_run:
-            first_run = candidate
-    if first_run <= now:
-        first_run += timedelta(weeks=1)
+    first_run = compile_recurrence("weekly", day_of_week=day_of_week_str, time_of_day=time_str).next_after(datetime.utcnow())
     if not is_edit:
-        await create_mailing_in_db(state, schedule_type="weekly", day_of_week=day_of_week_str, time_of_day=time_str, next_run=first_run)
+        await create_mailing_in_db(session, state, schedule_type="weekly", day_of_week=day_of_week_str, time_of_day=time_str, next_run=first_run, spread_minutes=spread_minutes)
         await message.answer("Еженедельная рассылка создана!")
     else:
         mailing_id = data["existing_mailing_id"]
-        await add_schedule_for_existing_mailing(mailing_id, schedule_type="weekly", day_of_week=day_of_week_str, time_of_day=time_str, next_run=first_run)
+        await add_schedule_for_existing_mailing(session, mailing_id, schedule_type="weekly", day_of_week=day_of_week_str, time_of_day=time_str, next_run=first_run, spread_minutes=spread_minutes)
         await message.answer("Расписание обновлено (еженедельно).")
     await state.clear()
 
@@ -1209,7 +1108,7 @@ async def choosing_monthly_days(callback: types.CallbackQuery, state: FSMContext
         if not selected:
             await callback.answer("Выберите хотя бы одну дату!", show_alert=True)
             return
-        await callback.message.edit_text("Введите время в формате HH:MM (например 09:00):")
+        await callback.message.edit_text(TIME_PROMPT)
         await state.set_state(BroadcastStates.ENTERING_MONTHLY_TIME)
         await callback.answer()
     else:
@@ -1220,41 +1119,23 @@ async def choosing_monthly_days(callback: types.CallbackQuery, state: FSMContext
 #  Ввод времени для ежемесячной рассылки
 # -----------------------------
 @broadcast_router.message(BroadcastStates.ENTERING_MONTHLY_TIME)
-async def entering_monthly_time(message: types.Message, state: FSMContext):
-    time_str = message.text.strip()
+async def entering_monthly_time(message: types.Message, state: FSMContext, session: AsyncSession):
     try:
-        hh, mm = time_str.split(":")
-        dt_time = time(hour=int(hh), minute=int(mm))
-    except:
-        await message.answer("Неверный формат. Введите время в формате HH:MM (например 09:00).")
+        time_str, spread_minutes = parse_time_and_spread(message.text)
+    except ValueError:
+        await message.answer(f"Неверный формат. Введите время в формате HH:MM (например 09:00) или HH:MM/N (например 09:00/30, N не больше {MAX_SPREAD_MINUTES}).")
         return
     data = await state.get_data()
     selected_days = data.get("selected_monthdays", [])
     is_edit = data.get("is_edit", False)
     day_of_month_str = ",".join(str(d) for d in selected_days)
-    now = datetime.utcnow()
-    first_run = None
-    for d in selected_days:
-        candidate = datetime(now.year, now.month, d, dt_time.hour, dt_time.minute)
-        if candidate <= now:
-            month = now.month + 1
-            year = now.year
-            if month > 12:
-                month = 1
-                year += 1
-            from calendar import monthrange
-            max_d = monthrange(year, month)[1]
-            if d > max_d:
-                d = max_d
-            candidate = datetime(year, month, d, dt_time.hour, dt_time.minute)
-        if not first_run or candidate < first_run:
-            first_run = candidate
+    first_run = compile_recurrence("monthly", day_of_month=day_of_month_str, time_of_day=time_str).next_after(datetime.utcnow())
     if not is_edit:
-        await create_mailing_in_db(state, schedule_type="monthly", day_of_month=day_of_month_str, time_of_day=time_str, next_run=first_run)
+        await create_mailing_in_db(session, state, schedule_type="monthly", day_of_month=day_of_month_str, time_of_day=time_str, next_run=first_run, spread_minutes=spread_minutes)
         await message.answer("Ежемесячная рассылка создана!")
     else:
         mailing_id = data["existing_mailing_id"]
-        await add_schedule_for_existing_mailing(mailing_id, schedule_type="monthly", day_of_month=day_of_month_str, time_of_day=time_str, next_run=first_run)
+        await add_schedule_for_existing_mailing(session, mailing_id, schedule_type="monthly", day_of_month=day_of_month_str, time_of_day=time_str, next_run=first_run, spread_minutes=spread_minutes)
         await message.answer("Расписание обновлено (ежемесячно).")
     await state.clear()
 
@@ -1263,26 +1144,21 @@ async def entering_monthly_time(message: types.Message, state: FSMContext):
 #  Ввод времени для ежедневной рассылки
 # -----------------------------
 @broadcast_router.message(BroadcastStates.ENTERING_DAILY_TIME)
-async def entering_daily_time(message: types.Message, state: FSMContext):
-    time_str = message.text.strip()
+async def entering_daily_time(message: types.Message, state: FSMContext, session: AsyncSession):
     try:
-        hh, mm = time_str.split(":")
-        dt_time = time(hour=int(hh), minute=int(mm))
-    except:
-        await message.answer("Неверный формат. Введите время в формате HH:MM (например 09:00).")
+        time_str, spread_minutes = parse_time_and_spread(message.text)
+    except ValueError:
+        await message.answer(f"Неверный формат. Введите время в формате HH:MM (например 09:00) или HH:MM/N (например 09:00/30, N не больше {MAX_SPREAD_MINUTES}).")
         return
     data = await state.get_data()
     is_edit = data.get("is_edit", False)
-    now = datetime.utcnow()
-    first_run = datetime(year=now.year, month=now.month, day=now.day, hour=dt_time.hour, minute=dt_time.minute)
-    if first_run <= now:
-        first_run += timedelta(days=1)
+    first_run = compile_recurrence("daily", time_of_day=time_str).next_after(datetime.utcnow())
     if not is_edit:
-        await create_mailing_in_db(state, schedule_type="daily", time_of_day=time_str, next_run=first_run)
+        await create_mailing_in_db(session, state, schedule_type="daily", time_of_day=time_str, next_run=first_run, spread_minutes=spread_minutes)
         await message.answer("Ежедневная рассылка создана!")
     else:
         mailing_id = data["existing_mailing_id"]
-        await add_schedule_for_existing_mailing(mailing_id, schedule_type="daily", time_of_day=time_str, next_run=first_run)
+        await add_schedule_for_existing_mailing(session, mailing_id, schedule_type="daily", time_of_day=time_str, next_run=first_run, spread_minutes=spread_minutes)
         await message.answer("Расписание обновлено (ежедневно).")
     await state.clear()
 
@@ -1290,20 +1166,22 @@ async def entering_daily_time(message: types.Message, state: FSMContext):
 # -----------------------------
 #  Функция для добавления (создания) нового расписания к существующей рассылке
 # -----------------------------
-async def add_schedule_for_existing_mailing(mailing_id: int, schedule_type: str, day_of_week: str = None,
-                                            day_of_month: str = None, time_of_day: str = None, next_run: datetime = None):
-    async with AsyncSessionLocal() as session:
-        mailing = await session.get(Mailing, mailing_id)
-        if not mailing or mailing.active == 0:
-            return
-        sch = MailingSchedule(
-            mailing_id=mailing_id,
-            schedule_type=schedule_type,
-            day_of_week=day_of_week,
-            day_of_month=day_of_month,
-            time_of_day=time_of_day,
-            next_run=next_run or datetime.utcnow(),
-            active=1
-        )
-        session.add(sch)
-        await session.commit()
+async def add_schedule_for_existing_mailing(session: AsyncSession, mailing_id: int, schedule_type: str, day_of_week: str = None,
+                                            day_of_month: str = None, time_of_day: str = None, next_run: datetime = None,
+                                            spread_minutes: int = 0):
+    mailing = await session.get(Mailing, mailing_id)
+    if not mailing or mailing.active == 0:
+        return
+    sch = MailingSchedule(
+        mailing_id=mailing_id,
+        schedule_type=schedule_type,
+        day_of_week=day_of_week,
+        day_of_month=day_of_month,
+        time_of_day=time_of_day,
+        next_run=next_run or datetime.utcnow(),
+        spread_minutes=spread_minutes,
+        active=1
+    )
+    session.add(sch)
+    await session.commit()
+    notify_scheduler()
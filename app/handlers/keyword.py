@@ -10,11 +10,12 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
 from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.config import config
-from app.db.db import AsyncSessionLocal
 from app.db.models import Material, KeywordLink
 from app.utils.helpers import generate_link_for_material, bot
+from app.utils.viewer_index import viewer_index
 
 keyword_router = Router()
 
@@ -69,7 +70,7 @@ async def process_media_group(media_group_id: str, state: FSMContext, trigger_me
 
 
 @keyword_router.message(Command("keyword"))
-async def cmd_keyword(message: types.Message, state: FSMContext):
+async def cmd_keyword(message: types.Message, state: FSMContext, session: AsyncSession):
     """
     Шаг 1: /keyword <слово>.
     Проверяем, свободно ли ключевое слово, и просим переслать сообщение.
@@ -90,9 +91,8 @@ async def cmd_keyword(message: types.Message, state: FSMContext):
         await message.answer("Ошибка: ключевое слово должно содержать только английские буквы и цифры.")
         return
 
-    async with AsyncSessionLocal() as session:
-        stmt = select(Material).where(Material.keyword == keyword)
-        existing_material = await session.scalar(stmt)
+    stmt = select(Material).where(Material.keyword == keyword)
+    existing_material = await session.scalar(stmt)
 
     cancel_button = InlineKeyboardButton(text="Отмена", callback_data="cancel")
     keyboard = InlineKeyboardMarkup(inline_keyboard=[[cancel_button]])
@@ -184,7 +184,7 @@ async def keyword_set_datetime(message: types.Message, state: FSMContext):
 
 
 @keyword_router.message(KeywordStates.waiting_for_maxclicks)
-async def keyword_set_maxclicks(message: types.Message, state: FSMContext):
+async def keyword_set_maxclicks(message: types.Message, state: FSMContext, session: AsyncSession):
     """
     Шаг 4: Пользователь вводит максимальное количество кликов (или '-'),
     после чего материал сохраняется в базе. Если материал с таким URL уже существует,
@@ -214,35 +214,35 @@ async def keyword_set_maxclicks(message: types.Message, state: FSMContext):
 
     logging.info("Текст: " + caption)
 
-    async with AsyncSessionLocal() as session:
-        stmt = select(Material).where(Material.keyword == keyword)
-        existing_material = await session.scalar(stmt)
-        if existing_material:
-            existing_material.chat_id = str(chat_id)
-            existing_material.message_id = ",".join(str(mid) for mid in source_message_ids)
-            existing_material.file_ids = file_ids
-            existing_material.caption = caption
-            existing_material.caption_entities = caption_entities
-            material = existing_material
-        else:
-            material = Material(
-                keyword=keyword,
-                chat_id=str(chat_id),
-                message_id=",".join(str(mid) for mid in source_message_ids),
-                file_ids=file_ids,
-                caption=caption,
-                caption_entities=caption_entities
-            )
-            session.add(material)
-        await session.commit()
-        await session.refresh(material)
-        link_obj = await generate_link_for_material(
-            session,
-            material,
-            keyword,
-            expire_in_days=expire_in_days,
-            max_clicks=max_clicks
+    stmt = select(Material).where(Material.keyword == keyword)
+    existing_material = await session.scalar(stmt)
+    if existing_material:
+        existing_material.chat_id = str(chat_id)
+        existing_material.message_id = ",".join(str(mid) for mid in source_message_ids)
+        existing_material.file_ids = file_ids
+        existing_material.caption = caption
+        existing_material.caption_entities = caption_entities
+        material = existing_material
+    else:
+        material = Material(
+            keyword=keyword,
+            chat_id=str(chat_id),
+            message_id=",".join(str(mid) for mid in source_message_ids),
+            file_ids=file_ids,
+            caption=caption,
+            caption_entities=caption_entities
         )
+        session.add(material)
+    await session.flush()  # получим ID материала
+    viewer_index.add_material(material.id, material.keyword)
+    link_obj = await generate_link_for_material(
+        session,
+        material,
+        keyword,
+        expire_in_days=expire_in_days,
+        max_clicks=max_clicks
+    )
+    await session.commit()
     await message.answer(
         f"Материал для ключевого слова <b>{keyword}</b> сохранён!\n"
         f"Ссылка: {link_obj.link}\n\n"
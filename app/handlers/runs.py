@@ -0,0 +1,95 @@
+import logging
+
+from aiogram import Router, types, F
+from aiogram.filters import Command
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import config
+from app.db.models import Mailing, MailingRun
+from app.tasks import notify_scheduler
+from app.utils.outbox import control_run, count_deliveries, get_run_status
+
+runs_router = Router()
+
+RUN_STATUS_NAMES = {
+    "running": "идёт отправка",
+    "paused": "на паузе",
+    "cancelled": "отменена",
+    "done": "завершена",
+}
+RUN_ACTION_RESULTS = {
+    "pause": "Рассылка поставлена на паузу.",
+    "resume": "Рассылка возобновлена.",
+    "cancel": "Рассылка отменена.",
+}
+
+
+def run_control_keyboard(run_id: int, status: str) -> InlineKeyboardMarkup | None:
+    """
+    Кнопки управления запуском рассылки: пауза/возобновление и отмена.
+    """
+    if status == "running":
+        first = InlineKeyboardButton(text="⏸ Пауза", callback_data=f"run_pause_{run_id}")
+    elif status == "paused":
+        first = InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"run_resume_{run_id}")
+    else:
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [first, InlineKeyboardButton(text="⏹ Отменить", callback_data=f"run_cancel_{run_id}")]
+    ])
+
+
+@runs_router.message(Command("runs"))
+async def cmd_runs(message: types.Message, session: AsyncSession):
+    """
+    Список незавершённых запусков рассылок с кнопками управления.
+    """
+    if message.chat.id not in config.ADMIN_IDS:
+        return
+    runs = (await session.execute(
+        select(MailingRun.id, MailingRun.status, MailingRun.started_at, Mailing.title)
+        .join(Mailing, Mailing.id == MailingRun.mailing_id)
+        .where(MailingRun.status.in_(("running", "paused")))
+        .order_by(MailingRun.id)
+    )).all()
+    if not runs:
+        await message.answer("Сейчас нет незавершённых рассылок.")
+        return
+
+    for run_id, status, started_at, title in runs:
+        counts = await count_deliveries(run_id)
+        text = (
+            f"Рассылка <b>{title}</b> (запуск {run_id}) – {RUN_STATUS_NAMES[status]}\n"
+            f"Начата (UTC): {started_at.strftime('%d.%m.%Y %H:%M')}\n"
+            f"Отправлено: {counts.get('sent', 0)}, Ошибок: {counts.get('failed', 0)}, "
+            f"Осталось: {counts.get('pending', 0) + counts.get('sending', 0)}"
+        )
+        await message.answer(text, parse_mode="HTML", reply_markup=run_control_keyboard(run_id, status))
+
+
+@runs_router.callback_query(F.data.regexp(r"^run_(pause|resume|cancel)_\d+$"))
+async def run_control_callback(callback: types.CallbackQuery):
+    """
+    Пауза, возобновление и отмена запуска рассылки. Отправка останавливается перед следующей пачкой.
+    """
+    if callback.from_user.id not in config.ADMIN_IDS:
+        await callback.answer()
+        return
+    _, action, run_id = callback.data.split("_")
+    run_id = int(run_id)
+
+    if not await control_run(run_id, action):
+        await callback.answer("Действие недоступно для текущего состояния рассылки.", show_alert=True)
+    else:
+        logging.info(f"Запуск рассылки run_id={run_id}: {action} (админ {callback.from_user.id})")
+        if action == "resume":
+            notify_scheduler()  # возобновлённый запуск подхватит планировщик
+        await callback.answer(RUN_ACTION_RESULTS[action])
+
+    status = await get_run_status(run_id)
+    try:
+        await callback.message.edit_reply_markup(reply_markup=run_control_keyboard(run_id, status))
+    except Exception as e:
+        logging.debug(f"Не удалось обновить кнопки запуска {run_id}: {e}")
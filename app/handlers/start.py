@@ -11,13 +11,15 @@ from aiogram.types import FSInputFile, InputMediaPhoto, InputMediaDocument, Inpu
     InlineKeyboardMarkup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import joinedload
 
 from app.config import config
-from app.db.db import AsyncSessionLocal
 from app.db.models import User, KeywordLink, Material, MaterialView
 from app.utils.cryptography import decrypt_wp_id
-from app.utils.helpers import get_or_create_user, bot
+from app.utils.helpers import get_or_create_user, mark_user_reachable, bot
+from app.utils.delivery import send_lane, LANE_ADMIN
+from app.utils.viewer_index import viewer_index
 
 start_router = Router()
 
@@ -28,13 +30,15 @@ def get_reply_button(user_id: int, message_id: int) -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 @start_router.message(CommandStart())
-async def cmd_start(message: types.Message, bot: Bot, state: FSMContext):
+async def cmd_start(message: types.Message, bot: Bot, state: FSMContext, session: AsyncSession):
     """
     Обработчик /start: проверяет параметры auth_ и keyword_.
     """
     await bot.send_chat_action(message.chat.id, "typing")
     params = message.text.split(maxsplit=1)
     await state.clear()
+    # Пользователь снова доступен для рассылок
+    await mark_user_reachable(message.from_user.id, session)
 
     if len(params) > 1:
         start_param = params[1]
@@ -48,107 +52,106 @@ async def cmd_start(message: types.Message, bot: Bot, state: FSMContext):
                 logging.error(f"Ошибка расшифровки wp_id: {e}")
                 return
 
-            async with AsyncSessionLocal() as session:
-                user = await get_or_create_user(session, message.from_user, decrypted_wp_id)
-                await session.commit()
+            user = await get_or_create_user(session, message.from_user, decrypted_wp_id)
 
         # Обработка параметра keyword_
         if start_param.startswith("keyword_"):
             link_str = start_param.replace("keyword_", "", 1)
 
-            async with AsyncSessionLocal() as session:
-                stmt = (
-                    select(KeywordLink)
-                    .join(KeywordLink.material)
-                    .where(Material.keyword == link_str)
-                    .options(joinedload(KeywordLink.material))
-                )
-                link_obj = await session.scalar(stmt)
-                if not link_obj:
-                    await message.answer("Ссылка не найдена или недействительна.")
-                    return
-
-                now = datetime.utcnow()
-                if (link_obj.expiration_date and now > link_obj.expiration_date) or \
-                   (link_obj.max_clicks is not None and link_obj.click_count >= link_obj.max_clicks):
-                    await message.answer("Срок действия ссылки истёк или превышено число кликов.")
-                    return
-
-                update_stmt = (
-                    KeywordLink.__table__.update()
-                    .where(KeywordLink.id == link_obj.id)
-                    .values(click_count=KeywordLink.click_count + 1)
-                )
-                await session.execute(update_stmt)
-
-                material = link_obj.material
-                if not material or not material.chat_id or not material.message_id:
-                    await message.answer("Материал не найден или некорректен.")
-                    return
-
-                user = await get_or_create_user(session, message.from_user)
-                material_view = MaterialView(
-                    user_id=user.id,
-                    material_id=material.id,
-                    viewed_at=datetime.utcnow()
-                )
-                session.add(material_view)
-                await session.commit()
+            stmt = (
+                select(KeywordLink)
+                .join(KeywordLink.material)
+                .where(Material.keyword == link_str)
+                .options(joinedload(KeywordLink.material))
+            )
+            link_obj = await session.scalar(stmt)
+            if not link_obj:
+                await message.answer("Ссылка не найдена или недействительна.")
+                return
 
-                if json.loads(material.file_ids):
-                    file_list = json.loads(material.file_ids)
-                    input_media = []
+            now = datetime.utcnow()
+            if (link_obj.expiration_date and now > link_obj.expiration_date) or \
+               (link_obj.max_clicks is not None and link_obj.click_count >= link_obj.max_clicks):
+                await message.answer("Срок действия ссылки истёк или превышено число кликов.")
+                return
 
-                    for i, item in enumerate(file_list):
-                        entities = (
-                            [MessageEntity(**entity) for entity in json.loads(material.caption_entities)]
-                            if material.caption_entities else None
-                        )
+            update_stmt = (
+                KeywordLink.__table__.update()
+                .where(KeywordLink.id == link_obj.id)
+                .values(click_count=KeywordLink.click_count + 1)
+            )
+            await session.execute(update_stmt)
 
-                        if item["type"] == "photo":
-                            media_obj = InputMediaPhoto(
-                                media=item["file_id"],
-                                caption=material.caption if i == 0 and material.caption else None,
-                                parse_mode=None,
-                                caption_entities=entities if i == 0 and material.caption else None
-                            )
-                        elif item["type"] == "document":
-                            media_obj = InputMediaDocument(
-                                media=item["file_id"],
-                                caption=material.caption if i == 0 and material.caption else None,
-                                parse_mode=None,
-                                caption_entities=entities if i == 0 and material.caption else None
-                            )
-                        elif item["type"] == "video":
-                            media_obj = InputMediaVideo(
-                                media=item["file_id"],
-                                caption=material.caption if i == 0 and material.caption else None,
-                                parse_mode=None,
-                                caption_entities=entities if i == 0 and material.caption else None
-                            )
-
-                        input_media.append(media_obj)
-
-                    await bot.send_media_group(
-                        chat_id=message.chat.id,
-                        media=input_media
-                    )
+            material = link_obj.material
+            if not material or not material.chat_id or not material.message_id:
+                await session.rollback()  # клик по битой ссылке не засчитываем
+                await message.answer("Материал не найден или некорректен.")
+                return
+
+            user = await get_or_create_user(session, message.from_user)
+            material_view = MaterialView(
+                user_id=user.id,
+                material_id=material.id,
+                viewed_at=datetime.utcnow()
+            )
+            session.add(material_view)
+            await session.commit()  # до отправки материала, чтобы не держать блокировку ссылки
+            viewer_index.add_view(material.id, user.id, material.keyword)
+
+            if json.loads(material.file_ids):
+                file_list = json.loads(material.file_ids)
+                input_media = []
 
-                else:
-                    # Если материал без медиа‑группы, отправляем одиночное сообщение с учётом caption_entities
+                for i, item in enumerate(file_list):
                     entities = (
                         [MessageEntity(**entity) for entity in json.loads(material.caption_entities)]
                         if material.caption_entities else None
                     )
 
-                    logging.info(entities)
-                    await bot.send_message(
-                        chat_id=message.chat.id,
-                        text=material.caption,
-                        parse_mode=None,
-                        entities=entities
-                    )
-                return
+                    if item["type"] == "photo":
+                        media_obj = InputMediaPhoto(
+                            media=item["file_id"],
+                            caption=material.caption if i == 0 and material.caption else None,
+                            parse_mode=None,
+                            caption_entities=entities if i == 0 and material.caption else None
+                        )
+                    elif item["type"] == "document":
+                        media_obj = InputMediaDocument(
+                            media=item["file_id"],
+                            caption=material.caption if i == 0 and material.caption else None,
+                            parse_mode=None,
+                            caption_entities=entities if i == 0 and material.caption else None
+                        )
+                    elif item["type"] == "video":
+                        media_obj = InputMediaVideo(
+                            media=item["file_id"],
+                            caption=material.caption if i == 0 and material.caption else None,
+                            parse_mode=None,
+                            caption_entities=entities if i == 0 and material.caption else None
+                        )
+
+                    input_media.append(media_obj)
+
+                await bot.send_media_group(
+                    chat_id=message.chat.id,
+                    media=input_media
+                )
+
+            else:
+                # Если материал без медиа‑группы, отправляем одиночное сообщение с учётом caption_entities
+                entities = (
+                    [MessageEntity(**entity) for entity in json.loads(material.caption_entities)]
+                    if material.caption_entities else None
+                )
+
+                logging.info(entities)
+                await bot.send_message(
+                    chat_id=message.chat.id,
+                    text=material.caption,
+                    parse_mode=None,
+                    entities=entities
+                )
+            return
 
     await bot.send_photo(
         chat_id=message.chat.id,
@@ -267,6 +270,8 @@ async def forward_all_messages(message: types.Message, bot: Bot, state: FSMConte
     user_id = message.from_user.id
     username = message.from_user.username
 
+    # Пересылка администраторам идёт в полосе admin, не мешая ответам пользователям
+    send_lane.set(LANE_ADMIN)
     for admin_id in config.ADMIN_IDS:
         if username:
             from_block = f"<b>📩 Сообщение от</b> <a href='tg://user?id={user_id}'>{full_name}</a> (@{username}):\n\n"
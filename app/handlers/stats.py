@@ -7,38 +7,43 @@ from aiogram import Router, types, Bot
 from aiogram.filters import Command
 from aiogram.types import MessageEntity, InputMediaPhoto, InputMediaDocument, InputMediaVideo, FSInputFile
 from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import joinedload
 
 
 from app.config import config
-from app.db.db import AsyncSessionLocal
+from app.db.db import pool_state
 from app.db.models import KeywordLink, Material, MaterialView, User
 from app.utils.helpers import get_user_statistics, get_keyword_info, get_user_info, export_statistics_to_excel
+from app.utils.delivery_log import (
+    get_delivery_summary, DELIVERY_SENT, DELIVERY_FAILED, DELIVERY_UNREACHABLE, DELIVERY_REJECTED
+)
+from app.utils.viewer_index import viewer_index
+from app.utils.perf import handler_report, metrics
 
 stats_router = Router()
 
 @stats_router.message(Command("stats"))
-async def cmd_stats(message: types.Message):
+async def cmd_stats(message: types.Message, session: AsyncSession):
     """
     Показать статистику с новой сегментацией пользователей
     """
     if message.chat.id not in config.ADMIN_IDS:
         return
-    async with AsyncSessionLocal() as session:
-        stats = await get_user_statistics(session)
+    stats = await get_user_statistics(session)
         
-        reply_text = (
-            f"Общее количество: *{stats['total_users']}*\n\n"
-            f"*Активные пользователи* (активная подписка): *{stats['active_users']}*\n"
-            f"*Зарегистрированные* (без подписки): *{stats['registered_users']}*\n"
-            f"*Подписка закончилась* (завершенная подписка): *{stats['expired_users']}*\n"
-            f"*Пользователи по лид-магниту* (только контакт): *{stats['lead_magnet_users']}*"
-        )
+    reply_text = (
+        f"Общее количество: *{stats['total_users']}*\n\n"
+        f"*Активные пользователи* (активная подписка): *{stats['active_users']}*\n"
+        f"*Зарегистрированные* (без подписки): *{stats['registered_users']}*\n"
+        f"*Подписка закончилась* (завершенная подписка): *{stats['expired_users']}*\n"
+        f"*Пользователи по лид-магниту* (только контакт): *{stats['lead_magnet_users']}*"
+    )
 
-        await message.answer(reply_text, parse_mode="Markdown")
+    await message.answer(reply_text, parse_mode="Markdown")
 
 @stats_router.message(Command("export_stats"))
-async def cmd_export_stats(message: types.Message):
+async def cmd_export_stats(message: types.Message, session: AsyncSession):
     """
     Экспорт статистики пользователей в Excel и отправка файла.
     """
@@ -47,8 +52,7 @@ async def cmd_export_stats(message: types.Message):
     timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M")
     file_path = f"users_stats_{timestamp}.xlsx"  # Указываем дату и время в названии файла
     message = await message.answer("Ожидайте, собираем информацию...")
-    async with AsyncSessionLocal() as session:
-        file_path = await export_statistics_to_excel(session, file_path)
+    file_path = await export_statistics_to_excel(session, file_path)
     await message.delete()
     # Отправляем файл пользователю
     await message.answer_document(document=types.FSInputFile(file_path))
@@ -94,20 +98,19 @@ async def cmd_backup(message: types.Message):
         logging.error(f"Ошибка при создании бэкапа: {e}")
 
 
-async def send_keyword_info(chat_id: int, keyword: str, bot: Bot):
+async def send_keyword_info(session: AsyncSession, chat_id: int, keyword: str, bot: Bot):
     """
     Получает материал и информацию по ключевому слову, отправляет медиа (если есть) и текст с данными.
     Добавляет кнопку для удаления ключевого слова.
     """
-    async with AsyncSessionLocal() as session:
-        info = await get_keyword_info(session, keyword)
-        stmt = (
-            select(KeywordLink)
-            .join(KeywordLink.material)
-            .where(Material.keyword == keyword)
-            .options(joinedload(KeywordLink.material))
-        )
-        link_obj = await session.scalar(stmt)
+    info = await get_keyword_info(session, keyword)
+    stmt = (
+        select(KeywordLink)
+        .join(KeywordLink.material)
+        .where(Material.keyword == keyword)
+        .options(joinedload(KeywordLink.material))
+    )
+    link_obj = await session.scalar(stmt)
     if not link_obj:
         await bot.send_message(chat_id, f"Ключевое слово '{keyword}' не найдено.")
         return
@@ -179,7 +182,7 @@ async def send_keyword_info(chat_id: int, keyword: str, bot: Bot):
 
 
 @stats_router.message(Command("keyword_info"))
-async def cmd_keyword_info(message: types.Message, bot: Bot):
+async def cmd_keyword_info(message: types.Message, bot: Bot, session: AsyncSession):
     """
     Если команда вызывается с аргументом (например, /keyword_info MARCH8),
     сразу показывает информацию по этому ключевому слову.
@@ -191,10 +194,9 @@ async def cmd_keyword_info(message: types.Message, bot: Bot):
     parts = message.text.strip().split(maxsplit=1)
     if len(parts) == 2:
         keyword = parts[1]
-        await send_keyword_info(message.chat.id, keyword, bot)
+        await send_keyword_info(session, message.chat.id, keyword, bot)
     else:
-        async with AsyncSessionLocal() as session:
-            materials = (await session.scalars(select(Material))).all()
+        materials = (await session.scalars(select(Material))).all()
         if not materials:
             await message.answer("Нет сохранённых ключевых слов.")
             return
@@ -207,9 +209,9 @@ async def cmd_keyword_info(message: types.Message, bot: Bot):
 
 
 @stats_router.callback_query(lambda c: c.data and c.data.startswith("info_keyword_"))
-async def show_keyword_info(callback: types.CallbackQuery, bot: Bot):
+async def show_keyword_info(callback: types.CallbackQuery, bot: Bot, session: AsyncSession):
     keyword = callback.data[len("info_keyword_"):]
-    await send_keyword_info(callback.message.chat.id, keyword, bot)
+    await send_keyword_info(session, callback.message.chat.id, keyword, bot)
     await callback.answer()
 
 
@@ -228,19 +230,19 @@ async def prompt_delete_keyword(callback: types.CallbackQuery, bot: Bot):
 
 
 @stats_router.callback_query(lambda c: c.data and c.data.startswith("confirm_delete_keyword_"))
-async def confirm_delete_keyword(callback: types.CallbackQuery, bot: Bot):
+async def confirm_delete_keyword(callback: types.CallbackQuery, bot: Bot, session: AsyncSession):
     keyword = callback.data[len("confirm_delete_keyword_"):]
-    async with AsyncSessionLocal() as session:
-        material = await session.scalar(select(Material).where(Material.keyword == keyword))
-        if not material:
-            await callback.message.edit_text(f"Ключевое слово '{keyword}' не найдено.")
-            return
-        # Удаляем все связанные записи из KeywordLink и MaterialView
-        await session.execute(delete(KeywordLink).where(KeywordLink.material_id == material.id))
-        await session.execute(delete(MaterialView).where(MaterialView.material_id == material.id))
-        # Удаляем сам материал
-        await session.delete(material)
-        await session.commit()
+    material = await session.scalar(select(Material).where(Material.keyword == keyword))
+    if not material:
+        await callback.message.edit_text(f"Ключевое слово '{keyword}' не найдено.")
+        return
+    # Удаляем все связанные записи из KeywordLink и MaterialView
+    await session.execute(delete(KeywordLink).where(KeywordLink.material_id == material.id))
+    await session.execute(delete(MaterialView).where(MaterialView.material_id == material.id))
+    # Удаляем сам материал
+    await session.delete(material)
+    await session.commit()
+    viewer_index.remove_material(material.id, keyword)
     await callback.message.edit_text(f"Ключевое слово '{keyword}' и вся связанная с ним информация удалены.")
     await callback.answer()
 
@@ -252,7 +254,7 @@ async def cancel_delete_keyword(callback: types.CallbackQuery, bot: Bot):
 
 
 @stats_router.message(Command("user_info"))
-async def cmd_user_info(message: types.Message):
+async def cmd_user_info(message: types.Message, session: AsyncSession):
     """
     Получить информацию по пользователю (по ID, username или имени).
     """
@@ -262,31 +264,101 @@ async def cmd_user_info(message: types.Message):
     if not query:
         await message.answer("Укажите Telegram ID, username (@username) или имя пользователя.")
         return
-    async with AsyncSessionLocal() as session:
-        info = await get_user_info(session, query)
-        if not info:
-            await message.answer("Пользователь не найден.")
-            return
-        user_info = info["user"]
-        reply_text = (
-            f"Пользователь:\n"
-            f"Telegram ID: <a href='tg://user?id={user_info['tg_id']}'>{user_info['tg_id']}</a>\n"
+    info = await get_user_info(session, query)
+    if not info:
+        await message.answer("Пользователь не найден.")
+        return
+    user_info = info["user"]
+    reply_text = (
+        f"Пользователь:\n"
+        f"Telegram ID: <a href='tg://user?id={user_info['tg_id']}'>{user_info['tg_id']}</a>\n"
+    )
+    if user_info.get("username"):
+        reply_text += f"Username: @{user_info['username']}\n"
+    if user_info.get("created_at"):
+        reply_text += f"Дата регистрации: <b>{user_info['created_at'].strftime('%d.%m.%Y %H:%M')}</b>\n"
+    reply_text += (
+        f"Имя: <b><a href='tg://user?id={user_info['tg_id']}'>{user_info['first_name']}</a></b>\n"
+        f"Статус: <b>{user_info['status'] if user_info['status'] is not None else 'не зарегистрирован'}</b>\n"
+        f"Просмотренные материалы:\n"
+    )
+    for material in info["viewed_materials"]:
+        reply_text += (
+            f"- Ключевое слово: <b>{material['keyword']}</b>\n"
+            f"- Дата просмотра: <b>{material['viewed_at'].strftime('%d.%m.%Y %H:%M')}</b>\n"
         )
-        if user_info.get("username"):
-            reply_text += f"Username: @{user_info['username']}\n"
-        if user_info.get("created_at"):
-            reply_text += f"Дата регистрации: <b>{user_info['created_at'].strftime('%d.%m.%Y %H:%M')}</b>\n"
+    await message.answer(reply_text, parse_mode="HTML")
+
+
+@stats_router.message(Command("mailing_report"))
+async def cmd_mailing_report(message: types.Message, session: AsyncSession):
+    """
+    Итоги доставки рассылки по запускам из журнала доставки: /mailing_report <id рассылки>
+    """
+    if message.chat.id not in config.ADMIN_IDS:
+        return
+
+    parts = message.text.strip().split(maxsplit=1)
+    if len(parts) != 2 or not parts[1].isdigit():
+        await message.answer("Использование: /mailing_report <id рассылки>")
+        return
+
+    rows = await get_delivery_summary(session, int(parts[1]))
+    if not rows:
+        await message.answer("По этой рассылке в журнале доставки нет записей.")
+        return
+
+    runs = {}
+    for run_id, status, count, last_at in rows:
+        run = runs.setdefault(run_id, {"counts": {}, "last_at": last_at})
+        run["counts"][status] = count
+        run["last_at"] = max(run["last_at"], last_at)
+
+    reply_text = f"<b>Доставка рассылки {parts[1]}</b>\n\n"
+    for run_id, run in runs.items():
+        counts = run["counts"]
         reply_text += (
-            f"Имя: <b><a href='tg://user?id={user_info['tg_id']}'>{user_info['first_name']}</a></b>\n"
-            f"Статус: <b>{user_info['status'] if user_info['status'] is not None else 'не зарегистрирован'}</b>\n"
-            f"Просмотренные материалы:\n"
+            f"Запуск {run_id or '—'} ({run['last_at'].strftime('%d.%m.%Y %H:%M')}):\n"
+            f"- Доставлено: <b>{counts.get(DELIVERY_SENT, 0)}</b>\n"
+            f"- Временные ошибки: <b>{counts.get(DELIVERY_FAILED, 0)}</b>\n"
+            f"- Недоступные получатели: <b>{counts.get(DELIVERY_UNREACHABLE, 0)}</b>\n"
+            f"- Отклонено Telegram: <b>{counts.get(DELIVERY_REJECTED, 0)}</b>\n\n"
         )
-        for material in info["viewed_materials"]:
-            reply_text += (
-                f"- Ключевое слово: <b>{material['keyword']}</b>\n"
-                f"- Дата просмотра: <b>{material['viewed_at'].strftime('%d.%m.%Y %H:%M')}</b>\n"
-            )
-        await message.answer(reply_text, parse_mode="HTML")
+    await message.answer(reply_text, parse_mode="HTML")
+
+
+@stats_router.message(Command("perf"))
+async def cmd_perf(message: types.Message):
+    """
+    Самые затратные обработчики с момента запуска: время, запросы к БД, вызовы Telegram API;
+    состояние пула соединений с БД.
+    """
+    if message.chat.id not in config.ADMIN_IDS:
+        return
+
+    pool = pool_state()
+    wait = metrics.histograms["bot_db_pool_wait_seconds"].get(())
+    reply_text = f"<b>Пул БД</b>: занято {pool['in_use']} из {pool['max']}, свободно {pool['idle']}"
+    if wait:
+        reply_text += f", ожидание соединения p95 ≤ {wait.quantile(0.95) * 1000:.0f} мс"
+    reply_text += "\n\n"
+
+    rows = handler_report()
+    if not rows:
+        await message.answer(reply_text + "Данных об обработчиках пока нет.", parse_mode="HTML")
+        return
+
+    reply_text += "<b>Обработчики по суммарному времени</b>\n\n"
+    for row in rows:
+        reply_text += (
+            f"<b>{row['router']}.{row['handler']}</b>: {row['count']} раз, всего {row['total']:.1f} с\n"
+            f"- среднее {row['mean'] * 1000:.0f} мс, p95 ≤ {row['p95'] * 1000:.0f} мс\n"
+            f"- БД: {row['queries_mean']:.1f} запросов, {row['db_mean'] * 1000:.0f} мс; "
+            f"API: {row['api_mean']:.1f} вызовов"
+            + (f"; ошибок: {row['errors']:.0f}" if row["errors"] else "")
+            + "\n\n"
+        )
+    await message.answer(reply_text, parse_mode="HTML")
 
 
 @stats_router.message(Command("info"))
@@ -304,6 +376,9 @@ async def cmd_info(message: types.Message):
         "📂 */export_stats* — экспорт статистики пользователей в Excel\n"
         "🔑 */keyword_info <ключевое слово>* — информация по ключевому слову\n"
         "👤 */user_info <ID | @username | имя>* — информация о пользователе\n"
+        "📬 */mailing_report <id рассылки>* — итоги доставки рассылки по запускам\n"
+        "⏯ */runs* — незавершённые рассылки: пауза, продолжение, отмена\n"
+        "⏱ */perf* — время обработчиков, запросы к БД, вызовы API и пул соединений\n"
         "ℹ️ */info* — показать список доступных команд\n\n"
         "⚡ Используйте команды для управления ботом!"
     )
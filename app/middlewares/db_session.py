@@ -0,0 +1,23 @@
+from aiogram.dispatcher.middlewares.base import BaseMiddleware
+from aiogram.types import Update
+
+from app.db.db import AsyncSessionLocal
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """
+    Одна сессия БД на апдейт, доступная обработчикам как аргумент session.
+    Соединение из пула берётся только при первом запросе; после успешной
+    обработки изменения фиксируются, при исключении – откатываются.
+    """
+
+    async def __call__(self, handler, event: Update, data):
+        async with AsyncSessionLocal() as session:
+            data["session"] = session
+            try:
+                result = await handler(event, data)
+            except Exception:
+                await session.rollback()
+                raise
+            await session.commit()
+            return result
@@ -0,0 +1,40 @@
+from aiogram.dispatcher.middlewares.base import BaseMiddleware
+from aiogram.types import Update
+
+from app.utils.perf import RequestStats, current_request, record_request
+
+
+class PerfMiddleware(BaseMiddleware):
+    """
+    Внешний middleware апдейтов: время обработки, число и время запросов к БД
+    и число вызовов Telegram API за апдейт – в гистограммы по обработчику и роутеру.
+    """
+
+    async def __call__(self, handler, event: Update, data):
+        stats = RequestStats()
+        token = current_request.set(stats)
+        failed = False
+        try:
+            return await handler(event, data)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            current_request.reset(token)
+            record_request(stats, failed)
+
+
+class HandlerTagMiddleware(BaseMiddleware):
+    """
+    Внутренний middleware роутера: отмечает, какой обработчик обрабатывает апдейт.
+    Роутер определяется по модулю обработчика (app/handlers/<роутер>.py).
+    """
+
+    async def __call__(self, handler, event, data):
+        stats = current_request.get()
+        handler_object = data.get("handler")
+        if stats is not None and handler_object is not None:
+            callback = handler_object.callback
+            stats.handler = callback.__name__
+            stats.router = callback.__module__.rsplit(".", 1)[-1]
+        return await handler(event, data)
@@ -0,0 +1,26 @@
+from aiogram.dispatcher.middlewares.base import BaseMiddleware
+from aiogram.types import Update
+
+from app.config import config
+from app.utils.delivery import send_lane, LANE_INTERACTIVE, LANE_ADMIN
+
+
+class SendLaneMiddleware(BaseMiddleware):
+    """
+    Задаёт полосу приоритета исходящих запросов на время обработки апдейта:
+    ответы пользователям – interactive, действия администраторов – admin.
+    """
+
+    async def __call__(self, handler, event: Update, data):
+        user = None
+        if event.message:
+            user = event.message.from_user
+        elif event.callback_query:
+            user = event.callback_query.from_user
+
+        is_admin = user is not None and user.id in config.ADMIN_IDS
+        token = send_lane.set(LANE_ADMIN if is_admin else LANE_INTERACTIVE)
+        try:
+            return await handler(event, data)
+        finally:
+            send_lane.reset(token)
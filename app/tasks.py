@@ -1,10 +1,8 @@
 import asyncio
 import logging
-import json
 import subprocess
 import os
 from datetime import datetime, timedelta
-from calendar import monthrange
 
 import aiohttp
 from aiohttp import BasicAuth
@@ -12,9 +10,17 @@ from sqlalchemy import select, func
 from sqlalchemy.exc import SQLAlchemyError
 
 from app.db.db import AsyncSessionLocal
-from app.db.models import User, Mailing, MailingStatus, MailingSchedule, Material, MaterialView
+from app.db.models import User, Mailing, MailingSchedule, MailingRun
 from app.config import config
-from aiogram.types import MessageEntity, InputMediaPhoto, InputMediaDocument, InputMediaVideo
+from app.utils.delivery import get_mailing_payload
+from app.utils.outbox import (
+    get_or_create_run, fill_run, complete_run, finish_run, claim_stale_runs, get_next_lease_expiry,
+    audience_key, delete_stale_snapshots, delivery_window, get_run_status, active_runs,
+    schedule_changed, notify_scheduler
+)
+from app.utils.audience import stream_audience, get_mailing_statuses
+from app.utils.recurrence import schedule_recurrence
+from app.utils.viewer_index import viewer_index
 from aiogram import Bot
 
 
@@ -56,6 +62,19 @@ async def create_database_backup():
         return None
 
 
+async def viewer_index_refresher():
+    """
+    Периодически перестраивает индекс аудитории целиком: подхватывает изменения,
+    сделанные в обход бота (загрузка из Excel, другие процессы, ручные правки БД).
+    """
+    while True:
+        await asyncio.sleep(config.VIEWER_INDEX_REFRESH)
+        try:
+            await viewer_index.build()
+        except Exception as e:
+            logging.error(f"❌ Не удалось перестроить индекс аудитории: {e}")
+
+
 async def backup_scheduler(bot: Bot):
     """
     Планировщик бэкапов - создает и отправляет бэкап базы данных каждую ночь в 01:00
@@ -106,176 +125,232 @@ async def backup_scheduler(bot: Bot):
         await asyncio.sleep(60)
 
 
+async def get_next_due_time():
+    """
+    Ближайший момент, когда планировщику есть что делать: next_run активного расписания,
+    время подготовки снимка аудитории (next_run - AUDIENCE_SNAPSHOT_LEAD) или истечение аренды
+    незавершённого запуска (None, если ничего из этого нет).
+    """
+    lead = timedelta(seconds=config.AUDIENCE_SNAPSHOT_LEAD)
+    active_schedules = (
+        select(func.min(MailingSchedule.next_run))
+        .join(Mailing, Mailing.id == MailingSchedule.mailing_id)
+        .where(MailingSchedule.active == 1, Mailing.active == 1)
+    )
+    async with AsyncSessionLocal() as session:
+        next_run = await session.scalar(active_schedules)
+        # Расписания внутри окна подготовки уже обработаны prepare_snapshots
+        next_snapshot = await session.scalar(
+            active_schedules.where(MailingSchedule.next_run > datetime.utcnow() + lead)
+        )
+    lease_expiry = await get_next_lease_expiry()
+    candidates = [next_run, lease_expiry, next_snapshot - lead if next_snapshot else None]
+    candidates = [dt for dt in candidates if dt is not None]
+    return min(candidates) if candidates else None
+
+
+async def wait_for_schedule(next_run: datetime = None):
+    """
+    Ждёт наступления next_run или сигнала notify_scheduler().
+    Если запланированных рассылок нет, ждёт только сигнала – БД в простое не опрашивается.
+    """
+    timeout = None
+    if next_run is not None:
+        timeout = max(0.0, (next_run - datetime.utcnow()).total_seconds())
+        logging.info(f"⏰ Следующая рассылка в {next_run} (UTC)")
+    try:
+        await asyncio.wait_for(schedule_changed.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    schedule_changed.clear()
+
+
+async def claim_due_schedules(limit: int) -> list[int]:
+    """
+    Атомарно забирает до limit наступивших расписаний (SELECT … FOR UPDATE SKIP LOCKED), создаёт для
+    каждого запуск рассылки и сразу сдвигает next_run. Отправка идёт уже вне этой короткой транзакции,
+    поэтому несколько экземпляров бота могут делить расписания без дублей.
+    """
+    now = datetime.utcnow()
+    run_ids = []
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            schedules = (await session.scalars(
+                select(MailingSchedule)
+                .join(Mailing, Mailing.id == MailingSchedule.mailing_id)
+                .where(MailingSchedule.active == 1, Mailing.active == 1, MailingSchedule.next_run <= now)
+                .order_by(MailingSchedule.next_run)
+                .limit(limit)
+                .with_for_update(skip_locked=True, of=MailingSchedule)
+            )).all()
+            for schedule in schedules:
+                run = await get_or_create_run(session, schedule.mailing_id, schedule.id, schedule.next_run)
+                run_ids.append(run.id)
+                # Пересчитываем next_run; единоразовое расписание деактивируем
+                next_run = compute_next_run(schedule)
+                if next_run is None:
+                    schedule.active = 0
+                else:
+                    schedule.next_run = next_run
+    return run_ids
+
+
+async def deliver_run(bot, run_id: int):
+    """
+    Отправляет запуск рассылки: при необходимости записывает аудиторию в outbox и дренирует её.
+    """
+    async with AsyncSessionLocal() as session:
+        run = await session.get(MailingRun, run_id)
+        if not run or run.status != "running":
+            return
+        mailing = await session.get(Mailing, run.mailing_id)
+        if not mailing or mailing.active != 1:
+            await finish_run(run_id)  # Рассылку удалили – запуск больше не нужен
+            return
+        # Аудитория определяется одним запросом по статусам/ключевым словам рассылки
+        statuses = await get_mailing_statuses(session, mailing.id)
+        key = audience_key(statuses)
+        schedule = await session.get(MailingSchedule, run.schedule_id) if run.schedule_id else None
+        window = delivery_window(run.scheduled_for, schedule.spread_minutes) if schedule else None
+
+    # Снимок аудитории обычно готов заранее (prepare_snapshots); пересобираем его,
+    # только если его нет или с тех пор изменились статусы/ключевые слова рассылки
+    stale = run.audience_key is not None and run.audience_key != key
+    if run.audience_loaded_at is None or stale:
+        async with AsyncSessionLocal() as audience_session:
+            await fill_run(run_id, stream_audience(audience_session, statuses), key, replace=stale, window=window)
+
+    # Содержимое рассылки разбирается один раз на запуск
+    payload = get_mailing_payload(mailing)
+
+    async def log_progress(text: str):
+        logging.info(f"📊 Рассылка '{mailing.title}' (run_id={run_id}): " + text.replace("\n", "; "))
+
+    stats = await complete_run(bot, run_id, payload.send, report=log_progress)
+    status = await get_run_status(run_id)
+    result = {"paused": "приостановлена", "cancelled": "отменена"}.get(status, "завершена")
+    logging.info(
+        f"📢 Рассылка '{mailing.title}' (run_id={run_id}) {result}: Успешно: {stats.success}, "
+        f"Ошибок: {stats.errors} (недоступных: {stats.unreachable}, "
+        f"прочих постоянных: {stats.permanent_errors - stats.unreachable}, повторов: {stats.retries})")
+
+
+# Снимки аудитории, которые сейчас записывает этот процесс: run_id -> задача
+snapshot_tasks: dict[int, asyncio.Task] = {}
+
+
+async def prepare_snapshots():
+    """
+    За AUDIENCE_SNAPSHOT_LEAD секунд до next_run заранее записывает аудиторию ближайших
+    расписаний в outbox (запуск в статусе prepared), чтобы в назначенную минуту отправка
+    началась сразу. Снимок пересобирается, если изменилось определение аудитории,
+    а снимки отключённых или перенесённых расписаний удаляются.
+    """
+    now = datetime.utcnow()
+    horizon = now + timedelta(seconds=config.AUDIENCE_SNAPSHOT_LEAD)
+    snapshots = []
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            await delete_stale_snapshots(session)
+            schedules = (await session.execute(
+                select(MailingSchedule.id, MailingSchedule.mailing_id, MailingSchedule.next_run,
+                       MailingSchedule.spread_minutes)
+                .join(Mailing, Mailing.id == MailingSchedule.mailing_id)
+                .where(
+                    MailingSchedule.active == 1, Mailing.active == 1,
+                    MailingSchedule.next_run > now, MailingSchedule.next_run <= horizon
+                )
+                .with_for_update(skip_locked=True, of=MailingSchedule)
+            )).all()
+            for schedule_id, mailing_id, next_run, spread_minutes in schedules:
+                run = await get_or_create_run(session, mailing_id, schedule_id, next_run, status="prepared")
+                if run.status != "prepared" or run.id in snapshot_tasks:
+                    continue
+                statuses = await get_mailing_statuses(session, mailing_id)
+                key = audience_key(statuses)
+                if run.audience_loaded_at is None or run.audience_key != key:
+                    window = delivery_window(next_run, spread_minutes)
+                    snapshots.append((run.id, statuses, key, run.audience_loaded_at is not None, window))
+
+    for run_id, statuses, key, replace, window in snapshots:
+        task = asyncio.create_task(fill_snapshot(run_id, statuses, key, replace, window))
+        snapshot_tasks[run_id] = task
+        task.add_done_callback(lambda _, run_id=run_id: snapshot_tasks.pop(run_id, None))
+
+
+async def fill_snapshot(run_id: int, statuses: list[str], key: str, replace: bool, window: tuple = None):
+    try:
+        async with AsyncSessionLocal() as audience_session:
+            await fill_run(run_id, stream_audience(audience_session, statuses), key, replace, window)
+        logging.info(f"📸 Аудитория запуска run_id={run_id} подготовлена заранее.")
+    except Exception as e:
+        logging.error(f"⚠ Ошибка подготовки аудитории run_id={run_id}: {e}")
+
+
+async def supervise_run(bot, run_id: int):
+    """
+    Отдельная задача одного запуска: ошибка в ней не затрагивает остальные рассылки.
+    """
+    try:
+        await deliver_run(bot, run_id)
+    except Exception as e:
+        logging.error(f"⚠ Ошибка при отправке рассылки run_id={run_id}: {e}")
+
+
+def dispatch_run(bot, run_id: int):
+    if run_id in active_runs:
+        return
+    task = asyncio.create_task(supervise_run(bot, run_id))
+    active_runs[run_id] = task
+
+    def on_done(_):
+        active_runs.pop(run_id, None)
+        notify_scheduler()  # освободилось место – можно забрать следующую рассылку
+
+    task.add_done_callback(on_done)
+
+
 async def mailing_scheduler(bot):
     """
-    Периодически проверяет расписания и отправляет рассылку, если настало время.
-    Теперь поддерживается выбор пользователей для рассылки как по статусу, так и по ключевым словам (в том числе по нескольким ключевым словам).
-    При отправке используются поля file_ids, caption и caption_entities для формирования сообщения.
+    Отправляет рассылки по расписанию. Между запусками спит ровно до ближайшего next_run;
+    создание или изменение расписания будит его сразу (notify_scheduler).
+    Наступившие расписания забираются атомарно, а прерванные запуски (истёкшая аренда)
+    подхватываются любым экземпляром бота, поэтому процессов может быть несколько.
+    Каждый запуск отправляется отдельной задачей; одновременно – не больше MAX_CONCURRENT_MAILINGS,
+    поэтому небольшая рассылка не ждёт окончания большой, наступившей в то же время.
     """
     while True:
-        await asyncio.sleep(60)  # Проверяем раз в 60 секунд
         logging.info("🔄 Проверка расписаний рассылок...")
-        now = datetime.utcnow()
-
         try:
-            async with AsyncSessionLocal() as session:
-                async with session.begin():
-                    # Ищем все активные расписания, у которых next_run <= now
-                    stmt = select(MailingSchedule).where(
-                        MailingSchedule.active == 1,
-                        MailingSchedule.next_run <= now
-                    )
-                    schedules_to_run = (await session.scalars(stmt)).all()
-
-                    if not schedules_to_run:
-                        logging.info("✅ Нет запланированных рассылок для отправки.")
-                    else:
-                        logging.info(f"📬 Найдено {len(schedules_to_run)} рассылок для отправки.")
-
-                    for schedule in schedules_to_run:
-                        mailing = schedule.mailing
-                        if not mailing or mailing.active != 1:
-                            continue  # Пропускаем, если рассылка неактивна
-
-                        # Получаем статусы рассылки
-                        mailing_statuses = (await session.scalars(
-                            select(MailingStatus).where(MailingStatus.mailing_id == mailing.id)
-                        )).all()
-
-                        # Если хотя бы один статус начинается с "keyword:", выбираем пользователей по просмотрам материала
-                        if any(ms.user_status.startswith("keyword:") for ms in mailing_statuses):
-                            keyword_statuses = [ms.user_status for ms in mailing_statuses if ms.user_status.startswith("keyword:")]
-                            keywords = [s.split(":", 1)[1].strip() for s in keyword_statuses]
-                            if not keywords:
-                                logging.error(f"Ключевые слова не заданы для рассылки '{mailing.title}'. Пропускаем данную рассылку.")
-                                continue
-
-                            materials_result = await session.scalars(select(Material).where(Material.keyword.in_(keywords)))
-                            materials_list = materials_result.all()
-                            if not materials_list:
-                                logging.error(f"Неверные ключевые слова {keywords} для рассылки '{mailing.title}'. Пропускаем данную рассылку.")
-                                continue
-
-                            material_ids = [material.id for material in materials_list]
-                            mviews = await session.scalars(select(MaterialView).where(MaterialView.material_id.in_(material_ids)))
-                            mviews_list = mviews.all()
-                            user_ids = [mv.user_id for mv in mviews_list]
-                            if user_ids:
-                                users_result = await session.scalars(select(User).where(User.id.in_(user_ids)))
-                                users_list = users_result.all()
-                            else:
-                                users_list = []
-                        else:
-                            # Таргетинг по статусам
-                            all_statuses = [ms.user_status.lower() for ms in mailing_statuses]
-                            non_admin_statuses = [st for st in all_statuses if st != "админы"]
-                            users_list = []
-                            users_by_status = await session.scalars(
-                                select(User).where(func.lower(User.status).in_(non_admin_statuses))
-                            )
-                            users_list.extend(users_by_status.all())
-                            if "админы" in all_statuses:
-                                admin_users = await session.scalars(
-                                    select(User).where(User.tg_id.in_(map(str, config.ADMIN_IDS)))
-                                )
-                                users_list.extend(admin_users.all())
-
-                        # Убираем дубликаты пользователей по tg_id
-                        unique_users = set({u.tg_id: u for u in users_list if u.tg_id}.values())
-
-                        # Рассылка сообщений с учетом вложений, caption и caption_entities
-                        success_count = 0
-                        error_count = 0
-                        for u in unique_users:
-                            try:
-                                attachments = json.loads(mailing.file_ids)
-                                entities = None
-                                if mailing.caption_entities:
-                                    try:
-                                        entities = [MessageEntity(**entity) for entity in json.loads(mailing.caption_entities)]
-                                    except Exception as e:
-                                        logging.error(f"Ошибка парсинга caption_entities: {e}")
-                                        entities = None
-                                if attachments and len(attachments) > 1:
-                                    input_media = []
-                                    for idx, att in enumerate(attachments):
-                                        if att["type"] == "photo":
-                                            media_obj = InputMediaPhoto(
-                                                media=att["file_id"],
-                                                caption=mailing.caption if (idx == 0 and mailing.caption) else None,
-                                                caption_entities=entities if (idx == 0 and mailing.caption) else None,
-                                                parse_mode=None,
-                                            )
-                                        elif att["type"] == "document":
-                                            media_obj = InputMediaDocument(
-                                                media=att["file_id"],
-                                                caption=mailing.caption if (idx == 0 and mailing.caption) else None,
-                                                caption_entities=entities if (idx == 0 and mailing.caption) else None,
-                                                parse_mode=None,
-                                            )
-                                        elif att["type"] == "video":
-                                            media_obj = InputMediaVideo(
-                                                media=att["file_id"],
-                                                caption=mailing.caption if (idx == 0 and mailing.caption) else None,
-                                                caption_entities=entities if (idx == 0 and mailing.caption) else None,
-                                                parse_mode=None,
-                                            )
-                                        input_media.append(media_obj)
-                                    await bot.send_media_group(chat_id=u.tg_id, media=input_media)
-                                elif attachments and len(attachments) == 1:
-                                    att = attachments[0]
-                                    if att["type"] == "photo":
-                                        await bot.send_photo(
-                                            chat_id=u.tg_id,
-                                            photo=att["file_id"],
-                                            caption=mailing.caption,
-                                            caption_entities=entities,
-                                            parse_mode=None,
-                                        )
-                                    elif att["type"] == "document":
-                                        await bot.send_document(
-                                            chat_id=u.tg_id,
-                                            document=att["file_id"],
-                                            caption=mailing.caption,
-                                            caption_entities=entities,
-                                            parse_mode=None,
-                                        )
-                                    elif att["type"] == "video":
-                                        await bot.send_video(
-                                            chat_id=u.tg_id,
-                                            video=att["file_id"],
-                                            caption=mailing.caption,
-                                            caption_entities=entities,
-                                            parse_mode=None,
-                                        )
-                                else:
-                                    await bot.send_message(
-                                        chat_id=u.tg_id,
-                                        text=mailing.caption,
-                                        entities=entities,
-                                        parse_mode=None,
-                                    )
-                                success_count += 1
-                            except Exception as e:
-                                logging.warning(f"❌ Ошибка отправки пользователю {u.tg_id}: {e}")
-                                error_count += 1
-
-                        logging.info(
-                            f"📢 Рассылка '{mailing.title}' завершена: Успешно: {success_count}, Ошибок: {error_count}")
-
-                        # Если рассылка единоразовая, деактивируем её
-                        if schedule.schedule_type == "once":
-                            schedule.active = 0
-                            logging.info(f"🛑 Единоразовая рассылка '{mailing.title}' завершена и деактивирована.")
-                        else:
-                            # Пересчитываем next_run для следующего запуска
-                            schedule.next_run = compute_next_run(schedule)
-
-                        await session.commit()
-
+            await prepare_snapshots()
+
+            free_slots = config.MAX_CONCURRENT_MAILINGS - len(active_runs)
+            run_ids = []
+            if free_slots > 0:
+                run_ids = await claim_due_schedules(free_slots)
+                if len(run_ids) < free_slots:
+                    stale_runs = await claim_stale_runs(free_slots - len(run_ids))
+                    run_ids += [run.id for run in stale_runs if run.id not in active_runs]
+
+            if run_ids:
+                logging.info(f"📬 Найдено {len(run_ids)} рассылок для отправки.")
+            elif not active_runs:
+                logging.info("✅ Нет запланированных рассылок для отправки.")
+
+            for run_id in run_ids:
+                dispatch_run(bot, run_id)
+
+            if len(active_runs) >= config.MAX_CONCURRENT_MAILINGS:
+                # Все места заняты – ждём завершения одной из рассылок (on_done будит планировщик)
+                next_run = None
+            else:
+                # Спим ровно до ближайшего next_run (или до изменения расписаний)
+                next_run = await get_next_due_time()
         except Exception as e:
             logging.error(f"⚠ Ошибка в планировщике рассылок: {e}")
-            await asyncio.sleep(60)  # Если произошла ошибка, ждем минуту перед повтором
+            next_run = datetime.utcnow() + timedelta(seconds=60)  # Если произошла ошибка, ждем минуту перед повтором
+
+        await wait_for_schedule(next_run)
 
 
 async def fetch_users():
@@ -309,6 +384,7 @@ async def update_database(bot):
                     logging.info("Не удалось получить данные из API.")
                     await asyncio.sleep(60 * 5)
                     continue
+                changed_statuses = []
                 for user_data in users:
                     wp_id = user_data.get("id_user")
                     first_name = user_data.get("name_user")
@@ -326,6 +402,7 @@ async def update_database(bot):
                         updated = False
                         if user.status != status:
                             user.status = status
+                            changed_statuses.append((user.id, status))
                             updated = True
                         if user.created_at is None:
                             user.created_at = created_at
@@ -341,6 +418,8 @@ async def update_database(bot):
                             session.add(user)
 
                 await session.commit()
+                for user_id, status in changed_statuses:
+                    viewer_index.set_status(user_id, status)
                 logging.info("База данных обновлена.")
 
             except SQLAlchemyError as e:
@@ -352,49 +431,14 @@ async def update_database(bot):
         await asyncio.sleep(60 * 5)
 
 
-def compute_next_run(schedule: MailingSchedule) -> datetime:
+def compute_next_run(schedule: MailingSchedule) -> datetime | None:
     """
-    Расчёт следующего времени запуска в зависимости от типа расписания.
+    Расчёт следующего времени запуска по скомпилированному правилу расписания.
+    Запуски, пропущенные за время простоя, не догоняются: берётся первый запуск после текущего момента.
+    None – расписание больше не повторяется (единоразовое или некорректное).
     """
+    recurrence = schedule_recurrence(schedule)
+    if recurrence is None:
+        return None
     now = datetime.utcnow()
-
-    if schedule.schedule_type == "daily":
-        return schedule.next_run + timedelta(days=1)
-
-    elif schedule.schedule_type == "weekly":
-        if schedule.day_of_week:
-            days = sorted(int(d.strip()) for d in schedule.day_of_week.split(","))
-            for day in days:
-                offset = (day - 1) - schedule.next_run.weekday()
-                if offset <= 0:
-                    offset += 7
-                candidate = schedule.next_run + timedelta(days=offset)
-                if candidate > now:
-                    return candidate
-            return schedule.next_run + timedelta(days=7)
-
-    elif schedule.schedule_type == "monthly":
-        if schedule.day_of_month:
-            days = sorted(int(d.strip()) for d in schedule.day_of_month.split(","))
-            for day in days:
-                month, year = schedule.next_run.month, schedule.next_run.year
-                found_valid_date = False
-                while not found_valid_date:
-                    try:
-                        candidate = schedule.next_run.replace(day=day, month=month, year=year)
-                        if candidate > now:
-                            return candidate
-                    except ValueError:
-                        pass
-                    month += 1
-                    if month > 12:
-                        month = 1
-                        year += 1
-                    last_day_of_month = monthrange(year, month)[1]
-                    if day <= last_day_of_month:
-                        found_valid_date = True
-                        return datetime(year, month, day, schedule.next_run.hour, schedule.next_run.minute)
-
-    # Для единоразовой рассылки деактивируем расписание
-    schedule.active = 0
-    return now
+    return recurrence.next_after(max(now, schedule.next_run) if schedule.next_run else now)
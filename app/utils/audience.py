@@ -0,0 +1,154 @@
+import time
+from typing import AsyncIterator
+
+from sqlalchemy import select, func, or_, literal, union_all
+
+from app.config import config
+from app.db.models import User, Material, MaterialView, MailingStatus
+from app.utils.viewer_index import viewer_index
+
+ADMINS_STATUS = "админы"
+KEYWORD_PREFIX = "keyword:"
+AUDIENCE_CHUNK_SIZE = 1000
+
+
+def split_statuses(user_statuses: list[str]) -> tuple[list[str], list[str]]:
+    """
+    Делит MailingStatus.user_status на обычные статусы (в нижнем регистре) и ключевые слова.
+    """
+    keywords = [s.split(":", 1)[1].strip() for s in user_statuses if s.lower().startswith(KEYWORD_PREFIX)]
+    statuses = [s.lower() for s in user_statuses if not s.lower().startswith(KEYWORD_PREFIX)]
+    return statuses, keywords
+
+
+def audience_query(user_statuses: list[str]):
+    """
+    Строит один запрос SELECT DISTINCT tg_id для аудитории рассылки.
+    Если среди статусов есть ключевые слова – выбираются пользователи, смотревшие эти материалы,
+    иначе – пользователи с выбранными статусами (и администраторы для статуса "админы").
+    Недоступные пользователи (blocked_at) исключаются. Возвращает None, если аудитория пуста.
+    """
+    statuses, keywords = split_statuses(user_statuses)
+    stmt = select(User.tg_id).distinct().where(User.blocked_at.is_(None), User.tg_id.is_not(None))
+
+    if keywords:
+        return (
+            stmt.join(MaterialView, MaterialView.user_id == User.id)
+            .join(Material, Material.id == MaterialView.material_id)
+            .where(Material.keyword.in_(keywords))
+        )
+
+    conditions = []
+    non_admin_statuses = [st for st in statuses if st != ADMINS_STATUS]
+    if non_admin_statuses:
+        conditions.append(func.lower(User.status).in_(non_admin_statuses))
+    if ADMINS_STATUS in statuses and config.ADMIN_IDS:
+        conditions.append(User.tg_id.in_([str(admin_id) for admin_id in config.ADMIN_IDS]))
+    if not conditions:
+        return None
+    return stmt.where(or_(*conditions))
+
+
+async def stream_audience(session, user_statuses: list[str]) -> AsyncIterator[str]:
+    """
+    Потоково отдаёт tg_id аудитории через серверный курсор, не загружая её целиком в память.
+    Для отправки аудитория всегда берётся из БД, а не из индекса в памяти: отметки
+    недоступности, сделанные воркерами и другими экземплярами, видны в нём только после перестройки.
+    """
+    stmt = audience_query(user_statuses)
+    if stmt is None:
+        return
+    result = await session.stream_scalars(stmt.execution_options(yield_per=AUDIENCE_CHUNK_SIZE))
+    async for tg_id in result:
+        yield tg_id
+
+
+async def count_audience(session, user_statuses: list[str]) -> int:
+    """
+    Размер аудитории рассылки (тот же запрос, что и в stream_audience, но COUNT).
+    """
+    stmt = audience_query(user_statuses)
+    if stmt is None:
+        return 0
+    return await session.scalar(select(func.count()).select_from(stmt.subquery()))
+
+
+# Кэш оценок размера аудитории: ключ -> (время расчёта, значение)
+_estimate_cache: dict[tuple, tuple[float, object]] = {}
+
+
+async def cached_estimate(key: tuple, compute):
+    """
+    Значение оценки из кэша, если оно моложе AUDIENCE_ESTIMATE_TTL секунд, иначе пересчитывает его.
+    """
+    cached = _estimate_cache.get(key)
+    if cached and time.monotonic() - cached[0] < config.AUDIENCE_ESTIMATE_TTL:
+        return cached[1]
+    value = await compute()
+    _estimate_cache[key] = (time.monotonic(), value)
+    return value
+
+
+async def get_status_counts(session) -> dict[str, int]:
+    """
+    Число доступных получателей по каждому статусу (в нижнем регистре) и для "админы" – одним запросом.
+    """
+    if viewer_index.ready:
+        return viewer_index.status_counts(ADMINS_STATUS)
+
+    async def compute():
+        reachable = (User.blocked_at.is_(None), User.tg_id.is_not(None))
+        by_status = (
+            select(func.lower(User.status).label("status"), func.count(func.distinct(User.tg_id)).label("users"))
+            .where(*reachable)
+            .group_by(func.lower(User.status))
+        )
+        admins = (
+            select(literal(ADMINS_STATUS).label("status"), func.count(func.distinct(User.tg_id)).label("users"))
+            .where(*reachable, User.tg_id.in_([str(admin_id) for admin_id in config.ADMIN_IDS]))
+        )
+        result = await session.execute(union_all(by_status, admins))
+        return {status: users for status, users in result.all() if status}
+
+    return await cached_estimate(("statuses",), compute)
+
+
+async def get_keyword_counts(session) -> dict[str, int]:
+    """
+    Число доступных получателей, смотревших материал, по каждому ключевому слову – одним запросом.
+    """
+    if viewer_index.ready:
+        return viewer_index.keyword_counts()
+
+    async def compute():
+        result = await session.execute(
+            select(Material.keyword, func.count(func.distinct(User.tg_id)))
+            .join(MaterialView, MaterialView.material_id == Material.id)
+            .join(User, User.id == MaterialView.user_id)
+            .where(User.blocked_at.is_(None), User.tg_id.is_not(None))
+            .group_by(Material.keyword)
+        )
+        return dict(result.all())
+
+    return await cached_estimate(("keywords",), compute)
+
+
+async def estimate_audience(session, user_statuses: list[str]) -> int:
+    """
+    Размер выбранной аудитории для экрана выбора: по индексу в памяти, если он построен,
+    иначе COUNT DISTINCT с тем же кэшем.
+    """
+    if viewer_index.ready:
+        return viewer_index.audience_mask(*split_statuses(user_statuses), ADMINS_STATUS).bit_count()
+    key = ("audience",) + tuple(sorted(user_statuses))
+    return await cached_estimate(key, lambda: count_audience(session, user_statuses))
+
+
+async def get_mailing_statuses(session, mailing_id: int) -> list[str]:
+    """
+    Возвращает user_status всех MailingStatus рассылки.
+    """
+    result = await session.scalars(
+        select(MailingStatus.user_status).where(MailingStatus.mailing_id == mailing_id)
+    )
+    return result.all()
@@ -0,0 +1,543 @@
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import AsyncIterable, Awaitable, Callable, Iterable, Union
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError, TelegramBadRequest, \
+    TelegramForbiddenError
+from aiogram.types import MessageEntity, InputMediaPhoto, InputMediaDocument, InputMediaVideo
+
+from app.config import config
+from app.utils.delivery_log import DELIVERY_SENT, DELIVERY_FAILED, DELIVERY_UNREACHABLE, DELIVERY_REJECTED
+
+
+# Полосы приоритета исходящих запросов: чем меньше число, тем раньше выдаётся токен
+LANE_INTERACTIVE = 0  # ответы пользователям (/start, ключевые слова)
+LANE_ADMIN = 1  # администраторам и служебные запросы
+LANE_BULK = 2  # рассылки
+
+# Полоса текущей задачи (задаётся middleware апдейтов и PreparedPayload.send)
+send_lane: ContextVar[int] = ContextVar("send_lane", default=LANE_ADMIN)
+
+
+class TokenBucket:
+    """
+    Глобальный ограничитель скорости (token bucket).
+    Пополняется со скоростью rate токенов в секунду, но не больше capacity.
+    Скорость адаптивная: при flood control снижается вдвое (не ниже min_rate),
+    а при успешных запросах постепенно возвращается к target_rate.
+    Ожидающие обслуживаются по полосам приоритета (lane), внутри полосы – по очереди,
+    поэтому рассылка уступает токены, как только появляются интерактивные запросы.
+    """
+
+    def __init__(self, rate: float, capacity: float = None, min_rate: float = 1.0):
+        self.target_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters: list[tuple] = []  # куча (lane, seq, tokens, future)
+        self._seq = itertools.count()
+        self._dispatcher: asyncio.Task | None = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens: float = 1, lane: int = LANE_BULK):
+        tokens = min(tokens, self.capacity)
+        # Быстрый путь: никто не ждёт и токенов хватает
+        if not self._waiters and time.monotonic() >= self._paused_until:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (lane, next(self._seq), tokens, future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        """
+        Выдаёт токены ожидающим: всегда первому в самой приоритетной полосе.
+        """
+        while self._waiters:
+            lane, _, tokens, future = self._waiters[0]
+            if future.done():  # ожидающий отменён
+                heapq.heappop(self._waiters)
+                continue
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill()
+            if self._tokens >= tokens:
+                heapq.heappop(self._waiters)
+                self._tokens -= tokens
+                future.set_result(None)
+                continue
+            await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> bool:
+        """
+        Останавливает выдачу токенов на seconds секунд (retry_after от Telegram).
+        False – выдача уже была остановлена (429 из того же окна): пауза лишь продлевается, если нужно.
+        """
+        now = time.monotonic()
+        already_paused = now < self._paused_until
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._refill()
+        self._tokens = 0
+        return not already_paused
+
+    def set_rate(self, rate: float):
+        self._refill()
+        self.target_rate = self.rate = self.capacity = rate
+        self.min_rate = min(self.min_rate, rate)
+        self._tokens = min(self._tokens, self.capacity)
+
+    def slow_down(self):
+        self._refill()
+        self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self):
+        if self.rate < self.target_rate:
+            self._refill()
+            self.rate = min(self.target_rate, self.rate + self.target_rate / 200)
+
+
+class ChatRateLimiter:
+    """
+    Ограничение частоты сообщений в один чат (Telegram: не чаще ~1 сообщения в секунду).
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next_allowed: dict[str, float] = {}
+
+    async def acquire(self, chat_id):
+        key = str(chat_id)
+        now = time.monotonic()
+        allowed_at = max(now, self._next_allowed.get(key, now))
+        self._next_allowed[key] = allowed_at + self.interval
+        if len(self._next_allowed) > 10000:
+            # Чистим устаревшие записи, чтобы словарь не рос бесконечно
+            self._next_allowed = {k: v for k, v in self._next_allowed.items() if v > now}
+        if allowed_at > now:
+            await asyncio.sleep(allowed_at - now)
+
+
+class RateLimiter:
+    """
+    Общий для всех рассылок лимит: глобальный token bucket + лимит на чат.
+    """
+
+    def __init__(self, rate: float, chat_interval: float, min_rate: float = 1.0):
+        self.bucket = TokenBucket(rate, min_rate=min_rate)
+        self.chats = ChatRateLimiter(chat_interval)
+        self._sharing = 0  # сколько открыто блоков sharing()
+        # Общие с процессами-воркерами значения (multiprocessing.Value), см. attach()
+        self.shared_paused_until = None
+        self.shared_busy = None
+
+    def attach(self, paused_until, busy):
+        """
+        Подключает значения, общие для основного процесса и воркеров: момент окончания паузы
+        flood control (time.time()) и число запусков, которые сейчас рассылают воркеры.
+        """
+        self.shared_paused_until, self.shared_busy = paused_until, busy
+
+    def sync_pause(self):
+        """
+        Применяет паузу flood control, полученную другим процессом: лимит Telegram общий на бота.
+        """
+        if self.shared_paused_until is None:
+            return
+        remaining = self.shared_paused_until.value - time.time()
+        if remaining > 0 and self.bucket.pause(remaining):
+            self.bucket.slow_down()
+
+    async def acquire(self, chat_id, cost: float = 1, lane: int = LANE_BULK):
+        self.sync_pause()
+        await self.chats.acquire(chat_id)
+        await self.bucket.acquire(cost, lane)
+
+    def on_flood(self, retry_after: float):
+        """
+        Получен 429: ставим общий лимит на паузу (во всех процессах) и снижаем скорость.
+        Параллельные отправки получают 429 пачкой на одно и то же окно – скорость снижается
+        только один раз за окно.
+        """
+        if self.shared_paused_until is not None:
+            self.shared_paused_until.value = max(self.shared_paused_until.value, time.time() + retry_after)
+        if not self.bucket.pause(retry_after):
+            return
+        self.bucket.slow_down()
+        logging.warning(f"⏳ Flood control: пауза {retry_after} с, скорость снижена до {self.bucket.rate:.1f} сообщ./с")
+
+    def on_success(self):
+        self.bucket.speed_up()
+
+    def share(self, parts: int):
+        """
+        Делит общий лимит BROADCAST_RATE между parts процессами: каждому достаётся равная доля.
+        """
+        self.bucket.set_rate(config.BROADCAST_RATE / parts)
+
+    @contextmanager
+    def sharing(self, parts: int):
+        """
+        На время блока процессу достаётся только доля 1/parts общего лимита (остальное отправляют
+        процессы-воркеры); когда последний такой блок закрыт, процессу снова доступен весь лимит.
+        """
+        self._sharing += 1
+        if self.shared_busy is not None:
+            self.shared_busy.value = self._sharing
+        self.share(parts)
+        try:
+            yield
+        finally:
+            self._sharing -= 1
+            if self.shared_busy is not None:
+                self.shared_busy.value = self._sharing
+            if not self._sharing:
+                self.share(1)
+
+
+rate_limiter = RateLimiter(config.BROADCAST_RATE, config.BROADCAST_CHAT_INTERVAL, config.BROADCAST_MIN_RATE)
+
+RETRYABLE_ERRORS = (TelegramRetryAfter, TelegramNetworkError, TelegramServerError, asyncio.TimeoutError)
+
+
+def retry_delay(error: Exception, attempt: int):
+    """
+    Задержка перед повтором отправки или None, если ошибка постоянная либо попытки исчерпаны.
+    """
+    if attempt >= config.BROADCAST_MAX_RETRIES or not isinstance(error, RETRYABLE_ERRORS):
+        return None
+    if isinstance(error, TelegramRetryAfter):
+        return error.retry_after
+    return min(config.BROADCAST_RETRY_CAP, config.BROADCAST_RETRY_BASE * 2 ** attempt)
+
+
+UNREACHABLE_BAD_REQUESTS = ("chat not found", "user is deactivated", "peer_id_invalid")
+
+
+def is_unreachable_error(error: Exception) -> bool:
+    """
+    Ошибка означает, что пользователь недоступен: заблокировал бота или удалил аккаунт.
+    """
+    if isinstance(error, TelegramForbiddenError):
+        return True
+    if isinstance(error, TelegramBadRequest):
+        return any(reason in error.message.lower() for reason in UNREACHABLE_BAD_REQUESTS)
+    return False
+
+
+@dataclass
+class DeliveryStats:
+    success: int = 0
+    errors: int = 0
+    permanent_errors: int = 0  # ошибки, которые не исправит повтор
+    unreachable: int = 0  # из них – недоступные получатели (бот заблокирован, чат не найден и т.п.)
+    retries: int = 0
+    failed: dict[str, str] = field(default_factory=dict)  # tg_id -> текст ошибки
+    permanent: set[str] = field(default_factory=set)  # tg_id с постоянной ошибкой
+
+    def merge(self, other: "DeliveryStats"):
+        self.success += other.success
+        self.errors += other.errors
+        self.permanent_errors += other.permanent_errors
+        self.unreachable += other.unreachable
+        self.retries += other.retries
+
+
+SendFunc = Callable[[Bot, str], Awaitable[None]]
+ChatIds = Union[Iterable[str], AsyncIterable[str]]
+
+
+async def iterate(items: ChatIds):
+    """
+    Единый async-перебор для обычных и асинхронных (потоковых) последовательностей.
+    """
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+class DeliveryEngine:
+    """
+    Движок доставки рассылок: ограниченный пул параллельных отправителей.
+    Каждый получатель целиком обрабатывается одним воркером, поэтому
+    порядок сообщений (медиа‑группа, затем текст) для него сохраняется.
+    Временные ошибки (429, сеть, 5xx) попадают в отложенную очередь повторов
+    с экспоненциальной задержкой, постоянные учитываются отдельно.
+    """
+
+    def __init__(self, bot: Bot, concurrency: int = None):
+        self.bot = bot
+        self.concurrency = concurrency or config.BROADCAST_CONCURRENCY
+
+    async def run(self, chat_ids: ChatIds, send: SendFunc, progress=None, log=None) -> DeliveryStats:
+        """
+        Рассылает send всем chat_ids. Если передан progress (BroadcastProgress),
+        его счётчики sent/failed обновляются по мере отправки, а в log (DeliveryLogWriter)
+        записывается итог по каждому получателю.
+        """
+        stats = DeliveryStats()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        retry_tasks = set()
+        all_done = asyncio.Event()
+        outstanding = 0
+        feeding = True
+
+        def finish():
+            nonlocal outstanding
+            outstanding -= 1
+            if not feeding and outstanding == 0:
+                all_done.set()
+
+        async def requeue(chat_id, attempt, delay):
+            await asyncio.sleep(delay)
+            await queue.put((chat_id, attempt))
+
+        async def worker():
+            while True:
+                chat_id, attempt = await queue.get()
+                try:
+                    await send(self.bot, chat_id)
+                    stats.success += 1
+                    if progress:
+                        progress.sent += 1
+                    if log:
+                        log.add(chat_id, DELIVERY_SENT)
+                    finish()
+                except Exception as e:
+                    delay = retry_delay(e, attempt)
+                    if delay is not None:
+                        stats.retries += 1
+                        task = asyncio.create_task(requeue(chat_id, attempt + 1, delay))
+                        retry_tasks.add(task)
+                        task.add_done_callback(retry_tasks.discard)
+                    else:
+                        logging.warning(f"❌ Ошибка отправки пользователю {chat_id}: {e}")
+                        stats.errors += 1
+                        stats.failed[chat_id] = str(e)
+                        if progress:
+                            progress.failed += 1
+                        if isinstance(e, RETRYABLE_ERRORS):
+                            status = DELIVERY_FAILED
+                        else:
+                            stats.permanent_errors += 1
+                            stats.permanent.add(chat_id)
+                            if is_unreachable_error(e):
+                                stats.unreachable += 1
+                                status = DELIVERY_UNREACHABLE
+                            else:
+                                status = DELIVERY_REJECTED
+                        if log:
+                            log.add(chat_id, status, e)
+                        finish()
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            async for chat_id in iterate(chat_ids):
+                outstanding += 1
+                await queue.put((chat_id, 0))
+            feeding = False
+            if outstanding == 0:
+                all_done.set()
+            await all_done.wait()
+        finally:
+            for task in workers + list(retry_tasks):
+                task.cancel()
+        return stats
+
+
+# Ошибки Telegram, означающие, что исходное сообщение рассылки удалено
+MISSING_SOURCE_ERRORS = ("message to copy not found", "message to forward not found", "message_id_invalid")
+
+# Исходные сообщения (chat_id, message_ids), которые больше нельзя скопировать
+_missing_sources: set[tuple] = set()
+
+
+# Ошибки copy/forward, которые могут относиться как к получателю, так и к исходному чату (from_chat_id)
+SOURCE_CHAT_ERRORS = ("chat not found", "peer_id_invalid")
+
+
+def is_missing_source_error(error: Exception) -> bool:
+    return isinstance(error, TelegramBadRequest) and any(
+        reason in error.message.lower() for reason in MISSING_SOURCE_ERRORS
+    )
+
+
+def is_source_chat_error(error: Exception) -> bool:
+    return isinstance(error, TelegramBadRequest) and any(
+        reason in error.message.lower() for reason in SOURCE_CHAT_ERRORS
+    )
+
+
+@dataclass(frozen=True)
+class PreparedPayload:
+    """
+    Скомпилированное содержимое рассылки: вложения, caption и caption_entities
+    разбираются один раз на запуск и переиспользуются для всех получателей.
+    В режиме copy/forward (BROADCAST_SEND_MODE) сообщение копируется из сохранённого
+    исходного чата одним запросом на весь альбом; если исходное сообщение удалено
+    или исходный чат недоступен, отправка автоматически переключается на сборку из file_ids.
+    """
+    kind: str  # text, photo, document, video, media_group
+    caption: str = None
+    entities: tuple = None
+    file_id: str = None
+    media: tuple = ()
+    source_chat_id: str = None
+    source_message_ids: tuple = ()
+    mode: str = "send"  # send, copy, forward
+
+    @property
+    def cost(self) -> int:
+        # Медиа‑группа расходует лимит Telegram как несколько сообщений
+        return len(self.media) if self.kind == "media_group" else 1
+
+    @property
+    def source(self) -> tuple | None:
+        if self.mode in ("copy", "forward") and self.source_chat_id and self.source_message_ids:
+            return self.source_chat_id, self.source_message_ids
+        return None
+
+    async def send(self, bot: Bot, chat_id: str):
+        """
+        Отправляет содержимое одному получателю, предварительно взяв токен из общего лимита.
+        """
+        # Запросы рассылки идут в полосе bulk и уже оплачены токенами здесь
+        send_lane.set(LANE_BULK)
+        source = self.source
+        if source and source not in _missing_sources:
+            await rate_limiter.acquire(chat_id, cost=len(self.source_message_ids))
+            try:
+                if self.mode == "copy":
+                    await bot.copy_messages(chat_id=chat_id, from_chat_id=self.source_chat_id,
+                                            message_ids=list(self.source_message_ids))
+                else:
+                    await bot.forward_messages(chat_id=chat_id, from_chat_id=self.source_chat_id,
+                                               message_ids=list(self.source_message_ids))
+                return
+            except TelegramBadRequest as e:
+                if is_source_chat_error(e):
+                    # "chat not found" не говорит, чей это чат: проверяем отправкой из file_ids.
+                    # Если не найден получатель, ошибка повторится и уйдёт наверх как обычно
+                    await self.send_built(bot, chat_id)
+                    _missing_sources.add(source)
+                    logging.warning(f"Исходный чат рассылки {source} недоступен ({e}), отправляем из file_ids.")
+                    return
+                if not is_missing_source_error(e):
+                    raise
+                _missing_sources.add(source)
+                logging.warning(f"Исходное сообщение рассылки {source} недоступно ({e}), отправляем из file_ids.")
+
+        await self.send_built(bot, chat_id)
+
+    async def send_built(self, bot: Bot, chat_id: str):
+        """
+        Отправка, собранная из file_ids, caption и caption_entities (без исходного сообщения).
+        """
+        await rate_limiter.acquire(chat_id, cost=self.cost)
+        entities = list(self.entities) if self.entities else None
+        if self.kind == "media_group":
+            await bot.send_media_group(chat_id=chat_id, media=list(self.media))
+        elif self.kind == "photo":
+            await bot.send_photo(chat_id=chat_id, photo=self.file_id, caption=self.caption,
+                                 caption_entities=entities, parse_mode=None)
+        elif self.kind == "document":
+            await bot.send_document(chat_id=chat_id, document=self.file_id, caption=self.caption,
+                                    caption_entities=entities, parse_mode=None)
+        elif self.kind == "video":
+            await bot.send_video(chat_id=chat_id, video=self.file_id, caption=self.caption,
+                                 caption_entities=entities, parse_mode=None)
+        else:
+            await bot.send_message(chat_id=chat_id, text=self.caption, entities=entities, parse_mode=None)
+
+
+MEDIA_TYPES = {"photo": InputMediaPhoto, "document": InputMediaDocument, "video": InputMediaVideo}
+
+
+def parse_message_ids(saved_message_id: str) -> tuple:
+    """
+    saved_message_id хранится строкой через запятую (для альбомов); copy_messages требует возрастающий порядок.
+    """
+    if not saved_message_id:
+        return ()
+    return tuple(sorted(int(mid) for mid in saved_message_id.split(",") if mid.strip().isdigit()))
+
+
+def prepare_payload(file_ids: str, caption: str, caption_entities: str,
+                    saved_chat_id: str = None, saved_message_id: str = None) -> PreparedPayload:
+    """
+    Разбирает поля рассылки (file_ids, caption, caption_entities) в PreparedPayload.
+    saved_chat_id/saved_message_id – исходное сообщение для режимов copy/forward.
+    """
+    source = dict(
+        source_chat_id=saved_chat_id,
+        source_message_ids=parse_message_ids(saved_message_id),
+        mode=config.BROADCAST_SEND_MODE,
+    )
+    attachments = json.loads(file_ids) if file_ids else []
+    entities = None
+    if caption_entities:
+        try:
+            entities = tuple(MessageEntity(**entity) for entity in json.loads(caption_entities))
+        except Exception as e:
+            logging.error(f"Ошибка парсинга caption_entities: {e}")
+            entities = None
+
+    attachments = [att for att in attachments if att.get("type") in MEDIA_TYPES]
+    if len(attachments) > 1:
+        media = tuple(
+            MEDIA_TYPES[att["type"]](
+                media=att["file_id"],
+                caption=caption if (idx == 0 and caption) else None,
+                caption_entities=list(entities) if (idx == 0 and caption and entities) else None,
+                parse_mode=None,
+            )
+            for idx, att in enumerate(attachments)
+        )
+        return PreparedPayload(kind="media_group", caption=caption, entities=entities, media=media, **source)
+    if attachments:
+        att = attachments[0]
+        return PreparedPayload(kind=att["type"], caption=caption, entities=entities, file_id=att["file_id"], **source)
+    return PreparedPayload(kind="text", caption=caption, entities=entities, **source)
+
+
+_payload_cache: dict[int, tuple] = {}
+
+
+def get_mailing_payload(mailing) -> PreparedPayload:
+    """
+    Возвращает PreparedPayload рассылки из кэша.
+    Ключ кэша – id рассылки и её версия (updated_at, либо created_at, если рассылку не редактировали).
+    """
+    version = mailing.updated_at or mailing.created_at
+    cached = _payload_cache.get(mailing.id)
+    if cached and cached[0] == version:
+        return cached[1]
+    payload = prepare_payload(mailing.file_ids, mailing.caption, mailing.caption_entities,
+                              mailing.saved_chat_id, mailing.saved_message_id)
+    _payload_cache[mailing.id] = (version, payload)
+    return payload
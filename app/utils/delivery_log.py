@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from datetime import datetime
+
+from sqlalchemy import select, func
+
+from app.config import config
+from app.db.db import engine, AsyncSessionLocal
+from app.db.models import DeliveryLog
+
+# Коды статуса в журнале доставки
+DELIVERY_SENT = 0
+DELIVERY_FAILED = 1  # временная ошибка, попытки исчерпаны
+DELIVERY_UNREACHABLE = 2  # получатель недоступен: бот заблокирован, чат не найден, аккаунт удалён
+DELIVERY_REJECTED = 3  # прочие постоянные ошибки (запрос отклонён Telegram, повтор не поможет)
+
+LOG_COLUMNS = ["mailing_id", "schedule_id", "run_id", "tg_id", "status", "error_class", "created_at"]
+
+
+async def copy_delivery_log(records: list[tuple]):
+    """
+    Записывает пачку строк журнала одним COPY (asyncpg copy_records_to_table).
+    """
+    async with engine.connect() as conn:
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table(
+            DeliveryLog.__tablename__, records=records, columns=LOG_COLUMNS
+        )
+
+
+class DeliveryLogWriter:
+    """
+    Буфер журнала доставки одного запуска: результаты копятся в памяти и пишутся
+    в фоне пачками по DELIVERY_LOG_BATCH_SIZE строк, не задерживая отправку.
+    """
+
+    def __init__(self, mailing_id: int = None, schedule_id: int = None, run_id: int = None):
+        self.mailing_id = mailing_id
+        self.schedule_id = schedule_id
+        self.run_id = run_id
+        self._buffer: list[tuple] = []
+        self._flushes: set[asyncio.Task] = set()
+
+    def add(self, tg_id, status: int, error: Exception = None):
+        self._buffer.append((
+            self.mailing_id, self.schedule_id, self.run_id, str(tg_id), status,
+            type(error).__name__[:64] if error else None, datetime.utcnow()
+        ))
+        if len(self._buffer) >= config.DELIVERY_LOG_BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        records, self._buffer = self._buffer, []
+        task = asyncio.create_task(self._write(records))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _write(self, records: list[tuple]):
+        try:
+            await copy_delivery_log(records)
+        except Exception as e:
+            logging.error(f"Не удалось записать журнал доставки ({len(records)} строк): {e}")
+
+    async def close(self):
+        if self._buffer:
+            self._flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+async def get_delivery_summary(session, mailing_id: int) -> list:
+    """
+    Итоги журнала доставки рассылки по запускам: строки (run_id, status, count, last_at).
+    """
+    result = await session.execute(
+        select(
+            DeliveryLog.run_id,
+            DeliveryLog.status,
+            func.count(DeliveryLog.id),
+            func.max(DeliveryLog.created_at)
+        )
+        .where(DeliveryLog.mailing_id == mailing_id)
+        .group_by(DeliveryLog.run_id, DeliveryLog.status)
+        .order_by(DeliveryLog.run_id, DeliveryLog.status)
+    )
+    return result.all()
+
+
+async def get_run_outcomes(run_id: int) -> dict[int, int]:
+    """
+    Число записей журнала доставки запуска по статусам (DELIVERY_*).
+    """
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(DeliveryLog.status, func.count(DeliveryLog.id))
+            .where(DeliveryLog.run_id == run_id)
+            .group_by(DeliveryLog.status)
+        )
+        return dict(result.all())
@@ -1,25 +1,29 @@
 import logging
 import secrets
+import time
 import csv
 from datetime import datetime, timedelta
 
 from aiogram import Bot
 from aiogram.client.default import DefaultBotProperties
-from sqlalchemy import func, select
-from sqlalchemy import select, func
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from aiogram.methods import CopyMessage, CopyMessages, ForwardMessage, ForwardMessages
+from sqlalchemy import func, select, update
 import pandas as pd
-from sqlalchemy import select
-from app.db.models import User, MaterialView, Material, MailingStatus
-from datetime import datetime
-
 
 from app.config import config
-from app.db.models import User, KeywordLink, Material, MaterialView
+from app.db.db import AsyncSessionLocal
+from app.db.models import User, KeywordLink, Material, MaterialView, MailingStatus
+from app.utils.delivery import rate_limiter, send_lane, LANE_BULK, is_unreachable_error, is_source_chat_error
+from app.utils.viewer_index import viewer_index
+from app.utils.perf import record_api_call
 
 
 async def get_or_create_user(session, tg_user, wp_id: str = "не зарегистрирован"):
     """
-    Получает или создает пользователя в БД.
+    Получает или создает пользователя в БД. Изменения не коммитит – это делает вызывающий
+    (в обработчиках – DbSessionMiddleware).
     """
     user = await session.execute(select(User).where(User.tg_id == str(tg_user.id)))
     user = user.scalar_one_or_none()
@@ -35,12 +39,11 @@ async def get_or_create_user(session, tg_user, wp_id: str = "не зарегис
             created_at=datetime.utcnow()
         )
         session.add(user)
-        await session.commit()  # Фиксируем изменения в БД
-        await session.refresh(user)  # Загружаем user с обновленным ID
+        await session.flush()  # Получаем ID пользователя
+        viewer_index.add_user(user.id, user.tg_id, user.status)
 
     elif wp_id and not user.wp_id:
         user.wp_id = wp_id
-        await session.commit()  # Сохраняем изменения, если обновили wp_id
 
     return user
 
@@ -72,8 +75,7 @@ async def generate_link_for_material(session, material, keyword, expire_in_days,
         )
         session.add(link_obj)
 
-    await session.commit()
-    await session.refresh(link_obj)
+    await session.flush()
     return link_obj
 
 
@@ -329,3 +331,110 @@ async def get_day_of_week_names(number):
 
 bot = Bot(token=config.BOT_TOKEN, default=DefaultBotProperties(parse_mode='HTML'))
 
+
+async def mark_user_unreachable(tg_id):
+    """
+    Помечает пользователя недоступным и увеличивает счётчик неудачных доставок.
+    """
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            update(User)
+            .where(User.tg_id == str(tg_id))
+            .values(
+                blocked_at=func.coalesce(User.blocked_at, datetime.utcnow()),
+                delivery_failures=User.delivery_failures + 1
+            )
+        )
+        await session.commit()
+    viewer_index.set_reachable(tg_id, False)
+
+
+async def mark_user_reachable(tg_id, session=None):
+    """
+    Снимает отметку недоступности (пользователь снова написал боту).
+    С переданной сессией апдейта UPDATE выполняется в ней и сразу коммитится: соединение
+    возвращается в пул и не простаивает в транзакции, пока обработчик ждёт Telegram.
+    Без сессии – открывает свою. Почти всегда blocked_at уже пуст, и UPDATE по частичному
+    индексу ix_users_blocked_at не находит строк.
+    """
+    stmt = (
+        update(User)
+        .where(User.tg_id == str(tg_id), User.blocked_at.is_not(None))
+        .values(blocked_at=None, delivery_failures=0)
+        .execution_options(synchronize_session=False)
+    )
+    if session is not None:
+        await session.execute(stmt)
+        await session.commit()
+    else:
+        async with AsyncSessionLocal() as own_session:
+            await own_session.execute(stmt)
+            await own_session.commit()
+    viewer_index.set_reachable(tg_id, True)
+
+
+# Методы, ошибки которых могут относиться к исходному чату (from_chat_id)
+SOURCE_CHAT_METHODS = (CopyMessage, CopyMessages, ForwardMessage, ForwardMessages)
+
+
+class FloodControlMiddleware(BaseRequestMiddleware):
+    """
+    Слой отправки вокруг общего bot: на TelegramRetryAfter ставит общий лимит
+    скорости на паузу retry_after и снижает его, пока 429 продолжаются;
+    успешные запросы постепенно возвращают скорость к заданной.
+    """
+
+    async def __call__(self, make_request, bot, method):
+        try:
+            response = await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            rate_limiter.on_flood(e.retry_after)
+            raise
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Любой путь отправки: недоступных пользователей исключаем из будущих рассылок
+            chat_id = getattr(method, "chat_id", None)
+            # В copy/forward "chat not found" может относиться к from_chat_id, а не к получателю:
+            # PreparedPayload.send повторит отправку из file_ids, и её ошибка уже однозначна
+            if isinstance(method, SOURCE_CHAT_METHODS) and is_source_chat_error(e):
+                chat_id = None
+            if chat_id is not None and is_unreachable_error(e):
+                try:
+                    await mark_user_unreachable(chat_id)
+                except Exception as db_error:
+                    logging.error(f"Не удалось отметить пользователя {chat_id} недоступным: {db_error}")
+            raise
+        rate_limiter.on_success()
+        return response
+
+
+class PriorityLaneMiddleware(BaseRequestMiddleware):
+    """
+    Все исходящие запросы в чаты проходят через общий лимит скорости в полосе send_lane.
+    Запросы рассылок (полоса bulk) уже оплачены в PreparedPayload.send, поэтому здесь
+    пропускаются; интерактивные и админские получают токены раньше рассылок.
+    """
+
+    async def __call__(self, make_request, bot, method):
+        lane = send_lane.get()
+        if lane != LANE_BULK and getattr(method, "chat_id", None) is not None:
+            rate_limiter.sync_pause()
+            await rate_limiter.bucket.acquire(1, lane)
+        return await make_request(bot, method)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """
+    Длительность вызовов Telegram API по методам и их число за апдейт (app/utils/perf.py).
+    """
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            record_api_call(type(method).__name__, time.perf_counter() - started)
+
+
+bot.session.middleware(PriorityLaneMiddleware())
+bot.session.middleware(FloodControlMiddleware())
+bot.session.middleware(ApiMetricsMiddleware())  # последним: время самого запроса, без ожидания лимита скорости
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import update, values, column, String, DateTime
+
+from app.config import config
+from app.db.db import AsyncSessionLocal
+from app.db.models import User
+
+FLUSH_CHUNK_SIZE = 5000  # строк в одном UPDATE (по 2 параметра на строку)
+
+
+class LastVisitBuffer:
+    """
+    Отложенная запись last_interaction: касания копятся в памяти (одно значение на tg_id)
+    и раз в LAST_VISIT_FLUSH_INTERVAL секунд пишутся одним UPDATE ... FROM (VALUES ...).
+    Повторные касания чаще LAST_VISIT_RESOLUTION секунд не записываются вовсе.
+    """
+
+    def __init__(self):
+        self.pending: dict[str, datetime] = {}
+        self.written: dict[str, datetime] = {}
+        self._lock = asyncio.Lock()
+
+    def touch(self, tg_id):
+        now = datetime.utcnow()
+        tg_id = str(tg_id)
+        last = self.written.get(tg_id)
+        if last and now - last < timedelta(seconds=config.LAST_VISIT_RESOLUTION):
+            return
+        self.pending[tg_id] = now
+        self.written[tg_id] = now
+
+    async def flush(self):
+        """
+        Записывает накопленные касания. При ошибке возвращает их в буфер (более свежие не затираются).
+        """
+        async with self._lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, {}
+            rows = list(batch.items())
+            # Касания старше LAST_VISIT_RESOLUTION больше не подавляют запись – забываем их
+            cutoff = datetime.utcnow() - timedelta(seconds=config.LAST_VISIT_RESOLUTION)
+            self.written = {tg_id: ts for tg_id, ts in self.written.items() if ts > cutoff}
+            try:
+                async with AsyncSessionLocal() as session:
+                    for start in range(0, len(rows), FLUSH_CHUNK_SIZE):
+                        touched = values(
+                            column("tg_id", String), column("ts", DateTime), name="touched"
+                        ).data(rows[start:start + FLUSH_CHUNK_SIZE])
+                        await session.execute(
+                            update(User)
+                            .where(User.tg_id == touched.c.tg_id)
+                            .values(last_interaction=touched.c.ts)
+                            .execution_options(synchronize_session=False)
+                        )
+                    await session.commit()
+            except Exception as e:
+                logging.error(f"❌ Не удалось записать last_interaction ({len(rows)} польз.): {e}")
+                for tg_id, ts in rows:
+                    self.pending.setdefault(tg_id, ts)
+
+    async def run(self):
+        """
+        Фоновый цикл сброса буфера.
+        """
+        while True:
+            await asyncio.sleep(config.LAST_VISIT_FLUSH_INTERVAL)
+            await self.flush()
+
+    async def close(self):
+        """
+        Последний сброс при остановке бота.
+        """
+        await self.flush()
+        logging.info("💾 Буфер last_interaction сброшен в БД")
+
+
+last_visit = LastVisitBuffer()
@@ -0,0 +1,574 @@
+import asyncio
+import hashlib
+import logging
+import os
+import socket
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+from sqlalchemy import select, update, delete, or_, func, cast, BigInteger
+from sqlalchemy.dialects.postgresql import insert
+
+from app.config import config
+from app.db.db import AsyncSessionLocal
+from app.db.models import Mailing, MailingRun, MailingDelivery, MailingSchedule
+from app.utils.delivery import DeliveryEngine, DeliveryStats, SendFunc, ChatIds, iterate, rate_limiter
+from app.utils.progress import BroadcastProgress, ReportFunc, active_progress, track_progress
+from app.utils.delivery_log import (
+    DeliveryLogWriter, get_run_outcomes, DELIVERY_SENT, DELIVERY_UNREACHABLE, DELIVERY_REJECTED
+)
+
+INSERT_CHUNK_SIZE = 1000
+# Результаты доставок пишутся в outbox не реже чем раз в RESULT_FLUSH_SECONDS или каждые RESULT_FLUSH_SIZE строк:
+# при падении процесса посреди пачки повторно уйдут только ещё не записанные
+RESULT_FLUSH_SIZE = 50
+RESULT_FLUSH_SECONDS = 1.0
+# Как долго максимум спать между проверками статуса запуска (пауза/отмена) в растянутой рассылке
+CONTROL_CHECK_SECONDS = 5
+
+# Идентификатор процесса-владельца аренды запусков
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Запуски, которые сейчас отправляет этот процесс (планировщик и обработчики "Отправить сейчас"):
+# run_id -> задача. Планировщик не берёт их повторно, даже если аренда успела истечь
+active_runs: dict[int, asyncio.Task] = {}
+
+# Событие «расписания изменились»: будит планировщик рассылок раньше срока
+schedule_changed = asyncio.Event()
+
+
+def notify_scheduler():
+    """
+    Будит планировщик рассылок после создания или изменения расписания
+    и после завершения запуска (освободилось место в MAX_CONCURRENT_MAILINGS).
+    """
+    schedule_changed.set()
+
+
+def lease_deadline() -> datetime:
+    return datetime.utcnow() + timedelta(seconds=config.BROADCAST_LEASE_SECONDS)
+
+
+def heartbeat_interval() -> float:
+    # Аренда продлевается трижды за срок: одна пропущенная отметка ещё не отдаёт запуск другому процессу
+    return config.BROADCAST_LEASE_SECONDS / 3
+
+
+def audience_key(user_statuses: list[str]) -> str:
+    """
+    Отпечаток определения аудитории (статусы/ключевые слова рассылки): по нему видно,
+    что снимок аудитории в outbox устарел.
+    """
+    return hashlib.sha1("\n".join(sorted(user_statuses)).encode()).hexdigest()
+
+
+async def get_or_create_run(session, mailing_id: int, schedule_id: int = None,
+                            scheduled_for: datetime = None, status: str = "running") -> MailingRun:
+    """
+    Находит запуск расписания по (schedule_id, scheduled_for) или создаёт новый.
+    status="running" – запуск сразу арендуется текущим процессом (заранее подготовленный
+    запуск переводится в running), status="prepared" – только снимок аудитории. Изменения не коммитит.
+    """
+    run = None
+    if schedule_id is not None:
+        run = await session.scalar(
+            select(MailingRun).where(
+                MailingRun.schedule_id == schedule_id,
+                MailingRun.scheduled_for == scheduled_for
+            )
+        )
+    if run is None:
+        run = MailingRun(
+            mailing_id=mailing_id,
+            schedule_id=schedule_id,
+            scheduled_for=scheduled_for,
+            status=status,
+            started_at=datetime.utcnow()
+        )
+        session.add(run)
+    elif run.status == "prepared" and status == "running":
+        # Аудитория подготовлена заранее – отправка начинается сейчас
+        run.status = "running"
+        run.started_at = datetime.utcnow()
+    if run.status == "running":
+        run.owner = INSTANCE_ID
+        run.lease_until = lease_deadline()
+    await session.flush()
+    return run
+
+
+def delivery_window(start: datetime, spread_minutes: int) -> tuple[datetime, int] | None:
+    """
+    Окно растянутой рассылки (начало, длительность в секундах) или None, если рассылка не растянута.
+    """
+    if not start or not spread_minutes:
+        return None
+    return start, spread_minutes * 60
+
+
+def delivery_slot(tg_id: str, window: tuple[datetime, int]) -> datetime:
+    """
+    Детерминированный слот получателя в окне: один и тот же пользователь всегда получает
+    рассылку с одним и тем же смещением от начала окна.
+    """
+    start, seconds = window
+    return start + timedelta(seconds=zlib.crc32(str(tg_id).encode()) % seconds)
+
+
+async def fill_run(run_id: int, tg_ids: ChatIds, key: str = None, replace: bool = False,
+                   window: tuple[datetime, int] = None):
+    """
+    Пачками записывает аудиторию запуска в outbox (повторная запись не создаёт дублей).
+    key – отпечаток определения аудитории (audience_key); replace – сначала удалить
+    ещё не отправленные строки устаревшего снимка; window – окно растянутой рассылки
+    (каждой строке назначается not_before).
+    """
+    async with AsyncSessionLocal() as session:
+        if replace:
+            await session.execute(
+                delete(MailingDelivery)
+                .where(MailingDelivery.run_id == run_id, MailingDelivery.status == "pending")
+            )
+        # Аудитория может быть потоковой: пишем её пачками, не собирая в память целиком
+        chunk = []
+        async for tg_id in iterate(tg_ids):
+            chunk.append({
+                "run_id": run_id, "tg_id": tg_id, "status": "pending",
+                "not_before": delivery_slot(tg_id, window) if window else None
+            })
+            if len(chunk) >= INSERT_CHUNK_SIZE:
+                await _insert_deliveries(session, chunk)
+                chunk = []
+        if chunk:
+            await _insert_deliveries(session, chunk)
+        await session.execute(
+            update(MailingRun)
+            .where(MailingRun.id == run_id)
+            .values(audience_loaded_at=datetime.utcnow(), audience_key=key)
+        )
+        await session.commit()
+
+
+async def _insert_deliveries(session, rows: list[dict]):
+    await session.execute(
+        insert(MailingDelivery)
+        .values(rows)
+        .on_conflict_do_nothing(index_elements=["run_id", "tg_id"])
+    )
+
+
+async def start_run(mailing_id: int, tg_ids: ChatIds, schedule_id: int = None,
+                    scheduled_for: datetime = None, key: str = None) -> MailingRun:
+    """
+    Создаёт (или находит уже начатый) запуск рассылки и записывает аудиторию в outbox.
+    """
+    async with AsyncSessionLocal() as session:
+        run = await get_or_create_run(session, mailing_id, schedule_id, scheduled_for)
+        await session.commit()
+    if run.status != "done":
+        await fill_run(run.id, tg_ids, key)
+    return run
+
+
+async def renew_lease(run_id: int) -> bool:
+    """
+    Продлевает аренду запуска. False – запуск перехвачен другим процессом, приостановлен,
+    отменён или уже завершён.
+    """
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            update(MailingRun)
+            .where(MailingRun.id == run_id, MailingRun.owner == INSTANCE_ID, MailingRun.status == "running")
+            .values(lease_until=lease_deadline())
+        )
+        await session.commit()
+        return result.rowcount > 0
+
+
+def partition_filter(partition: tuple[int, int]):
+    """
+    Условие "получатель попадает в раздел index из count" – хэш tg_id по модулю числа процессов.
+    """
+    index, count = partition
+    return func.abs(cast(func.hashtext(MailingDelivery.tg_id), BigInteger)) % count == index
+
+
+async def claim_batch(run_id: int, partition: tuple[int, int] = None) -> list:
+    """
+    Забирает пачку готовых к отправке доставок: строки переводятся в sending одним UPDATE
+    по подзапросу FOR UPDATE SKIP LOCKED, поэтому одна строка достаётся только одному отправителю.
+    """
+    claimable = (
+        select(MailingDelivery.id)
+        .where(
+            MailingDelivery.run_id == run_id,
+            MailingDelivery.status == "pending",
+            or_(MailingDelivery.not_before.is_(None), MailingDelivery.not_before <= datetime.utcnow())
+        )
+        .order_by(MailingDelivery.id)
+        .limit(config.BROADCAST_BATCH_SIZE)
+        .with_for_update(skip_locked=True)
+    )
+    if partition:
+        claimable = claimable.where(partition_filter(partition))
+    async with AsyncSessionLocal() as session:
+        rows = (await session.execute(
+            update(MailingDelivery)
+            .where(MailingDelivery.id.in_(claimable.scalar_subquery()))
+            .values(status="sending", updated_at=datetime.utcnow())
+            .returning(MailingDelivery.id, MailingDelivery.tg_id)
+            .execution_options(synchronize_session=False)
+        )).all()
+        await session.commit()
+    return sorted(rows, key=lambda row: row.id)
+
+
+async def keep_claim(run_id: int, delivery_ids: list[int], lease: bool):
+    """
+    Пульс на время отправки пачки: обновляет updated_at забранных строк (release_stale_deliveries
+    их не вернёт) и, если lease, продлевает аренду запуска, сколько бы ни шла пачка.
+    """
+    while True:
+        await asyncio.sleep(heartbeat_interval())
+        try:
+            async with AsyncSessionLocal() as session:
+                await session.execute(
+                    update(MailingDelivery)
+                    .where(MailingDelivery.id.in_(delivery_ids), MailingDelivery.status == "sending")
+                    .values(updated_at=datetime.utcnow())
+                    .execution_options(synchronize_session=False)
+                )
+                await session.commit()
+            if lease:
+                await renew_lease(run_id)
+        except Exception as e:
+            logging.error(f"Не удалось продлить аренду запуска run_id={run_id}: {e}")
+
+
+async def release_stale_deliveries(run_id: int) -> int:
+    """
+    Возвращает в pending строки, забранные отправителем, который перестал подавать пульс
+    (процесс упал посреди пачки). Возвращает число таких строк.
+    """
+    deadline = datetime.utcnow() - timedelta(seconds=config.BROADCAST_LEASE_SECONDS)
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            update(MailingDelivery)
+            .where(
+                MailingDelivery.run_id == run_id,
+                MailingDelivery.status == "sending",
+                MailingDelivery.updated_at < deadline
+            )
+            .values(status="pending", updated_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+    if result.rowcount:
+        logging.warning(f"♻️ Запуск run_id={run_id}: {result.rowcount} доставок прерванной пачки возвращены в очередь")
+    return result.rowcount
+
+
+class DeliveryResults:
+    """
+    Итоги доставок пачки: по мере отправки переводят строки outbox из sending в sent/failed
+    небольшими порциями (не дожидаясь конца пачки) и передаются дальше в журнал доставки.
+    Передаётся в DeliveryEngine.run вместо DeliveryLogWriter.
+    """
+
+    def __init__(self, row_ids: dict[str, int], log: DeliveryLogWriter = None):
+        self.row_ids = row_ids  # tg_id -> MailingDelivery.id
+        self.log = log
+        self._sent: list[int] = []
+        self._failed: list[dict] = []
+        self._flushed_at = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._flushes: set[asyncio.Task] = set()
+
+    def add(self, tg_id, status: int, error: Exception = None):
+        if self.log:
+            self.log.add(tg_id, status, error)
+        row_id = self.row_ids[str(tg_id)]
+        if status == DELIVERY_SENT:
+            self._sent.append(row_id)
+        else:
+            self._failed.append({"id": row_id, "status": "failed", "error": str(error)[:500],
+                                 "updated_at": datetime.utcnow()})
+        if (len(self._sent) + len(self._failed) >= RESULT_FLUSH_SIZE
+                or time.monotonic() - self._flushed_at >= RESULT_FLUSH_SECONDS):
+            self._flush()
+
+    def _flush(self):
+        sent, failed, self._sent, self._failed = self._sent, self._failed, [], []
+        self._flushed_at = time.monotonic()
+        if sent or failed:
+            task = asyncio.create_task(self._write(sent, failed))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _write(self, sent: list[int], failed: list[dict]):
+        # Порции пишутся по очереди, чтобы пачка не занимала несколько соединений пула
+        async with self._lock:
+            try:
+                async with AsyncSessionLocal() as session:
+                    if sent:
+                        await session.execute(
+                            update(MailingDelivery)
+                            .where(MailingDelivery.id.in_(sent))
+                            .values(status="sent", updated_at=datetime.utcnow())
+                        )
+                    if failed:
+                        await session.execute(update(MailingDelivery), failed)
+                    await session.commit()
+            except Exception as e:
+                # Строки останутся sending и вернутся в очередь через release_stale_deliveries
+                logging.error(f"Не удалось записать итоги доставки ({len(sent) + len(failed)} строк): {e}")
+
+    async def close(self):
+        self._flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes)
+
+
+async def drain_batch(engine: DeliveryEngine, run_id: int, send: SendFunc,
+                      partition: tuple[int, int] = None, progress: BroadcastProgress = None,
+                      log: DeliveryLogWriter = None, lease: bool = False) -> DeliveryStats | None:
+    """
+    Забирает и отправляет одну пачку ожидающих доставок; строки помечаются как sent/failed
+    по мере отправки (DeliveryResults). lease – продлевать аренду запуска, пока идёт пачка (отправка в процессе-владельце).
+    Возвращает None, если готовых к отправке доставок (в разделе partition) сейчас нет.
+    """
+    rows = await claim_batch(run_id, partition)
+    if not rows:
+        return None
+
+    results = DeliveryResults({row.tg_id: row.id for row in rows}, log)
+    heartbeat = asyncio.create_task(keep_claim(run_id, [row.id for row in rows], lease))
+    try:
+        return await engine.run([row.tg_id for row in rows], send, progress, results)
+    finally:
+        heartbeat.cancel()
+        await results.close()
+
+
+async def next_pending_at(run_id: int) -> datetime | None:
+    """
+    Когда наступит слот ближайшей ожидающей доставки (None – ожидающих доставок нет).
+    """
+    now = datetime.utcnow()
+    async with AsyncSessionLocal() as session:
+        return await session.scalar(
+            select(func.min(func.coalesce(MailingDelivery.not_before, now)))
+            .where(MailingDelivery.run_id == run_id, MailingDelivery.status == "pending")
+        )
+
+
+async def drain_run(bot: Bot, run_id: int, send: SendFunc, progress: BroadcastProgress = None,
+                    log: DeliveryLogWriter = None) -> DeliveryStats:
+    """
+    Отправляет ожидающие доставки запуска пачками и помечает каждую строку как sent/failed.
+    Перед каждой пачкой и во время неё продлевает аренду запуска; потеряв её, останавливается.
+    """
+    engine = DeliveryEngine(bot)
+    total = DeliveryStats()
+    while True:
+        if not await renew_lease(run_id):
+            logging.warning(f"Запуск рассылки run_id={run_id} приостановлен, отменён или перехвачен – отправка остановлена.")
+            return total
+        stats = await drain_batch(engine, run_id, send, progress=progress, log=log, lease=True)
+        if stats is None:
+            if await release_stale_deliveries(run_id):
+                continue
+            # Растянутая рассылка: ждём слота следующего получателя, не теряя аренду
+            wake_at = await next_pending_at(run_id)
+            if wake_at is None:
+                if not (await count_deliveries(run_id)).get("sending"):
+                    break
+                # Пачку ещё отправляет другой процесс: ждём её итога или возврата строк в очередь
+                wake_at = datetime.utcnow() + timedelta(seconds=CONTROL_CHECK_SECONDS)
+            delay = (wake_at - datetime.utcnow()).total_seconds()
+            await asyncio.sleep(min(max(0.0, delay), CONTROL_CHECK_SECONDS))
+            continue
+        total.merge(stats)
+
+    await finish_run(run_id)
+    return total
+
+
+async def count_deliveries(run_id: int) -> dict[str, int]:
+    """
+    Число строк outbox запуска по статусам (pending/sending/sent/failed).
+    """
+    async with AsyncSessionLocal() as session:
+        return dict((await session.execute(
+            select(MailingDelivery.status, func.count(MailingDelivery.id))
+            .where(MailingDelivery.run_id == run_id)
+            .group_by(MailingDelivery.status)
+        )).all())
+
+
+async def wait_run(run_id: int, progress: BroadcastProgress = None) -> DeliveryStats:
+    """
+    Ждёт, пока воркеры разошлют все доставки запуска, продлевая его аренду, и завершает запуск.
+    Итоги (и прогресс) считаются по статусам строк outbox, разбивка ошибок – по журналу доставки.
+    """
+    while True:
+        if not await renew_lease(run_id):
+            logging.warning(f"Запуск рассылки run_id={run_id} приостановлен, отменён или перехвачен – ожидание остановлено.")
+            break
+        await release_stale_deliveries(run_id)
+        counts = await count_deliveries(run_id)
+        if progress:
+            progress.sent, progress.failed = counts.get("sent", 0), counts.get("failed", 0)
+        if not counts.get("pending") and not counts.get("sending"):
+            await finish_run(run_id)
+            break
+        await asyncio.sleep(config.BROADCAST_WORKER_POLL)
+
+    # Разбивку ошибок outbox не хранит – она есть в журнале доставки, который пишут воркеры
+    counts = await count_deliveries(run_id)
+    outcomes = await get_run_outcomes(run_id)
+    unreachable = outcomes.get(DELIVERY_UNREACHABLE, 0)
+    return DeliveryStats(
+        success=counts.get("sent", 0), errors=counts.get("failed", 0),
+        permanent_errors=unreachable + outcomes.get(DELIVERY_REJECTED, 0), unreachable=unreachable
+    )
+
+
+async def complete_run(bot: Bot, run_id: int, send: SendFunc, report: ReportFunc = None) -> DeliveryStats:
+    """
+    Доводит запуск до конца: сам отправляет доставки или, если запущены процессы-воркеры
+    (BROADCAST_WORKERS), ждёт, пока их разошлют воркеры.
+    Прогресс запуска доступен в active_progress[run_id] и периодически передаётся в report.
+    Пока запуск идёт, он числится в active_runs, и планировщик этого процесса его не перехватывает.
+    """
+    task = asyncio.current_task()
+    registered = active_runs.setdefault(run_id, task) is task
+    try:
+        return await _complete_run(bot, run_id, send, report)
+    finally:
+        if registered:
+            active_runs.pop(run_id, None)
+            notify_scheduler()  # освободилось место – планировщик может забрать следующую рассылку
+
+
+async def _complete_run(bot: Bot, run_id: int, send: SendFunc, report: ReportFunc = None) -> DeliveryStats:
+    async with AsyncSessionLocal() as session:
+        run = await session.get(MailingRun, run_id)
+    counts = await count_deliveries(run_id)
+    progress = BroadcastProgress(
+        total=sum(counts.values()), sent=counts.get("sent", 0), failed=counts.get("failed", 0)
+    )
+    progress.initial = progress.processed
+    active_progress[run_id] = progress
+    try:
+        async with track_progress(progress, report):
+            if config.BROADCAST_WORKERS:
+                # Пока воркеры рассылают, основной процесс оставляет себе только свою долю лимита;
+                # в остальное время весь лимит доступен интерактивным ответам
+                with rate_limiter.sharing(config.BROADCAST_WORKERS + 1):
+                    return await wait_run(run_id, progress)  # журнал доставки пишут сами воркеры
+            async with DeliveryLogWriter(run.mailing_id, run.schedule_id, run_id) as log:
+                return await drain_run(bot, run_id, send, progress, log)
+    finally:
+        active_progress.pop(run_id, None)
+
+
+async def finish_run(run_id: int):
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            update(MailingRun)
+            .where(MailingRun.id == run_id, MailingRun.status == "running")
+            .values(status="done", finished_at=datetime.utcnow(), lease_until=None)
+        )
+        await session.commit()
+
+
+async def get_run_status(run_id: int) -> str | None:
+    async with AsyncSessionLocal() as session:
+        return await session.scalar(select(MailingRun.status).where(MailingRun.id == run_id))
+
+
+# Управление запуском администратором: действие -> (допустимые статусы, новые значения)
+RUN_CONTROLS = {
+    "pause": (("running",), {"status": "paused"}),
+    # Снятая аренда делает запуск доступным claim_stale_runs – его подхватит любой процесс
+    "resume": (("paused",), {"status": "running"}),
+    "cancel": (("running", "paused"), {"status": "cancelled"}),
+}
+
+
+async def control_run(run_id: int, action: str) -> bool:
+    """
+    Ставит запуск на паузу, возобновляет или отменяет его. Отправляющий процесс видит новый статус
+    перед следующей пачкой (renew_lease или выборка запусков воркером); неотправленные строки
+    outbox остаются pending, поэтому после возобновления отправка продолжается с того же места.
+    False – действие недопустимо для текущего статуса запуска.
+    """
+    allowed, values = RUN_CONTROLS[action]
+    values = dict(values, owner=None, lease_until=None)
+    if action == "cancel":
+        values["finished_at"] = datetime.utcnow()
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            update(MailingRun)
+            .where(MailingRun.id == run_id, MailingRun.status.in_(allowed))
+            .values(**values)
+        )
+        await session.commit()
+        return result.rowcount > 0
+
+
+async def claim_stale_runs(limit: int = None) -> list[MailingRun]:
+    """
+    Забирает (до limit) незавершённые запуски с истёкшей арендой (процесс-владелец упал или перезапущен).
+    Строки блокируются через FOR UPDATE SKIP LOCKED, поэтому каждый запуск достаётся одному процессу.
+    """
+    async with AsyncSessionLocal() as session:
+        async with session.begin():
+            runs = (await session.scalars(
+                select(MailingRun)
+                .where(
+                    MailingRun.status == "running",
+                    or_(MailingRun.lease_until.is_(None), MailingRun.lease_until < datetime.utcnow())
+                )
+                .order_by(MailingRun.id)
+                .limit(limit)
+                .with_for_update(skip_locked=True)
+            )).all()
+            for run in runs:
+                run.owner = INSTANCE_ID
+                run.lease_until = lease_deadline()
+    return runs
+
+
+async def delete_stale_snapshots(session):
+    """
+    Удаляет заранее подготовленные запуски, расписание (или рассылку) которых с тех пор
+    отключили, удалили или перенесли.
+    """
+    await session.execute(
+        delete(MailingRun).where(
+            MailingRun.status == "prepared",
+            ~select(MailingSchedule.id).join(Mailing, Mailing.id == MailingSchedule.mailing_id).where(
+                MailingSchedule.id == MailingRun.schedule_id,
+                MailingSchedule.active == 1,
+                Mailing.active == 1,
+                MailingSchedule.next_run == MailingRun.scheduled_for
+            ).exists()
+        )
+    )
+
+
+async def get_next_lease_expiry():
+    """
+    Ближайшее истечение аренды среди незавершённых запусков (None, если таких нет).
+    """
+    async with AsyncSessionLocal() as session:
+        return await session.scalar(
+            select(MailingRun.lease_until)
+            .where(MailingRun.status == "running", MailingRun.lease_until.is_not(None))
+            .order_by(MailingRun.lease_until)
+            .limit(1)
+        )
@@ -0,0 +1,231 @@
+import bisect
+import logging
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable
+
+from aiohttp import web
+
+from app.config import config
+
+# Границы корзин гистограмм длительности, секунды
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Границы корзин для количеств (запросов к БД, вызовов API на апдейт)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными корзинами (семантика le как в Prometheus).
+    """
+
+    def __init__(self, buckets: tuple = DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя корзина – +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        Оценка квантиля по верхней границе корзины.
+        """
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if count and cumulative >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return 0.0
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+
+class Metrics:
+    """
+    Метрики процесса в памяти: гистограммы, счётчики и вычисляемые gauge,
+    отдаются в текстовом формате Prometheus.
+    """
+
+    def __init__(self):
+        self.kinds: dict[str, tuple[str, str]] = {}  # имя -> (тип, описание)
+        self.histograms: dict[str, dict[Labels, Histogram]] = {}
+        self.buckets: dict[str, tuple] = {}
+        self.counters: dict[str, dict[Labels, float]] = {}
+        self.gauges: dict[str, Callable[[], dict[Labels, float]]] = {}
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = DURATION_BUCKETS):
+        self.kinds[name] = ("histogram", help_text)
+        self.histograms.setdefault(name, {})
+        self.buckets[name] = buckets
+
+    def counter(self, name: str, help_text: str):
+        self.kinds[name] = ("counter", help_text)
+        self.counters.setdefault(name, {})
+
+    def gauge(self, name: str, help_text: str, collect: Callable[[], dict[Labels, float]]):
+        """
+        Gauge, значения которого считываются collect() в момент выгрузки.
+        """
+        self.kinds[name] = ("gauge", help_text)
+        self.gauges[name] = collect
+
+    def observe(self, name: str, labels: Labels, value: float):
+        series = self.histograms[name]
+        histogram = series.get(labels)
+        if histogram is None:
+            histogram = series[labels] = Histogram(self.buckets[name])
+        histogram.observe(value)
+
+    def inc(self, name: str, labels: Labels = (), value: float = 1):
+        series = self.counters[name]
+        series[labels] = series.get(labels, 0) + value
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help_text) in self.kinds.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                for labels, histogram in self.histograms[name].items():
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+            elif kind == "counter":
+                for labels, value in self.counters[name].items():
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+            else:
+                try:
+                    values = self.gauges[name]()
+                except Exception as e:
+                    logging.error(f"Не удалось снять метрику {name}: {e}")
+                    continue
+                for labels, value in values.items():
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+metrics = Metrics()
+metrics.histogram("bot_handler_duration_seconds", "Время обработки апдейта обработчиком")
+metrics.histogram("bot_handler_db_seconds", "Суммарное время запросов к БД за апдейт")
+metrics.histogram("bot_handler_db_queries", "Число запросов к БД за апдейт", COUNT_BUCKETS)
+metrics.histogram("bot_handler_api_calls", "Число вызовов Telegram API за апдейт", COUNT_BUCKETS)
+metrics.histogram("bot_db_query_duration_seconds", "Длительность отдельного запроса к БД")
+metrics.histogram("bot_api_request_duration_seconds", "Длительность вызова Telegram API по методам")
+metrics.counter("bot_handler_errors_total", "Исключения в обработчиках")
+
+
+@dataclass
+class RequestStats:
+    """
+    Счётчики одного апдейта: запросы к БД и вызовы Telegram API, сделанные при его обработке.
+    """
+    started: float = field(default_factory=time.perf_counter)
+    db_queries: int = 0
+    db_time: float = 0.0
+    api_calls: int = 0
+    handler: str = "unhandled"
+    router: str = "-"
+
+
+# Статистика обрабатываемого апдейта (None – фоновые задачи)
+current_request: ContextVar[RequestStats | None] = ContextVar("current_request", default=None)
+
+
+def record_query(duration: float):
+    """
+    Вызывается из событий SQLAlchemy после каждого запроса к БД.
+    """
+    metrics.observe("bot_db_query_duration_seconds", (), duration)
+    stats = current_request.get()
+    if stats is not None:
+        stats.db_queries += 1
+        stats.db_time += duration
+
+
+def record_api_call(method: str, duration: float):
+    metrics.observe("bot_api_request_duration_seconds", (("method", method),), duration)
+    stats = current_request.get()
+    if stats is not None:
+        stats.api_calls += 1
+
+
+def record_request(stats: RequestStats, failed: bool = False):
+    labels = (("handler", stats.handler), ("router", stats.router))
+    metrics.observe("bot_handler_duration_seconds", labels, time.perf_counter() - stats.started)
+    metrics.observe("bot_handler_db_seconds", labels, stats.db_time)
+    metrics.observe("bot_handler_db_queries", labels, stats.db_queries)
+    metrics.observe("bot_handler_api_calls", labels, stats.api_calls)
+    if failed:
+        metrics.inc("bot_handler_errors_total", labels)
+
+
+def handler_report(limit: int = 15) -> list[dict]:
+    """
+    Сводка по обработчикам для /perf, самые затратные по суммарному времени – первыми.
+    """
+    durations = metrics.histograms["bot_handler_duration_seconds"]
+    rows = []
+    for labels, histogram in durations.items():
+        db_time = metrics.histograms["bot_handler_db_seconds"].get(labels)
+        queries = metrics.histograms["bot_handler_db_queries"].get(labels)
+        api_calls = metrics.histograms["bot_handler_api_calls"].get(labels)
+        rows.append({
+            **dict(labels),
+            "count": histogram.count,
+            "total": histogram.sum,
+            "mean": histogram.mean,
+            "p95": histogram.quantile(0.95),
+            "db_mean": db_time.mean if db_time else 0.0,
+            "queries_mean": queries.mean if queries else 0.0,
+            "api_mean": api_calls.mean if api_calls else 0.0,
+            "errors": metrics.counters["bot_handler_errors_total"].get(labels, 0),
+        })
+    rows.sort(key=lambda row: row["total"], reverse=True)
+    return rows[:limit]
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server() -> web.AppRunner | None:
+    """
+    Поднимает HTTP-эндпоинт /metrics (формат Prometheus) на PERF_METRICS_HOST:PERF_METRICS_PORT.
+    """
+    if not config.PERF_METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, config.PERF_METRICS_HOST, config.PERF_METRICS_PORT).start()
+    except OSError as e:
+        logging.error(f"❌ Не удалось открыть порт метрик {config.PERF_METRICS_PORT}: {e}")
+        await runner.cleanup()
+        return None
+    logging.info(f"📈 Метрики доступны на http://{config.PERF_METRICS_HOST}:{config.PERF_METRICS_PORT}/metrics")
+    return runner
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from app.config import config
+from app.utils.delivery import send_lane, LANE_ADMIN
+
+ReportFunc = Callable[[str], Awaitable]
+
+
+@dataclass
+class BroadcastProgress:
+    """
+    Живые счётчики рассылки: отправлено, ошибок, осталось, скорость и оценка времени до конца.
+    """
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    started: float = field(default_factory=time.monotonic)
+    finished: bool = False
+    # Строки, обработанные до начала отслеживания (возобновлённый запуск), не входят в скорость
+    initial: int = 0
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed
+
+    @property
+    def remaining(self) -> int:
+        return max(0, self.total - self.processed)
+
+    @property
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return (self.processed - self.initial) / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> float | None:
+        rate = self.rate
+        return self.remaining / rate if rate > 0 else None
+
+    def format(self) -> str:
+        eta = self.eta
+        eta_text = "—" if eta is None else format_duration(eta)
+        return (
+            f"Идёт рассылка...\n"
+            f"Отправлено: {self.sent} из {self.total}\n"
+            f"Ошибок: {self.failed}\n"
+            f"Осталось: {self.remaining}\n"
+            f"Скорость: {self.rate:.1f} сообщ./с\n"
+            f"Осталось времени: {eta_text}"
+        )
+
+
+def format_duration(seconds: float) -> str:
+    """
+    Длительность для сообщений администратору: "~1 ч 5 мин", "~3 мин 20 с", "~15 с".
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"~{hours} ч {minutes} мин"
+    return f"~{minutes} мин {seconds} с" if minutes else f"~{seconds} с"
+
+
+def estimate_send_duration(recipients: int, cost: int = 1) -> float:
+    """
+    Ожидаемая длительность рассылки (секунд) при заданной скорости BROADCAST_RATE.
+    """
+    return recipients * cost / config.BROADCAST_RATE
+
+
+# Прогресс незавершённых запусков этого процесса: run_id -> BroadcastProgress
+active_progress: dict[int, BroadcastProgress] = {}
+
+
+async def report_progress(progress: BroadcastProgress, report: ReportFunc, interval: float = None):
+    """
+    Периодически (не чаще interval секунд) передаёт текст прогресса в report, пропуская
+    неизменившийся текст. Каждое редактирование статуса забирает токен из общего лимита
+    отправки (в полосе admin), то есть немного замедляет рассылку, зато не вызывает flood
+    control и обслуживается раньше очереди рассылки.
+    """
+    interval = interval or config.BROADCAST_PROGRESS_INTERVAL
+    send_lane.set(LANE_ADMIN)
+    last_text = None
+    while not progress.finished:
+        await asyncio.sleep(interval)
+        text = progress.format()
+        if text == last_text:
+            continue
+        try:
+            await report(text)
+            last_text = text
+        except Exception as e:
+            logging.warning(f"Не удалось обновить прогресс рассылки: {e}")
+
+
+@asynccontextmanager
+async def track_progress(progress: BroadcastProgress, report: ReportFunc = None):
+    """
+    На время блока запускает периодический отчёт о прогрессе (если задан report).
+    """
+    task = asyncio.create_task(report_progress(progress, report)) if report else None
+    try:
+        yield progress
+    finally:
+        progress.finished = True
+        if task:
+            task.cancel()
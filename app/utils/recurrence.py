@@ -0,0 +1,101 @@
+from calendar import monthrange
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+WEEK_MASK = (1 << 7) - 1
+
+
+@dataclass(frozen=True)
+class Recurrence:
+    """
+    Скомпилированное правило повторения расписания: битовые маски дней недели
+    (бит 0 – понедельник) и дней месяца (бит d – d‑е число) плюс время суток в минутах.
+    Следующий запуск вычисляется за константное время, без перебора пропущенных запусков.
+    """
+    kind: str  # daily, weekly, monthly
+    minutes: int  # время суток, минут от полуночи
+    weekdays: int = 0
+    monthdays: int = 0
+
+    def next_after(self, after: datetime) -> datetime | None:
+        """
+        Первый запуск строго позже after (None, если правило не даёт ни одного запуска).
+        """
+        day = datetime(after.year, after.month, after.day)
+        at = timedelta(minutes=self.minutes)
+        # Если время сегодняшнего запуска уже прошло, сегодняшний день не подходит
+        today_passed = day + at <= after
+
+        if self.kind == "daily":
+            return day + timedelta(days=1 if today_passed else 0) + at
+
+        if self.kind == "weekly":
+            if not self.weekdays:
+                return None
+            # Маска на две недели, сдвинутая так, что бит 0 – сегодняшний день
+            window = ((self.weekdays | self.weekdays << 7) >> day.weekday()) & ~int(today_passed)
+            offset = (window & -window).bit_length() - 1
+            return day + timedelta(days=offset) + at
+
+        if self.kind == "monthly":
+            if not self.monthdays:
+                return None
+            year, month, first_day = day.year, day.month, day.day + int(today_passed)
+            # Любое число месяца встречается не реже чем раз в 2 месяца (31-е: янв → мар), поэтому шагов не больше 3
+            for _ in range(3):
+                last_day = monthrange(year, month)[1]
+                days = self.monthdays & ((1 << last_day + 1) - 1) & ~((1 << first_day) - 1)
+                if days:
+                    return datetime(year, month, (days & -days).bit_length() - 1) + at
+                year, month, first_day = (year + 1, 1, 1) if month == 12 else (year, month + 1, 1)
+            return None
+
+        return None
+
+
+def parse_minutes(time_of_day: str) -> int:
+    hh, mm = time_of_day.strip().split(":")
+    return int(hh) * 60 + int(mm)
+
+
+def parse_days(days: str, first: int) -> int:
+    """
+    "1,3,5" -> битовая маска; first – номер первого дня в строке (1 для дней недели, 0 для чисел месяца).
+    """
+    mask = 0
+    for part in (days or "").split(","):
+        if part.strip().isdigit():
+            mask |= 1 << (int(part) - first)
+    return mask
+
+
+@lru_cache(maxsize=1024)
+def compile_recurrence(schedule_type: str, day_of_week: str = None, day_of_month: str = None,
+                       time_of_day: str = None) -> Recurrence | None:
+    """
+    Компилирует поля расписания в Recurrence (кэшируется по значениям полей).
+    None – расписание не повторяется (единоразовое, неизвестный тип или некорректное время).
+    """
+    if schedule_type not in ("daily", "weekly", "monthly") or not time_of_day:
+        return None
+    try:
+        minutes = parse_minutes(time_of_day)
+    except ValueError:
+        return None
+    if schedule_type == "weekly":
+        # В day_of_week дни недели хранятся как 1..7, где 1 – понедельник
+        return Recurrence(kind="weekly", minutes=minutes, weekdays=parse_days(day_of_week, 1) & WEEK_MASK)
+    if schedule_type == "monthly":
+        return Recurrence(kind="monthly", minutes=minutes, monthdays=parse_days(day_of_month, 0))
+    return Recurrence(kind="daily", minutes=minutes)
+
+
+def schedule_recurrence(schedule) -> Recurrence | None:
+    """
+    Recurrence для MailingSchedule. У старых расписаний без time_of_day время берётся из next_run.
+    """
+    time_of_day = schedule.time_of_day
+    if not time_of_day and schedule.next_run:
+        time_of_day = schedule.next_run.strftime("%H:%M")
+    return compile_recurrence(schedule.schedule_type, schedule.day_of_week, schedule.day_of_month, time_of_day)
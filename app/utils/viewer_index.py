@@ -0,0 +1,204 @@
+import logging
+import time
+
+from sqlalchemy import select, func
+
+from app.config import config
+from app.db.db import AsyncSessionLocal
+from app.db.models import User, Material, MaterialView
+
+
+def mask_from_ids(ids: list[int]) -> int:
+    """
+    Битовая маска из номеров битов за один проход: биты ставятся в bytearray, а int
+    создаётся один раз (|= 1 << id в цикле каждый раз копирует всё растущее число).
+    """
+    if not ids:
+        return 0
+    bitmap = bytearray((max(ids) >> 3) + 1)
+    for bit in ids:
+        bitmap[bit >> 3] |= 1 << (bit & 7)
+    return int.from_bytes(bitmap, "little")
+
+
+class ViewerIndex:
+    """
+    Индекс аудитории в памяти: битовые маски (Python int) по User.id –
+    зрители каждого материала, пользователи каждого статуса (в нижнем регистре)
+    и доступные получатели. Объединения и подсчёты для выбора аудитории
+    считаются без SQL; получателей самой рассылки индекс не выбирает (см. stream_audience).
+    Строится при старте, дополняется по мере просмотров и изменений пользователей
+    и периодически перестраивается целиком.
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.built_at: float | None = None
+        self.viewers: dict[int, int] = {}         # material_id -> маска зрителей
+        self.keywords: dict[str, set[int]] = {}   # keyword -> material_id
+        self.statuses: dict[str, int] = {}        # lower(status) -> маска пользователей
+        self.reachable = 0                        # пользователи с tg_id и без blocked_at
+        self.user_ids: dict[str, int] = {}        # tg_id -> User.id
+        self.user_status: dict[int, str] = {}     # User.id -> lower(status)
+        self._changes: list | None = None         # изменения, пришедшие во время build()
+
+    async def build(self):
+        """
+        Загружает пользователей, материалы и просмотры и атомарно подменяет индекс.
+        Изменения, пришедшие, пока шла загрузка, записываются и применяются к новому
+        индексу сразу после подмены, чтобы не потеряться.
+        """
+        started = time.monotonic()
+        user_ids, user_status, keywords = {}, {}, {}
+        # Сначала собираем номера пользователей по ключам, маски строим в конце по одному разу
+        status_ids: dict[str, list[int]] = {}
+        viewer_ids: dict[int, list[int]] = {}
+        reachable_ids: list[int] = []
+        self._changes = []
+
+        try:
+            async with AsyncSessionLocal() as session:
+                users = await session.stream(
+                    select(User.id, User.tg_id, func.lower(User.status), User.blocked_at)
+                    .execution_options(yield_per=10000)
+                )
+                async for user_id, tg_id, status, blocked_at in users:
+                    if tg_id:
+                        user_ids[tg_id] = user_id
+                        if blocked_at is None:
+                            reachable_ids.append(user_id)
+                    if status:
+                        user_status[user_id] = status
+                        status_ids.setdefault(status, []).append(user_id)
+
+                for material_id, keyword in (await session.execute(select(Material.id, Material.keyword))).all():
+                    keywords.setdefault(keyword, set()).add(material_id)
+
+                views = await session.stream(
+                    select(MaterialView.material_id, MaterialView.user_id)
+                    .where(MaterialView.user_id.is_not(None))
+                    .execution_options(yield_per=10000)
+                )
+                async for material_id, user_id in views:
+                    viewer_ids.setdefault(material_id, []).append(user_id)
+        except BaseException:
+            self._changes = None
+            raise
+
+        statuses = {status: mask_from_ids(ids) for status, ids in status_ids.items()}
+        viewers = {material_id: mask_from_ids(ids) for material_id, ids in viewer_ids.items()}
+        reachable = mask_from_ids(reachable_ids)
+        changes, self._changes = self._changes, None
+        self.user_ids, self.user_status = user_ids, user_status
+        self.statuses, self.reachable = statuses, reachable
+        self.viewers, self.keywords = viewers, keywords
+        for method, args in changes:
+            method(*args)
+        self.ready = True
+        self.built_at = time.monotonic()
+        logging.info(
+            f"🧮 Индекс аудитории построен за {time.monotonic() - started:.2f} с: "
+            f"{len(user_ids)} пользователей, {len(viewers)} материалов"
+        )
+
+    def _record(self, method, *args):
+        """
+        Запоминает изменение, если сейчас идёт перестройка индекса.
+        """
+        if self._changes is not None:
+            self._changes.append((method, args))
+
+    def add_user(self, user_id: int, tg_id: str, status: str | None = None, reachable: bool = True):
+        """
+        Новый пользователь (или обновлённые tg_id/статус существующего).
+        """
+        self._record(self.add_user, user_id, tg_id, status, reachable)
+        if tg_id:
+            self.user_ids[tg_id] = user_id
+            self.set_reachable(tg_id, reachable)
+        self.set_status(user_id, status)
+
+    def set_status(self, user_id: int, status: str | None):
+        """
+        Переносит пользователя в маску нового статуса.
+        """
+        self._record(self.set_status, user_id, status)
+        status = status.lower() if status else None
+        bit = 1 << user_id
+        old = self.user_status.pop(user_id, None)
+        if old is not None:
+            self.statuses[old] &= ~bit
+        if status:
+            self.user_status[user_id] = status
+            self.statuses[status] = self.statuses.get(status, 0) | bit
+
+    def set_reachable(self, tg_id, reachable: bool):
+        """
+        Отмечает пользователя доступным или недоступным для рассылок.
+        """
+        self._record(self.set_reachable, tg_id, reachable)
+        user_id = self.user_ids.get(str(tg_id))
+        if user_id is None:
+            return
+        if reachable:
+            self.reachable |= 1 << user_id
+        else:
+            self.reachable &= ~(1 << user_id)
+
+    def add_material(self, material_id: int, keyword: str):
+        self._record(self.add_material, material_id, keyword)
+        self.keywords.setdefault(keyword, set()).add(material_id)
+
+    def remove_material(self, material_id: int, keyword: str):
+        self._record(self.remove_material, material_id, keyword)
+        self.viewers.pop(material_id, None)
+        self.keywords.get(keyword, set()).discard(material_id)
+        if not self.keywords.get(keyword):
+            self.keywords.pop(keyword, None)
+
+    def add_view(self, material_id: int, user_id: int, keyword: str | None = None):
+        """
+        Учитывает просмотр материала пользователем.
+        """
+        self._record(self.add_view, material_id, user_id, keyword)
+        if keyword:
+            self.add_material(material_id, keyword)
+        self.viewers[material_id] = self.viewers.get(material_id, 0) | (1 << user_id)
+
+    def keyword_mask(self, keyword: str) -> int:
+        mask = 0
+        for material_id in self.keywords.get(keyword, ()):
+            mask |= self.viewers.get(material_id, 0)
+        return mask
+
+    def admins_mask(self) -> int:
+        mask = 0
+        for admin_id in config.ADMIN_IDS:
+            user_id = self.user_ids.get(str(admin_id))
+            if user_id is not None:
+                mask |= 1 << user_id
+        return mask
+
+    def audience_mask(self, statuses: list[str], keywords: list[str], admins_status: str) -> int:
+        """
+        Маска аудитории с той же логикой, что и audience_query: ключевые слова важнее статусов.
+        """
+        mask = 0
+        if keywords:
+            for keyword in keywords:
+                mask |= self.keyword_mask(keyword)
+        else:
+            for status in statuses:
+                mask |= self.admins_mask() if status == admins_status else self.statuses.get(status, 0)
+        return mask & self.reachable
+
+    def status_counts(self, admins_status: str) -> dict[str, int]:
+        counts = {status: (mask & self.reachable).bit_count() for status, mask in self.statuses.items()}
+        counts[admins_status] = (self.admins_mask() & self.reachable).bit_count()
+        return counts
+
+    def keyword_counts(self) -> dict[str, int]:
+        return {keyword: (self.keyword_mask(keyword) & self.reachable).bit_count() for keyword in self.keywords}
+
+
+viewer_index = ViewerIndex()
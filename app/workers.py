@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import multiprocessing
+
+from sqlalchemy import select
+
+from app.config import config
+from app.db.db import AsyncSessionLocal
+from app.db.models import Mailing, MailingRun
+from app.utils.delivery import DeliveryEngine, DeliveryStats, rate_limiter, get_mailing_payload
+from app.utils.outbox import INSTANCE_ID, drain_batch
+from app.utils.delivery_log import DeliveryLogWriter
+
+
+async def partition_worker(owner: str, index: int, count: int, busy):
+    """
+    Воркер доставки: рассылает получателей своего раздела (хэш tg_id по модулю count)
+    во всех запусках, которые арендованы основным процессом owner и уже заполнены аудиторией.
+    Запуски обслуживаются по кругу, по одной пачке за раз: большой запуск не задерживает
+    остальные, а пауза или отмена видна перед каждой пачкой.
+    """
+    from app.utils.helpers import bot
+
+    logging.info(f"🚚 Воркер доставки {index + 1}/{count} запущен.")
+    engine = DeliveryEngine(bot)
+    totals: dict[int, DeliveryStats] = {}  # итоги по запускам, которые воркер сейчас рассылает
+    while True:
+        # Пока основной процесс не ждёт ни одного запуска (busy == 0), рассылать нечего – БД не опрашиваем
+        if not busy.value and not totals:
+            await asyncio.sleep(config.BROADCAST_WORKER_POLL)
+            continue
+        active = set()
+        try:
+            async with AsyncSessionLocal() as session:
+                runs = (await session.execute(
+                    select(MailingRun.id, MailingRun.schedule_id, Mailing)
+                    .join(Mailing, Mailing.id == MailingRun.mailing_id)
+                    .where(
+                        MailingRun.status == "running",
+                        MailingRun.owner == owner,
+                        MailingRun.audience_loaded_at.is_not(None)
+                    )
+                    .order_by(MailingRun.id)
+                )).all()
+
+            for run_id, schedule_id, mailing in runs:
+                async with DeliveryLogWriter(mailing.id, schedule_id, run_id) as log:
+                    stats = await drain_batch(engine, run_id, get_mailing_payload(mailing).send, (index, count), log=log)
+                if stats is not None:
+                    active.add(run_id)
+                    totals.setdefault(run_id, DeliveryStats()).merge(stats)
+        except Exception as e:
+            logging.error(f"⚠ Ошибка в воркере доставки {index + 1}/{count}: {e}")
+
+        # Свой раздел запуска разослан (или запуск остановлен) – итог в лог
+        for run_id in set(totals) - active:
+            stats = totals.pop(run_id)
+            logging.info(f"🚚 Воркер {index + 1}/{count}, run_id={run_id}: "
+                         f"Успешно: {stats.success}, Ошибок: {stats.errors}")
+        if not active:
+            await asyncio.sleep(config.BROADCAST_WORKER_POLL)
+
+
+def run_worker_process(owner: str, index: int, count: int, paused_until, busy):
+    """
+    Точка входа процесса-воркера. paused_until и busy – общие с основным процессом значения
+    (см. RateLimiter.attach).
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f"%(asctime)s [%(levelname)s] [worker {index + 1}] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    # Основной процесс тоже отправляет сообщения (единоразовые рассылки), поэтому долей count + 1.
+    # Доли статичны: воркер с опустевшим разделом свою долю не отдаёт; паузу flood control
+    # процессы делят через paused_until
+    rate_limiter.share(count + 1)
+    rate_limiter.attach(paused_until, busy)
+
+    import uvloop
+    uvloop.install()
+    asyncio.run(partition_worker(owner, index, count, busy))
+
+
+def start_workers(count: int) -> list[multiprocessing.Process]:
+    """
+    Запускает count процессов-воркеров доставки. Каждый получатель всегда попадает в один
+    и тот же процесс, поэтому лимит на чат соблюдается без координации между процессами.
+    Пауза flood control и признак "есть что рассылать" общие: их видят все процессы.
+    """
+    context = multiprocessing.get_context("spawn")
+    paused_until = context.Value("d", 0.0, lock=False)
+    busy = context.Value("i", 0, lock=False)
+    rate_limiter.attach(paused_until, busy)
+    processes = []
+    for index in range(count):
+        process = context.Process(
+            target=run_worker_process,
+            args=(INSTANCE_ID, index, count, paused_until, busy),
+            name=f"delivery-worker-{index + 1}",
+            daemon=True
+        )
+        process.start()
+        processes.append(process)
+    logging.info(f"🚚 Запущено процессов-воркеров доставки: {count}")
+    return processes
@@ -1,3 +1,4 @@
+import argparse
 import asyncio
 import logging
 from aiogram import Bot, Dispatcher
@@ -7,18 +8,26 @@ from sqlalchemy import select, func
 
 from app.config import config
 from app.db.db import init_db, AsyncSessionLocal
-from app.db.models import Base, User
+from app.db.models import User
 from app.handlers.answers import answer_router
 from app.handlers.callback import callback_router
 from app.handlers.start import start_router
 from app.handlers.broadcast import broadcast_router
+from app.handlers.runs import runs_router
 from app.handlers.keyword import keyword_router
 from app.handlers.stats import stats_router
-from app.tasks import mailing_scheduler, update_database, backup_scheduler
+from app.tasks import mailing_scheduler, update_database, backup_scheduler, viewer_index_refresher
 
 from app.utils.excel_loader import load_initial_data_from_excel
 from app.middlewares.logging_lastvisit import LoggingAndLastVisitMiddleware
+from app.middlewares.send_lane import SendLaneMiddleware
+from app.middlewares.db_session import DbSessionMiddleware
+from app.middlewares.perf import PerfMiddleware, HandlerTagMiddleware
 from app.utils.helpers import bot
+from app.utils.viewer_index import viewer_index
+from app.utils.last_visit import last_visit
+from app.utils.perf import start_metrics_server
+from app.workers import start_workers
 
 logging.basicConfig(
     level=logging.INFO,
@@ -27,8 +36,8 @@ logging.basicConfig(
 )
 
 async def main():
-    # Шаг 1: создаём таблицы (если не существуют)
-    await init_db(Base)
+    # Шаг 1: проверяем, что миграции БД применены (python -m app.db.migrate)
+    await init_db()
 
     # Шаг 2: проверяем, пуста ли таблица User
     async with AsyncSessionLocal() as session:
@@ -39,12 +48,21 @@ async def main():
         else:
             logging.info(f"В таблице User уже есть {count_users} запись(-ей). Пропускаем загрузку Excel.")
 
+    # Шаг 3: индекс аудитории в памяти – подсчёты и выборка получателей без SQL
+    if config.VIEWER_INDEX_REFRESH:
+        await viewer_index.build()
+
     # Инициализация бота и диспетчера
     dp = Dispatcher(storage=MemoryStorage())
 
+    dp.update.outer_middleware(PerfMiddleware())
+    dp.update.middleware(SendLaneMiddleware())
     dp.update.middleware(LoggingAndLastVisitMiddleware())
+    dp.update.middleware(DbSessionMiddleware())  # одна сессия БД на апдейт: аргумент session в обработчиках
+    dp.shutdown.register(last_visit.close)
 
     # Подключаем роутеры
+    dp.include_router(runs_router)  # раньше broadcast_router: кнопки управления работают в любом состоянии FSM
     dp.include_router(broadcast_router)
     dp.include_router(keyword_router)
     dp.include_router(stats_router)
@@ -52,17 +70,42 @@ async def main():
     dp.include_router(start_router)
     dp.include_router(answer_router)
 
+    # Метки обработчика и роутера для метрик /perf и /metrics
+    for router in dp.sub_routers:
+        router.message.middleware(HandlerTagMiddleware())
+        router.callback_query.middleware(HandlerTagMiddleware())
+
+    # Процессы-воркеры доставки (python main.py --workers N): делят получателей по хэшу tg_id
+    # и общий лимит скорости, основной процесс только заполняет outbox и ждёт завершения
+    # (на это время он ограничивает себя своей долей лимита, см. complete_run)
+    if config.BROADCAST_WORKERS:
+        start_workers(config.BROADCAST_WORKERS)
+
     # Регистрируем запуск фоновой задачи в on_startup
     asyncio.create_task(mailing_scheduler(bot))
     asyncio.create_task(update_database(bot))
     asyncio.create_task(backup_scheduler(bot))
+    if config.VIEWER_INDEX_REFRESH:
+        asyncio.create_task(viewer_index_refresher())
+    asyncio.create_task(last_visit.run())
+    await start_metrics_server()
 
     logging.info("Starting bot polling...")
     await dp.start_polling(bot)
 
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Telegram-бот рассылок")
+    parser.add_argument(
+        "--workers", type=int, default=config.BROADCAST_WORKERS,
+        help="число процессов-воркеров доставки рассылок (0 – отправка в основном процессе)"
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
+    config.BROADCAST_WORKERS = max(0, parse_args().workers)
     import uvloop
     uvloop.install()
     asyncio.run(main())
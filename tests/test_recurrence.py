@@ -0,0 +1,115 @@
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.utils.recurrence import Recurrence, compile_recurrence
+
+SEED = 20240601
+CASES = 5000
+
+
+def brute_next_after(kind: str, minutes: int, weekdays: set[int], monthdays: set[int], after: datetime):
+    """
+    Эталон: перебор дней подряд начиная с after, первый подходящий запуск строго позже after.
+    """
+    day = datetime(after.year, after.month, after.day)
+    for offset in range(800):
+        current = day + timedelta(days=offset)
+        if kind == "weekly" and current.isoweekday() not in weekdays:
+            continue
+        if kind == "monthly" and current.day not in monthdays:
+            continue
+        run_at = current + timedelta(minutes=minutes)
+        if run_at > after:
+            return run_at
+    return None
+
+
+def random_rule(rng: random.Random) -> tuple[str, int, set[int], set[int]]:
+    kind = rng.choice(("daily", "weekly", "monthly"))
+    minutes = rng.randrange(24 * 60)
+    weekdays = {day for day in range(1, 8) if rng.random() < 0.3}
+    monthdays = {day for day in range(1, 32) if rng.random() < rng.choice((0.03, 0.1, 0.5))}
+    return kind, minutes, weekdays, monthdays
+
+
+def random_moment(rng: random.Random) -> datetime:
+    moment = datetime(2020, 1, 1) + timedelta(minutes=rng.randrange(10 * 366 * 24 * 60))
+    # Часть моментов – ровно во время запуска или на границе суток и месяца
+    return rng.choice((
+        moment,
+        moment.replace(second=0),
+        moment.replace(hour=0, minute=0),
+        moment.replace(day=1, hour=0, minute=0),
+        moment.replace(day=28) + timedelta(days=rng.randrange(4)),
+    ))
+
+
+def compile_rule(kind: str, minutes: int, weekdays: set[int], monthdays: set[int]) -> Recurrence:
+    return compile_recurrence(
+        kind,
+        ",".join(map(str, sorted(weekdays))),
+        ",".join(map(str, sorted(monthdays))),
+        f"{minutes // 60:02d}:{minutes % 60:02d}",
+    )
+
+
+def test_next_after_matches_brute_force():
+    rng = random.Random(SEED)
+    for _ in range(CASES):
+        rule = random_rule(rng)
+        after = random_moment(rng)
+        expected = brute_next_after(*rule, after)
+        assert compile_rule(*rule).next_after(after) == expected, (rule, after)
+
+
+def test_next_after_chain_matches_brute_force():
+    """
+    Цепочка запусков (как у планировщика: каждый следующий – после предыдущего) за несколько лет.
+    """
+    rng = random.Random(SEED + 1)
+    for _ in range(200):
+        rule = random_rule(rng)
+        recurrence = compile_rule(*rule)
+        after = random_moment(rng)
+        for _ in range(30):
+            expected = brute_next_after(*rule, after)
+            actual = recurrence.next_after(after)
+            assert actual == expected, (rule, after)
+            if actual is None:
+                break
+            after = actual
+
+
+def test_non_recurring_schedules():
+    assert compile_recurrence("once", time_of_day="10:00") is None
+    assert compile_recurrence("daily") is None
+    assert compile_recurrence("daily", time_of_day="10-00") is None
+    assert compile_recurrence("weekly", day_of_week="", time_of_day="10:00").next_after(datetime(2024, 1, 1)) is None
+
+
+@pytest.mark.skipif(not os.getenv("RUN_BENCHMARKS"), reason="замер времени: RUN_BENCHMARKS=1")
+def test_next_after_benchmark():
+    """
+    Замер next_after против перебора по дням: скомпилированное правило не зависит от того,
+    как далеко следующий запуск, поэтому должно быть заметно быстрее. Зависит от загрузки
+    машины, поэтому запускается только вручную; корректность проверяют тесты выше.
+    """
+    rng = random.Random(SEED + 2)
+    cases = [(random_rule(rng), random_moment(rng)) for _ in range(2000)]
+    compiled = [(compile_rule(*rule), after) for rule, after in cases]
+
+    started = time.perf_counter()
+    for recurrence, after in compiled:
+        recurrence.next_after(after)
+    fast = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for rule, after in cases:
+        brute_next_after(*rule, after)
+    slow = time.perf_counter() - started
+
+    assert fast < slow, f"next_after: {fast:.3f} с, перебор по дням: {slow:.3f} с"